@@ -19,13 +19,18 @@ import logging
 from framework.bizz.authentication import get_browser_language
 from framework.plugin_loader import get_config
 from mcfw.exceptions import HttpBadRequestException
-from mcfw.restapi import rest
+from mcfw.restapi import rest, GenericRESTRequestHandler
 from mcfw.rpc import returns, arguments, serialize_complex_value
 from plugins.reports.bizz.map import get_report_map_items, get_reports_map_item_details, vote_report_item, \
-    get_report_map_announcement
-from plugins.reports.consts import NAMESPACE
+    get_report_map_announcement, get_report_map_items_sync, get_report_map_snapshot_url, get_report_map_batch, \
+    MapItemsQuery
+from plugins.reports.consts import NAMESPACE, MapItemsSort
+from plugins.reports.utils import codec
+from plugins.reports.utils.geo import BoundingBox
 from plugins.reports.to import GetMapItemsResponseTO, GetMapItemDetailsResponseTO, ItemVoteTO, SaveMapItemVoteResponseTO, \
-    MapAnnouncementTO
+    MapAnnouncementTO, GetMapItemsSyncResponseTO, GetMapBatchRequestTO, GetMapBatchResponseTO
+
+MAX_BATCH_QUERIES = 10
 
 
 def validate_request(f, handler):
@@ -38,14 +43,73 @@ def validate_request(f, handler):
 @arguments(user_id=unicode)
 def api_get_map(user_id):
     announcement = get_report_map_announcement(user_id)
-    return {u'announcement': serialize_complex_value(announcement, MapAnnouncementTO(), False) if announcement else None}
+    return {u'announcement': serialize_complex_value(announcement, MapAnnouncementTO(), False) if announcement else None,
+            u'snapshot_url': get_report_map_snapshot_url(user_id)}
 
 
 @rest('/items', 'get', silent_result=True, custom_auth_method=validate_request)
-@returns(GetMapItemsResponseTO)
-@arguments(user_id=unicode, lat=float, lon=float, distance=(int, long), status=unicode, limit=(int, long), cursor=unicode)
-def api_get_items(user_id, lat, lon, distance, status=None, limit=None, cursor=None):
-    return get_report_map_items(user_id, lat, lon, distance, status, limit, cursor)
+@returns(dict)
+@arguments(user_id=unicode, lat=float, lon=float, distance=(int, long), status=unicode, limit=(int, long), cursor=unicode,
+           cluster=bool, bbox=unicode, sort=unicode, min_votes=(int, long))
+def api_get_items(user_id, lat=None, lon=None, distance=None, status=None, limit=None, cursor=None, cluster=False,
+                  bbox=None, sort=None, min_votes=None):
+    # bbox: 'top,left,bottom,right' to search a viewport instead of a circle around lat, lon
+    # sort: see MapItemsSort, default 'distance'
+    # min_votes: only incidents that were also reported by at least this many users
+    result = get_report_map_items(user_id, lat, lon, distance, status, limit, cursor, cluster, _parse_bbox(bbox),
+                                  _parse_sort(sort), min_votes, _wants_compact_items())
+    return codec.serialize(result, GetMapItemsResponseTO, False)
+
+
+@rest('/map/batch', 'post', silent_result=True, custom_auth_method=validate_request)
+@returns(dict)
+@arguments(data=GetMapBatchRequestTO)
+def api_get_map_batch(data):
+    # type: (GetMapBatchRequestTO) -> dict
+    # /map, /items for several filters or viewports and /items/detail in one request
+    if not data.user_id or len(data.queries) > MAX_BATCH_QUERIES:
+        raise HttpBadRequestException()
+    queries = [MapItemsQuery(query.lat, query.lon, query.distance, query.status, query.limit, query.cluster,
+                             _parse_bbox(query.bbox), _parse_sort(query.sort), query.min_votes)
+               for query in data.queries]
+    result = get_report_map_batch(data.user_id, queries, data.announcement, data.detail_ids, get_browser_language(),
+                                  _wants_compact_items())
+    return codec.serialize(result, GetMapBatchResponseTO, False)
+
+
+def _parse_bbox(bbox):
+    # type: (unicode) -> BoundingBox
+    if not bbox:
+        return None
+    try:
+        return BoundingBox.from_string(bbox)
+    except ValueError as e:
+        logging.debug(e.message, exc_info=True)
+        raise HttpBadRequestException()
+
+
+def _parse_sort(sort):
+    # type: (unicode) -> unicode
+    if not sort:
+        return MapItemsSort.DISTANCE
+    if sort not in MapItemsSort.all():
+        raise HttpBadRequestException('Invalid sort', {'allowed_sorts': MapItemsSort.all()})
+    return sort
+
+
+def _wants_compact_items():
+    # Newer clients request the compact format (see MapItemsCompactTO) via a header
+    headers = GenericRESTRequestHandler.get_current_request().headers
+    return headers.get('X-Map-Items-Format', '').lower() == 'compact'
+
+
+@rest('/items/sync', 'get', silent_result=True, custom_auth_method=validate_request)
+@returns(GetMapItemsSyncResponseTO)
+@arguments(user_id=unicode, lat=float, lon=float, distance=(int, long), status=unicode, limit=(int, long),
+           sync_token=unicode)
+def api_sync_items(user_id, lat, lon, distance, status=None, limit=None, sync_token=None):
+    # Changes since the sync_token returned by /items or a previous sync
+    return get_report_map_items_sync(user_id, lat, lon, distance, status, limit, sync_token)
 
 
 @rest('/items/detail', 'get', silent_result=True, custom_auth_method=validate_request)
@@ -27,6 +27,8 @@ from plugins.reports.dal import get_consumer, get_incident, update_incident
 from plugins.reports.integrations.int_topdesk.topdesk import topdesk_integration_call
 from plugins.reports.models import FormIntegration, SaveFormIntegrationTO, IncidentStatus
 from plugins.reports.to import IncidentListTO, IncidentTO, FormSubmittedCallback
+from plugins.reports.utils import codec
+from plugins.reports.utils.config_cache import invalidate_cached
 
 
 def get_auth_header():
@@ -59,6 +61,7 @@ def api_save_form_settings(data):
     form_integration.config = data.config
     form_integration.integration_id = consumer.integration_id
     form_integration.put()
+    invalidate_cached(FormIntegration)
     return form_integration.to_dict()
 
 
@@ -125,11 +128,12 @@ def api_save_incident(incident_id, data):
 
 @rest('/callbacks/form/<form_id:[^/]+>', 'post', silent_result=True)
 @returns(dict)
-@arguments(form_id=(int, long), data=FormSubmittedCallback)
+@arguments(form_id=(int, long), data=dict)
 def api_form_callback(form_id, data):
-    # type: (int, FormSubmittedCallback) -> str
+    # type: (int, dict) -> str
     consumer = _get_consumer()
-    return {'external_reference': create_incident_from_form(consumer.integration_id, data)}
+    submission = codec.parse(FormSubmittedCallback, data, False)  # type: FormSubmittedCallback
+    return {'external_reference': create_incident_from_form(consumer.integration_id, submission)}
 
 
 @rest('/integrations/topdesk/categories', 'get', silent_result=True)
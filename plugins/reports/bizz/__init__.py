@@ -15,17 +15,22 @@
 #
 # @@license_version:1.5@@
 import logging
+import random
 from datetime import datetime, date
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb, deferred
 
 from dateutil.relativedelta import relativedelta
 from framework.bizz.job import run_job
 from framework.i18n_utils import translate
+from mcfw.cache import cached, invalidate_cache
+from mcfw.rpc import returns, arguments
 from plugins.reports.models import IncidentVote, UserIncidentVote, Incident, IncidentStatus, \
-    IncidentStatisticsYear, IncidentStatisticsMonth, IntegrationSettings
+    IncidentStatisticsYear, IncidentStatisticsMonth, IntegrationSettings, IncidentVoteShard
 from plugins.reports.to import MapItemDetailsTO, TextSectionTO, VoteSectionTO, \
     MapItemTO, GeoPointTO, MapIconTO, MapVoteOptionTO
+from typing import Tuple, Dict, List
 
 ICON_MAPPING = {
     IncidentStatus.NEW: ('new', '#f10812'),
@@ -34,11 +39,25 @@ ICON_MAPPING = {
 }
 
 
-@ndb.transactional(xg=True)
+VOTES_CACHE_LIFETIME = 3600  # seconds
+# After a vote, the cached totals can't be added again for this long. Requests which summed the shards before the vote
+# was saved would otherwise cache their outdated totals.
+VOTES_CACHE_LOCK_TIME = 5  # seconds
+
+
 def update_incident_vote(incident_id, user_id, vote_id, to_option_id):
-    vote_key = IncidentVote.create_key(incident_id)
+    # type: (unicode, unicode, unicode, unicode) -> Tuple[IncidentVote, UserIncidentVote]
+    user_vote, deltas = _update_incident_vote(incident_id, user_id, to_option_id)
+    _update_cached_votes(incident_id, deltas)
+    return get_incident_votes([incident_id])[incident_id], user_vote
+
+
+@ndb.transactional(xg=True)
+def _update_incident_vote(incident_id, user_id, to_option_id):
+    # Only the user's vote and one random shard are part of the transaction
+    shard_key = IncidentVoteShard.create_key(incident_id, random.randint(0, IncidentVoteShard.SHARD_COUNT - 1))
     user_vote_key = UserIncidentVote.create_key(user_id, incident_id)
-    vote, user_vote = ndb.get_multi((vote_key, user_vote_key))
+    shard, user_vote = ndb.get_multi((shard_key, user_vote_key))
 
     from_option_id = None
     save_vote = True
@@ -56,30 +75,75 @@ def update_incident_vote(incident_id, user_id, vote_id, to_option_id):
         user_vote.option_id = to_option_id
         user_vote.put()
 
-    if not vote:
-        vote = IncidentVote(key=vote_key)
-
-    changed = False
-    if from_option_id == IncidentVote.NEGATIVE:
-        vote.negative_count -= 1
-        changed = True
-    if from_option_id == IncidentVote.POSITIVE:
-        vote.positive_count -= 1
-        changed = True
-
-    if from_option_id == to_option_id:
-        pass
-    elif IncidentVote.NEGATIVE == to_option_id:
-        vote.negative_count += 1
-        changed = True
-    elif IncidentVote.POSITIVE == to_option_id:
-        vote.positive_count += 1
-        changed = True
-
-    if changed:
-        vote.put()
-
-    return vote, user_vote
+    if not shard:
+        shard = IncidentVoteShard(key=shard_key)
+
+    deltas = {IncidentVote.NEGATIVE: 0, IncidentVote.POSITIVE: 0}
+    if from_option_id in deltas:
+        deltas[from_option_id] -= 1
+    if from_option_id != to_option_id and to_option_id in deltas:
+        deltas[to_option_id] += 1
+
+    if any(deltas.itervalues()):
+        # A shard can become negative when the user's vote was counted in another shard, only the sum matters
+        shard.negative_count += deltas[IncidentVote.NEGATIVE]
+        shard.positive_count += deltas[IncidentVote.POSITIVE]
+        shard.put()
+
+    return user_vote, deltas
+
+
+def _get_votes_cache_key(incident_id, option_id):
+    return 'incident-votes-%s-%s' % (option_id, incident_id)
+
+
+def _update_cached_votes(incident_id, deltas):
+    # type: (unicode, Dict[unicode, int]) -> None
+    # The totals are calculated from the shards again the next time they're needed
+    if any(deltas.itervalues()):
+        memcache.delete_multi([_get_votes_cache_key(incident_id, option_id) for option_id in deltas],
+                              seconds=VOTES_CACHE_LOCK_TIME, namespace=IncidentVoteShard.NAMESPACE)
+
+
+def invalidate_cached_votes(incident_ids):
+    # type: (List[unicode]) -> None
+    memcache.delete_multi([_get_votes_cache_key(incident_id, option_id) for incident_id in incident_ids
+                           for option_id in (IncidentVote.NEGATIVE, IncidentVote.POSITIVE)],
+                          namespace=IncidentVoteShard.NAMESPACE)
+
+
+def get_incident_votes(incident_ids):
+    # type: (List[unicode]) -> Dict[unicode, IncidentVote]
+    """Total vote counts per incident, from memcache or else summed from the shards"""
+    keys = {incident_id: (_get_votes_cache_key(incident_id, IncidentVote.NEGATIVE),
+                          _get_votes_cache_key(incident_id, IncidentVote.POSITIVE))
+            for incident_id in incident_ids}
+    cached = memcache.get_multi([key for incident_keys in keys.itervalues() for key in incident_keys],
+                                namespace=IncidentVoteShard.NAMESPACE)
+    votes = {}
+    missing = []
+    for incident_id, (negative_key, positive_key) in keys.iteritems():
+        if negative_key in cached and positive_key in cached:
+            votes[incident_id] = IncidentVote(key=IncidentVote.create_key(incident_id),
+                                              negative_count=cached[negative_key],
+                                              positive_count=cached[positive_key])
+        else:
+            missing.append(incident_id)
+    if missing:
+        shards = ndb.get_multi([key for incident_id in missing for key in IncidentVoteShard.list_keys(incident_id)])
+        to_cache = {}
+        for i, incident_id in enumerate(missing):
+            incident_shards = [shard for shard in shards[i * IncidentVoteShard.SHARD_COUNT:
+                                                         (i + 1) * IncidentVoteShard.SHARD_COUNT] if shard]
+            vote = IncidentVote(key=IncidentVote.create_key(incident_id),
+                                negative_count=sum(shard.negative_count for shard in incident_shards),
+                                positive_count=sum(shard.positive_count for shard in incident_shards))
+            votes[incident_id] = vote
+            to_cache[keys[incident_id][0]] = vote.negative_count
+            to_cache[keys[incident_id][1]] = vote.positive_count
+        # add instead of set: fails while the totals are locked by a vote, see _update_cached_votes
+        memcache.add_multi(to_cache, time=VOTES_CACHE_LIFETIME, namespace=IncidentVoteShard.NAMESPACE)
+    return votes
 
 
 def get_vote_options(vote, user_vote, language):
@@ -105,15 +169,26 @@ def get_vote_options(vote, user_vote, language):
 
 def convert_to_item_to(incident):
     # type: (Incident) -> MapItemTO
-    icon_id, icon_color = ICON_MAPPING.get(incident.status, IncidentStatus.NEW)
+    return _create_item_to(incident.id, incident.details.geo_location.lat, incident.details.geo_location.lon,
+                           incident.status, incident.details.title, incident.details.description)
+
 
-    return MapItemTO(id=incident.id,
-                     coords=GeoPointTO(lat=incident.details.geo_location.lat,
-                                       lon=incident.details.geo_location.lon),
+def convert_hit_to_item_to(incident_id, source):
+    # type: (unicode, dict) -> MapItemTO
+    # source is the document created by elasticsearch.index_incident_operations
+    return _create_item_to(incident_id, source['location']['lat'], source['location']['lon'], source['status'],
+                           source.get('title'), source.get('description'))
+
+
+def _create_item_to(incident_id, lat, lon, status, title, description):
+    icon_id, icon_color = ICON_MAPPING.get(status, ICON_MAPPING[IncidentStatus.NEW])
+    return MapItemTO(id=incident_id,
+                     coords=GeoPointTO(lat=lat,
+                                       lon=lon),
                      icon=MapIconTO(id=icon_id,
                                     color=icon_color),
-                     title=incident.details.title,
-                     description=incident.details.description)
+                     title=title,
+                     description=description)
 
 
 def convert_to_item_details_to(incident, vote, user_vote, language):
@@ -187,3 +262,13 @@ def re_count_incidents_year(app_id, year):
                            app_id=app_id,
                            year=year,
                            resolved_count=resolved_count).put()
+    invalidate_cache(get_resolved_count, app_id, year)
+
+
+@cached(1, lifetime=600, request=True, memcache=True)
+@returns(long)
+@arguments(app_id=unicode, year=(int, long))
+def get_resolved_count(app_id, year):
+    # Returns 0 when the statistics haven't been calculated yet
+    s = IncidentStatisticsYear.create_key(app_id, year).get()
+    return long(s.resolved_count if s else 0)
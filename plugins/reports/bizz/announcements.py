@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Keeps track of which users have already seen the map announcement this month, without writing to the datastore
+while opening the map. Users are marked in memcache immediately and saved in batches by save_seen_announcements.
+"""
+import json
+import logging
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+from plugins.reports.consts import ANNOUNCEMENTS_QUEUE, NAMESPACE
+from plugins.reports.models import UserIncidentAnnouncement
+
+SEEN_LIFETIME = 32 * 24 * 3600  # seconds, the marker is only needed for the current month
+SAVE_BATCH_SIZE = 500
+LEASE_SECONDS = 60
+
+
+def _get_seen_cache_key(user_id, year, month):
+    return 'announcement-seen-%s-%d-%02d' % (user_id, year, month)
+
+
+def mark_announcement_seen(user_id, year, month):
+    # type: (unicode, int, int) -> bool
+    """Returns False when the user had already seen the announcement for this month"""
+    cache_key = _get_seen_cache_key(user_id, year, month)
+    if memcache.get(cache_key, namespace=NAMESPACE):
+        return False
+    # Marker might have been evicted from memcache
+    if UserIncidentAnnouncement.create_key(user_id, year, month).get():
+        memcache.set(cache_key, True, time=SEEN_LIFETIME, namespace=NAMESPACE)
+        return False
+    if not memcache.add(cache_key, True, time=SEEN_LIFETIME, namespace=NAMESPACE):
+        # Concurrent request for the same user
+        return False
+    payload = json.dumps({'user_id': user_id, 'year': year, 'month': month})
+    taskqueue.Queue(ANNOUNCEMENTS_QUEUE).add(taskqueue.Task(payload=payload, method='PULL'))
+    return True
+
+
+def save_seen_announcements():
+    """Saves the markers of mark_announcement_seen in the datastore. Executed every minute by a cron job."""
+    queue = taskqueue.Queue(ANNOUNCEMENTS_QUEUE)
+    while True:
+        tasks = queue.lease_tasks(LEASE_SECONDS, SAVE_BATCH_SIZE)
+        if not tasks:
+            return
+        to_put = {}
+        for task in tasks:
+            data = json.loads(task.payload)
+            key = UserIncidentAnnouncement.create_key(data['user_id'], data['year'], data['month'])
+            to_put[key] = UserIncidentAnnouncement(key=key)
+        ndb.put_multi(to_put.values())
+        queue.delete_tasks(tasks)
+        logging.info('Saved %d seen announcements', len(to_put))
+        if len(tasks) < SAVE_BATCH_SIZE:
+            return
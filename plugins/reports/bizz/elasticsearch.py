@@ -16,190 +16,887 @@
 # @@license_version:1.5@@
 
 import base64
+import httplib
 import itertools
 import json
 import logging
+import random
+import threading
 import time
+import urllib
+from collections import namedtuple
 
-from google.appengine.api import urlfetch
+from google.appengine.api import urlfetch, apiproxy_stub_map
 from google.appengine.ext import ndb
+from mcfw.cache import cached
 from mcfw.consts import DEBUG
+from mcfw.rpc import returns, arguments
 from typing import Generator, Dict, Iterable, List, Tuple, Union
 
-from plugins.reports.bizz import convert_to_item_to
-from plugins.reports.models import ElasticsearchSettings, Incident
+from plugins.reports.bizz import convert_to_item_to, convert_hit_to_item_to, get_incident_votes
+from plugins.reports.bizz.search_cache import invalidate_search_cache
+from plugins.reports.consts import MapItemsSort
+from plugins.reports.models import ElasticsearchSettings, Incident, ReindexJob, IndexingFailure, IntegrationSettings, \
+    IncidentVote
+from plugins.reports.to import MapItemTO, MapClusterTO, GeoPointTO, MapClusterStatusTO
+from plugins.reports.utils import geohash
+from plugins.reports.utils.config_cache import get_cached, invalidate_cached
+from plugins.reports.utils.geo import BoundingBox
+
+
+class ElasticsearchException(Exception):
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        super(ElasticsearchException, self).__init__('Invalid response from elasticsearch: %s' % status_code)
+
+
+class ElasticsearchClient(object):
+    """
+    Process wide client for the elasticsearch cluster.
+
+    The settings and the authorization header are cached on the instance so a request doesn't need a datastore
+    lookup. Connections are pooled and kept alive by the urlfetch service, we only make sure the headers and the
+    base url are identical between calls.
+    """
+    SETTINGS_LIFETIME = 5 * 60  # seconds
+    DEFAULT_DEADLINE = 30  # seconds, total budget for one call including retries
+    MAX_RETRIES = 2
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    BACKOFF_BASE = 0.1  # seconds
+    BACKOFF_MAX = 2  # seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._base_url = None
+        self._headers = None
+        self._settings_version = None
+        self._settings_expiration = 0
+
+    @property
+    def settings_version(self):
+        return self._settings_version
+
+    def _load_settings(self):
+        now = time.time()
+        if self._base_url and now < self._settings_expiration:
+            return self._base_url, self._headers
+        with self._lock:
+            if not self._base_url or now >= self._settings_expiration:
+                config = get_elasticsearch_config()
+                version = (config.base_url, config.auth_username, config.auth_password)
+                if version != self._settings_version:
+                    credentials = base64.b64encode('%s:%s' % (config.auth_username, config.auth_password))
+                    self._headers = {
+                        'Accept': 'application/json',
+                        'Authorization': 'Basic %s' % credentials,
+                    }
+                    self._base_url = config.base_url
+                    self._settings_version = version
+                self._settings_expiration = now + self.SETTINGS_LIFETIME
+        return self._base_url, self._headers
+
+    def invalidate_settings(self):
+        # Applies changed ElasticsearchSettings right away, otherwise they are picked up within 2 * SETTINGS_LIFETIME
+        invalidate_cached(ElasticsearchSettings)
+        with self._lock:
+            self._settings_expiration = 0
+
+    @classmethod
+    def get_backoff(cls, attempt):
+        # type: (int) -> float
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(cls.BACKOFF_MAX, cls.BACKOFF_BASE * 2 ** attempt))
+
+    def request(self, path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204),
+                deadline=DEFAULT_DEADLINE, max_retries=MAX_RETRIES, hedge=False):
+        # type: (str, int, Union[Dict, str], Tuple[int], float, int, bool) -> Union[Dict, str]
+        """
+        Args:
+            path (str): path relative to the base url of the cluster
+            method (int): urlfetch method
+            payload (dict or str): dicts are sent as json, strings as ndjson
+            allowed_status_codes (tuple of int)
+            deadline (float): time budget in seconds for this call, including retries
+            max_retries (int): amount of retries after a 429/5xx status or a connection error
+            hedge (bool): send the request twice and use the first response. Only use this for read requests.
+        """
+        base_url, base_headers = self._load_settings()
+        headers = dict(base_headers)
+        if payload:
+            if isinstance(payload, basestring):
+                headers['Content-Type'] = 'application/x-ndjson'
+            else:
+                headers['Content-Type'] = 'application/json'
+        data = json.dumps(payload) if isinstance(payload, dict) else payload
+        url = base_url + path
+        if DEBUG:
+            if data:
+                logging.debug('%s\n%s', url, data)
+            else:
+                logging.debug(url)
+
+        end_time = time.time() + deadline
+        attempt = 0
+        while True:
+            remaining = end_time - time.time()
+            try:
+                result = self._fetch(url, data, method, headers, remaining, hedge)
+                if result.status_code not in self.RETRY_STATUS_CODES:
+                    break
+                error = ElasticsearchException(result.status_code, result.content)
+            except (urlfetch.DownloadError, urlfetch.DeadlineExceededError) as e:
+                error = e
+            attempt += 1
+            backoff = self.get_backoff(attempt)
+            if attempt > max_retries or time.time() + backoff >= end_time:
+                logging.debug('Giving up on %s after %d attempt(s)', url, attempt)
+                raise error
+            logging.info('Retrying request to %s in %.2fs: %s', url, backoff, error)
+            time.sleep(backoff)
+
+        if result.status_code not in allowed_status_codes:
+            logging.debug(result.content)
+            raise ElasticsearchException(result.status_code, result.content)
+        if result.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(result.content)
+        return result.content
+
+    def _fetch(self, url, data, method, headers, deadline, hedge):
+        # type: (str, str, int, dict, float, bool) -> urlfetch._URLFetchResult
+        rpcs = []
+        for _ in xrange(2 if hedge else 1):
+            rpc = urlfetch.create_rpc(deadline=deadline)
+            urlfetch.make_fetch_call(rpc, url, data, method, headers)
+            rpcs.append(rpc)
+        if len(rpcs) == 1:
+            return rpcs[0].get_result()
+        # Use whichever response arrives first, fall back to the other one if that one failed
+        first = apiproxy_stub_map.UserRPC.wait_any(rpcs)
+        rpcs.remove(first)
+        try:
+            result = first.get_result()
+            if result.status_code not in self.RETRY_STATUS_CODES:
+                return result
+        except (urlfetch.DownloadError, urlfetch.DeadlineExceededError):
+            logging.debug('Hedged request to %s failed, waiting for the other one', url, exc_info=True)
+        return rpcs[0].get_result()
+
+
+_client = ElasticsearchClient()
+
+
+def get_elasticsearch_client():
+    # type: () -> ElasticsearchClient
+    return _client
 
 
 def get_elasticsearch_config():
     # type: () -> ElasticsearchSettings
-    settings = ElasticsearchSettings.create_key().get()
+    # Only edited in the datastore viewer, so nothing invalidates the cache
+    settings = get_cached(ElasticsearchSettings.create_key(),
+                          lifetime=ElasticsearchClient.SETTINGS_LIFETIME)  # type: ElasticsearchSettings
     if not settings:
         raise Exception('elasticsearch settings not found')
     return settings
 
 
-def _request(path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204)):
+def _request(path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204), **kwargs):
     # type: (str, int, Dict, Tuple[int]) -> Dict
-    config = get_elasticsearch_config()
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (config.auth_username, config.auth_password))
-    }
-    if payload:
-        if isinstance(payload, basestring):
-            headers['Content-Type'] = 'application/x-ndjson'
-        else:
-            headers['Content-Type'] = 'application/json'
-    data = json.dumps(payload) if isinstance(payload, dict) else payload
-    url = config.base_url + path
-    if DEBUG:
-        if data:
-            logging.debug('%s\n%s', url, data)
-        else:
-            logging.debug(url)
-    result = urlfetch.fetch(url, data, method, headers, deadline=30)  # type: urlfetch._URLFetchResult
-    if result.status_code not in allowed_status_codes:
-        logging.debug(result.content)
-        raise Exception('Invalid response from elasticsearch: %s' % result.status_code)
-    if result.headers.get('Content-Type').startswith('application/json'):
-        return json.loads(result.content)
-    return result.content
-
-
-def execute_bulk_request(operations):
-    # type: (Iterable[Dict]) -> List[Dict]
-    path = '/%s/_bulk' % get_reports_index()
-    # NDJSON
-    payload = '\n'.join([json.dumps(op) for op in operations])
-    payload += '\n'
-    result = _request(path, urlfetch.POST, payload)
-    if result['errors'] is True:
-        logging.debug(result)
-        # throw the first error found
-        for item in result['items']:
-            k = item.keys()[0]
-            if 'error' in item[k]:
-                reason = item[k]['error']['reason']
-                raise Exception(reason)
-    return result['items']
+    return get_elasticsearch_client().request(path, method, payload, allowed_status_codes, **kwargs)
+
+
+class BulkItemResult(object):
+
+    def __init__(self, action, doc_id, status, error=None):
+        # type: (str, unicode, int, dict) -> None
+        self.action = action
+        self.doc_id = doc_id
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self):
+        # Version conflicts mean a newer version of the document has already been indexed. Vote updates of documents
+        # that don't exist (anymore) can be ignored, a new document always contains the latest counts.
+        return not self.error or self.status == httplib.CONFLICT or \
+            (self.action == 'update' and self.status == httplib.NOT_FOUND)
+
+    @property
+    def retryable(self):
+        # e.g. 429 es_rejected_execution when the write queue of a node is full
+        return not self.ok and self.status in ElasticsearchClient.RETRY_STATUS_CODES
+
+    def __repr__(self):
+        return '<BulkItemResult %s %s: %s %s>' % (self.action, self.doc_id, self.status, self.error)
+
+
+def execute_bulk_request(operations, index=None, wait_for_refresh=False):
+    # type: (Iterable[Dict], str, bool) -> List[BulkItemResult]
+    """
+    Executes the operations on `index`. When no index is specified, the operations are executed on the live index and
+    also on the index that is being built by a reindex job (if any).
+    With `wait_for_refresh`, this only returns once the changes are visible to searches on the live index (or
+    `index`). The index of a reindex job has refreshing disabled, so that one is never waited for.
+
+    The operations are sent in chunks of at most BULK_MAX_BYTES / BULK_MAX_ACTIONS. Items that were rejected are
+    retried, permanent failures are saved as IndexingFailure.
+
+    Returns:
+        one result per action on the live index (or `index`), in the same order as the operations. Items which are
+        still retryable after BULK_MAX_RETRIES are not dead-lettered, the caller should try those again later.
+    """
+    indices = [index] if index else get_write_indices()
+    results = []
+    for chunk in _chunk_bulk_actions(_iter_bulk_actions(operations)):
+        for index_name in indices:
+            is_read_index = index_name == indices[0]
+            chunk_results = _execute_bulk_chunk(index_name, chunk, wait_for_refresh and is_read_index)
+            if is_read_index:
+                results.extend(chunk_results)
+    return results
+
+
+def _iter_bulk_actions(operations):
+    # type: (Iterable[Dict]) -> Generator[Tuple[Dict, Dict, str], None, None]
+    """Groups the operations per action and serializes them as NDJSON: (metadata, document, ndjson lines)"""
+    operations = iter(operations)
+    for metadata in operations:
+        # All actions except for delete are followed by a document
+        doc = None if 'delete' in metadata else next(operations)
+        yield metadata, doc, _serialize_bulk_action(metadata, doc)
+
+
+def _serialize_bulk_action(metadata, doc, routing=True):
+    # type: (Dict, Dict, bool) -> str
+    if not routing:
+        metadata = {action: {k: v for k, v in params.iteritems() if k != 'routing'}
+                    for action, params in metadata.iteritems()}
+    lines = [json.dumps(metadata)]
+    if doc is not None:
+        lines.append(json.dumps(doc))
+    return '\n'.join(lines) + '\n'
+
+
+def _chunk_bulk_actions(actions):
+    # type: (Iterable[Tuple[Dict, Dict, str]]) -> Generator[List[Tuple[Dict, Dict, str]], None, None]
+    chunk = []
+    chunk_size = 0
+    for action in actions:
+        action_size = len(action[2])
+        if chunk and (chunk_size + action_size > BULK_MAX_BYTES or len(chunk) >= BULK_MAX_ACTIONS):
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(action)
+        chunk_size += action_size
+    if chunk:
+        yield chunk
+
+
+def _execute_bulk_chunk(index, chunk, wait_for_refresh=False):
+    # type: (str, List[Tuple[Dict, Dict, str]], bool) -> List[BulkItemResult]
+    if is_routed_by_app(index):
+        lines = [action[2] for action in chunk]
+    else:
+        lines = [_serialize_bulk_action(metadata, doc, routing=False) for metadata, doc, _ in chunk]
+    results = [None] * len(chunk)  # type: List[BulkItemResult]
+    pending = range(len(chunk))
+    path = '/%s/_bulk' % index
+    if wait_for_refresh:
+        path += '?refresh=wait_for'
+    attempt = 0
+    while True:
+        payload = ''.join(lines[i] for i in pending)
+        response = _request(path, urlfetch.POST, payload, deadline=60)
+        retry = []
+        for i, item in zip(pending, response['items']):
+            action, status = item.items()[0]
+            results[i] = BulkItemResult(action, status.get('_id'), status['status'], status.get('error'))
+            if results[i].retryable:
+                retry.append(i)
+        attempt += 1
+        if not retry or attempt > BULK_MAX_RETRIES:
+            break
+        backoff = ElasticsearchClient.get_backoff(attempt)
+        logging.info('Retrying %d/%d rejected bulk actions on %s in %.2fs', len(retry), len(chunk), index, backoff)
+        time.sleep(backoff)
+        pending = retry
+
+    failures = [IndexingFailure(key=IndexingFailure.create_key(index, result.doc_id),
+                                index=index,
+                                doc_id=result.doc_id,
+                                status=result.status,
+                                error=result.error,
+                                operation=lines[i])
+                for i, result in enumerate(results) if not result.ok and not result.retryable]
+    if failures:
+        logging.error('%d bulk actions failed on %s: %s', len(failures), index, [f.error for f in failures])
+        ndb.put_multi(failures)
+    retryable_count = len([result for result in results if result.retryable])
+    if retryable_count:
+        logging.warning('%d bulk actions were still rejected by %s after %d attempts', retryable_count, index, attempt)
+    return results
+
+
+# Send search requests twice and use the fastest response, trades cluster load for lower tail latency
+SEARCH_HEDGING = False
+# Page through a point in time snapshot of the index so results don't shift between pages
+SEARCH_POINT_IN_TIME = False
+SEARCH_PIT_KEEP_ALIVE = '2m'
+# Geohash precisions stored as keyword fields on every document, used to cluster incidents on the map
+CLUSTER_PRECISIONS = range(3, 8)
+# Don't cluster when the map is zoomed in this far
+CLUSTER_MIN_DISTANCE = 2000  # meters
+# Amount of cells that should roughly fit in the diameter of the visible area
+CLUSTER_CELLS_PER_DIAMETER = 8
+MAX_CLUSTERS = 500
+REINDEX_TARGET_CACHE_LIFETIME = 60  # seconds
+# Tombstones are kept this long, clients with older sync tokens have to reload all items
+TOMBSTONE_LIFETIME = 30 * 24 * 3600  # seconds
+# Changes made this long before a sync token was created are included in the next sync
+SYNC_MARGIN = 5 * 60  # seconds
+BULK_MAX_BYTES = 5 * 1024 * 1024
+BULK_MAX_ACTIONS = 500
+# Retries for items rejected by elasticsearch, on top of the retries of the request itself
+BULK_MAX_RETRIES = 3
 
 
 def get_reports_index():
+    # This is an alias pointing to the current version of the index, see bizz.reindex
     if DEBUG:
         return 'debug-reports'
     return 'reports'
 
 
-def delete_index():
-    path = '/%s' % get_reports_index()
+def get_versioned_index(version):
+    # type: (int) -> str
+    return '%s-v%d' % (get_reports_index(), version)
+
+
+def get_write_indices():
+    # type: () -> List[str]
+    indices = [get_reports_index()]
+    reindex_target = get_reindex_target()
+    if reindex_target:
+        indices.append(reindex_target)
+    return indices
+
+
+@cached(1, lifetime=REINDEX_TARGET_CACHE_LIFETIME, request=True, memcache=True)
+@returns(unicode)
+@arguments()
+def get_reindex_target():
+    job = ReindexJob.get_running()
+    return job and job.index
+
+
+@cached(1, lifetime=3600, request=True, memcache=True)
+@returns(bool)
+@arguments(index=unicode)
+def is_routed_by_app(index):
+    """
+    Documents are routed by app id and contain the app id, so a search only needs to query one shard.
+    Indices created before this was added route documents by their id and need to be rebuilt, see bizz.reindex.
+    """
+    mappings = _request('/%s/_mapping' % index)
+    return any(mapping['mappings'].get('_routing', {}).get('required', False) for mapping in mappings.itervalues())
+
+
+@cached(1, lifetime=3600, request=True, memcache=True)
+@returns(unicode)
+@arguments(index=unicode)
+def get_id_sort_field(index):
+    """
+    Field to sort on by incident id. Indices created before `id` was mapped as a keyword have a dynamic text mapping,
+    which can't be sorted on. Those can only use the keyword subfield until they're rebuilt, see bizz.reindex.
+    """
+    mappings = _request('/%s/_mapping' % index)
+    for mapping in mappings.itervalues():
+        id_mapping = mapping['mappings'].get('properties', {}).get('id', {})
+        if id_mapping.get('type') == 'text' and 'keyword' in id_mapping.get('fields', {}):
+            return u'id.keyword'
+    return u'id'
+
+
+def delete_index(index=None):
+    path = '/%s' % (index or get_reports_index())
     return _request(path, urlfetch.DELETE)
 
 
-def create_index():
+def create_index(index=None, index_settings=None):
+    properties = {
+        'location': {
+            'type': 'geo_point'
+        },
+        'status': {
+            'type': 'keyword'
+        },
+        'id': {
+            'type': 'keyword'
+        },
+        'updated': {
+            'type': 'date',
+            'format': 'epoch_millis'
+        },
+        'deleted': {
+            'type': 'boolean'
+        },
+        'app_id': {
+            'type': 'keyword'
+        },
+        'integration_id': {
+            'type': 'long'
+        },
+        'negative_votes': {
+            'type': 'integer'
+        },
+        'positive_votes': {
+            'type': 'integer'
+        },
+        'title': {
+            'type': 'text',
+            'index': False
+        },
+        'description': {
+            'type': 'text',
+            'index': False
+        }
+    }
+    for precision in CLUSTER_PRECISIONS:
+        properties[_get_geohash_field(precision)] = {'type': 'keyword'}
     request = {
         'mappings': {
-            'properties': {
-                'location': {
-                    'type': 'geo_point'
-                },
-                'status': {
-                    'type': 'keyword'
-                }
-            }
+            '_routing': {
+                'required': True
+            },
+            'properties': properties
         }
     }
-    path = '/%s' % get_reports_index()
+    if index_settings:
+        request['settings'] = index_settings
+    path = '/%s' % (index or get_reports_index())
     return _request(path, urlfetch.PUT, request)
 
 
-def _index_incident(incident):
-    # type: (Incident) -> Generator[Dict]
-    if incident.visible:
+def index_incident_operations(incident, vote):
+    # type: (Incident, IncidentVote) -> Generator[Dict]
+    """
+    The document contains everything needed to build a MapItemTO, so searches don't need to fetch the incident from
+    the datastore. This is always a full `index` operation and every change to a visible incident is saved through
+    bizz.indexer.save_incident(s), which re-indexes it with this function. This way the stored fields can never drift
+    from the datastore. The only partial updates are those of the vote counts, see vote_update_operations.
+
+    Incidents that are no longer visible are replaced by a tombstone, so clients syncing their map can remove them.
+    Tombstones are excluded from normal searches and deleted by cleanup_tombstones after TOMBSTONE_LIFETIME.
+    """
+    app_id = _get_app_id(incident.integration_id)
+    geo_location = incident.details and incident.details.geo_location
+    if not geo_location:
+        return delete_doc_operations(incident.id, incident.version, app_id)
+    doc = {
+        'location': {
+            'lat': geo_location.lat,
+            'lon': geo_location.lon
+        },
+        'id': incident.id,
+        'app_id': app_id,
+        'integration_id': incident.integration_id,
+        'updated': incident.version / 1000 if incident.version else None,
+        'negative_votes': vote.negative_count,
+        'positive_votes': vote.positive_count,
+    }
+    if not incident.visible:
+        doc['deleted'] = True
+        return index_doc_operations(incident.id, doc, incident.version, app_id)
+    doc.update({
+        'status': incident.status,
+        'title': incident.details.title,
+        'description': incident.details.description,
+    })
+    for precision in CLUSTER_PRECISIONS:
+        doc[_get_geohash_field(precision)] = geohash.encode(geo_location.lat, geo_location.lon, precision)
+    return index_doc_operations(incident.id, doc, incident.version, app_id)
+
+
+def deleted_incident_operations(incident_ids):
+    # type: (List[unicode]) -> List[Dict]
+    """
+    Replaces the documents of incidents that were removed from the datastore by a tombstone, like
+    index_incident_operations does for invisible incidents. The location and app of those incidents can only be read
+    from their current documents.
+    """
+    if not incident_ids:
+        return []
+    qry = {
+        'size': len(incident_ids),
+        '_source': ['location', 'app_id', 'integration_id', 'deleted'],
+        'query': {
+            'ids': {
+                'values': incident_ids
+            }
+        }
+    }
+    hits = _request('/%s/_search' % get_reports_index(), urlfetch.POST, qry)['hits']['hits']
+    # Newer than any version of the incident that was indexed before
+    version = long(time.time() * 1000000)
+    operations = []
+    for hit in hits:
+        source = hit['_source']
+        if source.get('deleted') or 'location' not in source:
+            continue
         doc = {
-            'location': {
-                'lat': incident.details.geo_location.lat,
-                'lon': incident.details.geo_location.lon
-            },
-            'status': incident.status
+            'location': source['location'],
+            'id': hit['_id'],
+            'app_id': source.get('app_id'),
+            'integration_id': source.get('integration_id'),
+            'updated': version / 1000,
+            'deleted': True,
         }
-        return index_doc_operations(incident.id, doc)
-    else:
-        return delete_doc_operations(incident.id)
+        operations.extend(index_doc_operations(hit['_id'], doc, version, hit.get('_routing')))
+    return operations
+
+
+def vote_update_operations(incident, vote):
+    # type: (Incident, IncidentVote) -> Generator[Dict]
+    # Doesn't change `updated`: the vote counts aren't part of the synced map items
+    if not incident.details or not incident.details.geo_location:
+        return
+    metadata = _get_operation_metadata(incident.id, None, _get_app_id(incident.integration_id))
+    metadata['retry_on_conflict'] = 3
+    yield {'update': metadata}
+    yield {'doc': {'negative_votes': vote.negative_count, 'positive_votes': vote.positive_count}}
 
 
-def delete_doc_operations(uid):
-    yield {'delete': {'_id': uid}}
+def _get_app_id(integration_id):
+    # type: (long) -> unicode
+    return get_cached(IntegrationSettings.create_key(integration_id)).app_id
 
 
-def index_doc_operations(uid, doc):
-    yield {'index': {'_id': uid}}
+def _get_operation_metadata(uid, version, routing):
+    metadata = {'_id': uid}
+    # Ensures an older version of an incident can't overwrite a newer one, e.g. while a reindex job is running
+    if version:
+        metadata['version'] = version
+        metadata['version_type'] = 'external_gte'
+    if routing:
+        metadata['routing'] = routing
+    return metadata
+
+
+def delete_doc_operations(uid, version=None, routing=None):
+    yield {'delete': _get_operation_metadata(uid, version, routing)}
+
+
+def index_doc_operations(uid, doc, version=None, routing=None):
+    yield {'index': _get_operation_metadata(uid, version, routing)}
     yield doc
 
 
 def re_index_incident(incident):
-    # type: (Incident) -> List[Dict]
-    return execute_bulk_request(_index_incident(incident))
+    # type: (Incident) -> List[BulkItemResult]
+    return re_index_incidents([incident])
 
 
 def re_index_incidents(incidents):
-    # type: (List[Incident]) -> List[Dict]
-    operations = itertools.chain.from_iterable([_index_incident(incident) for incident in incidents])
-    return execute_bulk_request(operations)
+    # type: (List[Incident]) -> List[BulkItemResult]
+    votes = get_incident_votes([incident.id for incident in incidents])
+    operations = itertools.chain.from_iterable([index_incident_operations(incident, votes[incident.id])
+                                                for incident in incidents])
+    results = execute_bulk_request(operations, wait_for_refresh=True)
+    invalidate_search_cache(incidents)
+    return results
+
+
+# Fields needed to build a MapItemTO
+MAP_ITEM_FIELDS = ['location', 'status', 'title', 'description']
 
 
-def search_current(lat, lon, distance, status, cursor=None, limit=10):
+def search_current(lat, lon, distance, status, cursor=None, limit=10, app_id=None, bbox=None,
+                   sort=MapItemsSort.DISTANCE, min_votes=None):
+    # type: (float, float, int, str, str, int, str, BoundingBox, str, int) -> Tuple[List[MapItemTO], Union[None, str]]
+    """
+    Searches the incidents within `distance` meters of lat, lon or, when `bbox` is set, within that bounding box.
+    Results are sorted by distance from lat, lon and by id (see MapItemsSort for the other options). Sorting by id only
+    is cheaper and is fine when the client shows all results of the bounding box anyway.
+    `min_votes` only returns incidents that were also reported by at least that many users.
+    """
     start_time = time.time()
-    new_cursor, result_ids = _search(lat, lon, distance, status, cursor, limit)
+    new_cursor, hits = _search(lat, lon, distance, status, cursor, limit, app_id, bbox, sort, min_votes)
     took_time = time.time() - start_time
     logging.info('debugging.search_current _search {0:.3f}s'.format(took_time))
-    keys = {Incident.create_key(id_) for id_ in result_ids}
+    return _convert_hits_to_item_tos(hits), new_cursor
 
-    if keys:
+
+def _convert_hits_to_item_tos(hits):
+    # type: (List[Dict]) -> List[MapItemTO]
+    return _convert_hit_lists_to_item_tos([hits])[0]
+
+
+def _convert_hit_lists_to_item_tos(hit_lists):
+    # type: (List[List[Dict]]) -> List[List[MapItemTO]]
+    # Converts the hits of several searches at once, so there's at most one datastore call
+    hits = [hit for hit_list in hit_lists for hit in hit_list]
+    items = [convert_hit_to_item_to(hit['_id'], hit['_source']) if 'title' in hit.get('_source', {}) else None
+             for hit in hits]
+    # Documents indexed before the map item fields were added to the index: fetch those from the datastore
+    missing = [hit['_id'] for hit, item in zip(hits, items) if not item]
+    if missing:
         start_time = time.time()
-        models = ndb.get_multi(keys)
+        models = ndb.get_multi([Incident.create_key(id_) for id_ in missing])
         took_time = time.time() - start_time
         logging.info('debugging.search_current ndb.get_multi {0:.3f}s'.format(took_time))
+        models_by_id = {model.id: model for model in models if model}
+        for i, hit in enumerate(hits):
+            if not items[i] and hit['_id'] in models_by_id:
+                items[i] = convert_to_item_to(models_by_id[hit['_id']])
+    results = []
+    offset = 0
+    for hit_list in hit_lists:
+        results.append([item for item in items[offset:offset + len(hit_list)] if item])
+        offset += len(hit_list)
+    return results
 
-        start_time = time.time()
-        items = [convert_to_item_to(model) for model in models]
-        took_time = time.time() - start_time
-        logging.info('debugging.search_current convert_to_item_tos {0:.3f}s'.format(took_time))
-    else:
-        items = []
 
-    return items, new_cursor
+def _encode_cursor(sort_values, pit_id=None):
+    # type: (list, str) -> unicode
+    data = {'s': sort_values}
+    if pit_id:
+        data['p'] = pit_id
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':'))).decode('utf-8')
 
 
-def _search(lat, lon, distance, status, cursor, limit):
-    # type: (float, float, int, str, str, int) -> Tuple[Union[None, str], List[str]]
-    # we can only fetch up to 10000 items with from param
-    start_offset = long(cursor) if cursor else 0
+def _decode_cursor(cursor):
+    # type: (str) -> Tuple[list, Union[None, str]]
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return data['s'], data.get('p')
+    except (TypeError, ValueError, KeyError):
+        logging.debug('Invalid cursor: %s', cursor, exc_info=True)
+        return None, None
+
+
+def _open_point_in_time(routing=None):
+    # type: (str) -> str
+    path = '/%s/_pit?keep_alive=%s' % (get_reports_index(), SEARCH_PIT_KEEP_ALIVE)
+    if routing:
+        path += '&routing=%s' % urllib.quote(routing)
+    return _request(path, urlfetch.POST, deadline=5)['id']
 
-    if (start_offset + limit) > 10000:
-        limit = 10000 - start_offset
-    if limit <= 0:
-        return None, []
 
+def _get_search_routing(app_id):
+    # type: (str) -> Union[None, str]
+    # Only filter on app when all documents contain the app id
+    if app_id and is_routed_by_app(get_reports_index()):
+        return app_id
+    return None
+
+
+def _get_search_path(routing):
+    # type: (str) -> str
+    path = '/%s/_search' % get_reports_index()
+    if routing:
+        path += '?routing=%s' % urllib.quote(routing)
+    return path
+
+
+def _get_search_query(lat, lon, distance, status, app_id=None, include_deleted=False, bbox=None, min_votes=None):
+    # type: (float, float, int, str, str, bool, BoundingBox, int) -> dict
+    # Without bounding box or distance, all incidents (of the app) match
+    filters = []
+    if bbox:
+        filters.append({
+            'geo_bounding_box': {
+                'location': {
+                    'top_left': {
+                        'lat': bbox.top,
+                        'lon': bbox.left
+                    },
+                    'bottom_right': {
+                        'lat': bbox.bottom,
+                        'lon': bbox.right
+                    }
+                }
+            }
+        })
+    elif distance:
+        filters.append({
+            'geo_distance': {
+                'distance': '%sm' % distance,
+                'location': {
+                    'lat': lat,
+                    'lon': lon
+                }
+            }
+        })
+    qry = {
+        'bool': {
+            'must': {
+                'match_all': {}
+            },
+            'filter': filters
+        }
+    }
+    if status:
+        qry['bool']['filter'].append({
+            'term': {
+                'status': status
+            }
+        })
+    if min_votes:
+        qry['bool']['filter'].append({
+            'range': {
+                'negative_votes': {
+                    'gte': min_votes
+                }
+            }
+        })
+    if app_id:
+        # Routing only limits the search to one shard, other apps can have documents on that shard as well
+        qry['bool']['filter'].append({
+            'term': {
+                'app_id': app_id
+            }
+        })
+    if not include_deleted:
+        qry['bool']['must_not'] = [{
+            'term': {
+                'deleted': True
+            }
+        }]
+    return qry
+
+
+def get_sync_token(timestamp=None):
+    # type: (float) -> unicode
+    """
+    Token to pass to sync_items to get all changes since `timestamp` (default: now). The token is a bit older than
+    that, since incidents are indexed a short while after they were changed.
+    """
+    timestamp = (timestamp or time.time()) - SYNC_MARGIN
+    return _encode_cursor([long(timestamp * 1000), ''])
+
+
+def sync_items(lat, lon, distance, status, sync_token, limit, app_id=None):
+    # type: (float, float, int, str, str, int, str) -> Tuple[List[MapItemTO], List[unicode], unicode, bool, bool]
+    """
+    Returns the incidents in the area that were added or changed since `sync_token`, the ids of the incidents that
+    were removed (or no longer match `status`), the token for the next sync, whether there are more changes to fetch
+    with that token and whether the client should reload all items because the token is too old.
+    """
+    search_after, _ = _decode_cursor(sync_token)
+    if not search_after or search_after[0] < (time.time() - TOMBSTONE_LIFETIME) * 1000:
+        return [], [], get_sync_token(), False, True
+    routing = _get_search_routing(app_id)
     qry = {
         'size': limit,
-        'from': start_offset,
+        '_source': MAP_ITEM_FIELDS + ['deleted'],
+        # No status filter: incidents which changed to another status must be removed
+        'query': _get_search_query(lat, lon, distance, None, routing, include_deleted=True),
+        'sort': [{'updated': {'order': 'asc', 'unmapped_type': 'date'}},
+                 {get_id_sort_field(get_reports_index()): {'order': 'asc', 'unmapped_type': 'keyword'}}],
+        'search_after': search_after,
+        'track_total_hits': False,
+    }
+    # Documents indexed before the updated field was added can't be synced
+    qry['query']['bool']['filter'].append({'exists': {'field': 'updated'}})
+    result_data = _request(_get_search_path(routing), urlfetch.POST, qry, deadline=10, hedge=SEARCH_HEDGING)
+    hits = result_data['hits']['hits']
+    changed = []
+    removed_ids = []
+    for hit in hits:
+        source = hit['_source']
+        if source.get('deleted') or (status and source.get('status') != status):
+            removed_ids.append(hit['_id'])
+        else:
+            changed.append(hit)
+    has_more = len(hits) == limit
+    if has_more:
+        new_token = _encode_cursor(hits[-1]['sort'])
+    else:
+        new_token = get_sync_token()
+    return _convert_hits_to_item_tos(changed), removed_ids, new_token, has_more, False
+
+
+def cleanup_tombstones():
+    """Removes tombstones which are older than the oldest sync token that's still accepted"""
+    qry = {
         'query': {
             'bool': {
-                'must': {
-                    'match_all': {}
-                },
                 'filter': [{
-                    'geo_distance': {
-                        'distance': '%sm' % distance,
-                        'location': {
-                            'lat': lat,
-                            'lon': lon
+                    'term': {
+                        'deleted': True
+                    }
+                }, {
+                    'range': {
+                        'updated': {
+                            'lt': long((time.time() - TOMBSTONE_LIFETIME) * 1000)
                         }
                     }
                 }]
             }
-        },
-        'sort': [{
+        }
+    }
+    for index in get_write_indices():
+        path = '/%s/_delete_by_query?conflicts=proceed' % index
+        result = _request(path, urlfetch.POST, qry, deadline=60)
+        logging.info('Deleted %s tombstones from %s', result['deleted'], index)
+
+
+def _search(lat, lon, distance, status, cursor, limit, app_id=None, bbox=None, sort=MapItemsSort.DISTANCE,
+            min_votes=None):
+    # type: (float, float, int, str, str, int, str, BoundingBox, str, int) -> Tuple[Union[None, str], List[Dict]]
+    """
+    Returns the cursor for the next page and the hits of this page, containing MAP_ITEM_FIELDS in `_source`.
+
+    Cursors are opaque strings containing the sort values of the last hit of the previous page, which are passed to
+    elasticsearch as `search_after`. This way every page costs the same and there is no limit on the amount of
+    results. Numeric cursors are offsets that were returned by previous versions, those are still paged with `from`.
+    """
+    routing = _get_search_routing(app_id)
+    qry = _get_items_query(lat, lon, distance, status, limit, routing, bbox, sort, min_votes)
+
+    if cursor and cursor.isdigit():
+        return _search_with_offset(qry, long(cursor), limit, routing)
+
+    pit_id = None
+    if cursor:
+        search_after, pit_id = _decode_cursor(cursor)
+        if not search_after:
+            return None, []
+        qry['search_after'] = search_after
+    elif SEARCH_POINT_IN_TIME:
+        pit_id = _open_point_in_time(routing)
+    qry['track_total_hits'] = False
+
+    if pit_id:
+        # The index must not be specified when searching a point in time
+        qry['pit'] = {'id': pit_id, 'keep_alive': SEARCH_PIT_KEEP_ALIVE}
+        path = '/_search'
+    else:
+        path = _get_search_path(routing)
+    result_data = _request(path, urlfetch.POST, qry, deadline=10, hedge=SEARCH_HEDGING)
+    hits = result_data['hits']['hits']
+
+    new_cursor = None
+    if len(hits) == limit:
+        new_cursor = _encode_cursor(hits[-1]['sort'], result_data.get('pit_id', pit_id))
+    return new_cursor, hits
+
+
+def _get_items_query(lat, lon, distance, status, limit, routing, bbox=None, sort=MapItemsSort.DISTANCE,
+                     min_votes=None):
+    # type: (float, float, int, str, int, str, BoundingBox, str, int) -> dict
+    sort_fields = [{
+        # tiebreaker for incidents at the same distance
+        get_id_sort_field(get_reports_index()): {
+            'order': 'asc',
+            'unmapped_type': 'keyword'
+        }
+    }]
+    if sort != MapItemsSort.NONE:
+        sort_fields.insert(0, {
             '_geo_distance': {
                 'location': {
                     'lat': lat,
@@ -208,16 +905,34 @@ def _search(lat, lon, distance, status, cursor, limit):
                 'order': 'asc',
                 'unit': 'm'
             }
-        }]
-    }
-    if status:
-        qry['query']['bool']['filter'].append({
-            'term': {
-                'status': status
+        })
+    if sort == MapItemsSort.VOTES:
+        sort_fields.insert(0, {
+            'negative_votes': {
+                'order': 'desc',
+                'missing': 0,
+                'unmapped_type': 'integer'
             }
         })
-    path = '/%s/_search' % get_reports_index()
-    result_data = _request(path, urlfetch.POST, qry)
+    return {
+        'size': limit,
+        '_source': MAP_ITEM_FIELDS,
+        'query': _get_search_query(lat, lon, distance, status, routing, bbox=bbox, min_votes=min_votes),
+        'sort': sort_fields
+    }
+
+
+def _search_with_offset(qry, start_offset, limit, routing=None):
+    # type: (dict, long, int, str) -> Tuple[Union[None, str], List[Dict]]
+    # we can only fetch up to 10000 items with from param
+    if (start_offset + limit) > 10000:
+        limit = 10000 - start_offset
+    if limit <= 0:
+        return None, []
+    qry['size'] = limit
+    qry['from'] = start_offset
+    path = _get_search_path(routing)
+    result_data = _request(path, urlfetch.POST, qry, deadline=10, hedge=SEARCH_HEDGING)
 
     new_cursor = None
     next_offset = start_offset + len(result_data['hits']['hits'])
@@ -225,4 +940,139 @@ def _search(lat, lon, distance, status, cursor, limit):
         if result_data['hits']['total']['value'] > next_offset and next_offset < 10000:
             new_cursor = u'%s' % next_offset
 
-    return new_cursor, [hit['_id'] for hit in result_data['hits']['hits']]
+    return new_cursor, result_data['hits']['hits']
+
+
+def _get_geohash_field(precision):
+    return 'geohash_%d' % precision
+
+
+def should_cluster(distance):
+    # type: (int) -> bool
+    return distance >= CLUSTER_MIN_DISTANCE
+
+
+def get_cluster_precision(distance):
+    # type: (int) -> int
+    # Most precise level where the cells are still large enough to only have a handful of them on the screen
+    min_cell_width = 2 * distance / CLUSTER_CELLS_PER_DIAMETER
+    for precision in reversed(CLUSTER_PRECISIONS):
+        if geohash.CELL_WIDTH[precision] >= min_cell_width:
+            return precision
+    return CLUSTER_PRECISIONS[0]
+
+
+def search_clusters(lat, lon, distance, status, app_id=None, bbox=None, min_votes=None):
+    # type: (float, float, int, str, str, BoundingBox, int) -> Tuple[List[MapItemTO], List[MapClusterTO]]
+    """
+    Groups all incidents in the area per geohash cell, using the precomputed geohash fields of the documents.
+    Cells that contain only one incident are returned as a normal item.
+    """
+    routing = _get_search_routing(app_id)
+    qry = _get_clusters_query(lat, lon, distance, status, routing, bbox, min_votes)
+    path = _get_search_path(routing)
+    result_data = _request(path, urlfetch.POST, qry, deadline=10, hedge=SEARCH_HEDGING)
+    single_hits, clusters = _parse_clusters_result(result_data)
+    return _convert_hits_to_item_tos(single_hits), clusters
+
+
+def _get_clusters_query(lat, lon, distance, status, routing, bbox=None, min_votes=None):
+    # type: (float, float, int, str, str, BoundingBox, int) -> dict
+    precision = get_cluster_precision(distance)
+    return {
+        'size': 0,
+        'query': _get_search_query(lat, lon, distance, status, routing, bbox=bbox, min_votes=min_votes),
+        'aggs': {
+            'cells': {
+                'terms': {
+                    'field': _get_geohash_field(precision),
+                    'size': MAX_CLUSTERS
+                },
+                'aggs': {
+                    'centroid': {
+                        'geo_centroid': {
+                            'field': 'location'
+                        }
+                    },
+                    'statuses': {
+                        'terms': {
+                            'field': 'status'
+                        }
+                    },
+                    'item': {
+                        'top_hits': {
+                            'size': 1,
+                            '_source': MAP_ITEM_FIELDS
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def _parse_clusters_result(result_data):
+    # type: (dict) -> Tuple[List[Dict], List[MapClusterTO]]
+    # Returns the hits of the cells with only one incident and the clusters
+    single_hits = []
+    clusters = []
+    for bucket in result_data['aggregations']['cells']['buckets']:
+        if bucket['doc_count'] == 1:
+            single_hits.extend(bucket['item']['hits']['hits'])
+            continue
+        centroid = bucket['centroid']['location']
+        clusters.append(MapClusterTO(id=bucket['key'],
+                                     coords=GeoPointTO(lat=centroid['lat'], lon=centroid['lon']),
+                                     count=bucket['doc_count'],
+                                     statuses=[MapClusterStatusTO(status=status_bucket['key'],
+                                                                  count=status_bucket['doc_count'])
+                                               for status_bucket in bucket['statuses']['buckets']]))
+    return single_hits, clusters
+
+
+# First page of a search in multi_search. With cluster=True, `limit` and `sort` are ignored.
+MapSearch = namedtuple('MapSearch', ['lat', 'lon', 'distance', 'status', 'limit', 'bbox', 'sort', 'min_votes',
+                                     'cluster'])
+
+
+def multi_search(searches, app_id=None):
+    # type: (List[MapSearch], str) -> List[Tuple[List[MapItemTO], Union[None, str, List[MapClusterTO]]]]
+    """
+    Executes several searches in one _msearch request. Returns (items, cursor) for every item search and
+    (items, clusters) for every cluster search, in the same order as `searches`.
+    The next pages can be fetched with search_current. Those cursors don't use a point in time.
+    """
+    if not searches:
+        return []
+    routing = _get_search_routing(app_id)
+    header = {'index': get_reports_index()}
+    if routing:
+        header['routing'] = routing
+    lines = []
+    for search in searches:
+        if search.cluster:
+            qry = _get_clusters_query(search.lat, search.lon, search.distance, search.status, routing, search.bbox,
+                                      search.min_votes)
+        else:
+            qry = _get_items_query(search.lat, search.lon, search.distance, search.status, search.limit, routing,
+                                   search.bbox, search.sort, search.min_votes)
+            qry['track_total_hits'] = False
+        lines.append(json.dumps(header))
+        lines.append(json.dumps(qry))
+    payload = '\n'.join(lines) + '\n'
+    result_data = _request('/_msearch', urlfetch.POST, payload, deadline=10, hedge=SEARCH_HEDGING)
+
+    hit_lists = []
+    others = []
+    for search, response in zip(searches, result_data['responses']):
+        if 'error' in response:
+            raise ElasticsearchException(response.get('status', httplib.INTERNAL_SERVER_ERROR),
+                                         json.dumps(response['error']))
+        if search.cluster:
+            hits, clusters = _parse_clusters_result(response)
+            others.append(clusters)
+        else:
+            hits = response['hits']['hits']
+            others.append(_encode_cursor(hits[-1]['sort']) if len(hits) == search.limit else None)
+        hit_lists.append(hits)
+    return zip(_convert_hit_lists_to_item_tos(hit_lists), others)
@@ -37,17 +37,18 @@ def is_file_available(filepath):
         return False
 
 
-def upload_to_gcs(file_data, content_type, file_name):
+def upload_to_gcs(file_data, content_type, file_name, options=None):
     """
     Args:
         file_data (str or file-like object)
         content_type (unicode)
         file_name (unicode)
+        options (dict): extra headers, e.g. {'cache-control': 'public, max-age=300', 'x-goog-acl': 'public-read'}
     Returns:
         blob_key (unicode): An encrypted `BlobKey` string.
     """
     # this can fail on the devserver for some reason
-    with cloudstorage.open(file_name, 'w', content_type=content_type) as f:
+    with cloudstorage.open(file_name, 'w', content_type=content_type, options=options) as f:
         if isinstance(file_data, basestring):
             f.write(file_data)
         else:
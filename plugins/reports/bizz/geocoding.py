@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Reverse geocoding of incident locations. Many incidents are reported around the same streets, so locations are rounded
+to `geocoding_precision` decimals and the address of every rounded location is cached per instance, in memcache and in
+the datastore for RESULT_LIFETIME.
+
+Requests to the geocoding api are limited per app to `geocoding_rate_limit` per minute and `geocoding_daily_quota` per
+day. When a limit is reached or the api fails, no address is returned.
+"""
+import abc
+import json
+import logging
+import time
+import urllib
+from datetime import datetime, timedelta
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from framework.plugin_loader import get_config
+from plugins.reports.consts import NAMESPACE
+from plugins.reports.models import GeocodedAddress
+from plugins.reports.to import ReportsPluginConfiguration
+from plugins.reports.utils.local_cache import LocalCache
+from typing import Dict, Tuple
+
+RESULT_LIFETIME = timedelta(days=90)
+MEMCACHE_LIFETIME = 24 * 3600  # seconds
+LOCAL_CACHE_LIFETIME = 3600  # seconds
+LOCAL_CACHE_SIZE = 1000
+GEOCODING_DEADLINE = 10  # seconds
+
+
+class Geocoder(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def reverse_geocode_async(self, lat, lon):
+        # type: (float, float) -> ndb.Future
+        """Returns a future with the address, an empty string when there is no address at this location"""
+        pass
+
+
+class GoogleGeocoder(Geocoder):
+
+    @ndb.tasklet
+    def reverse_geocode_async(self, lat, lon):
+        url = 'https://maps.googleapis.com/maps/api/geocode/json?'
+        maps_key = get_config(NAMESPACE).google_maps_key
+        params = urllib.urlencode({'latlng': '%s,%s' % (lat, lon), 'key': maps_key})
+        response = yield ndb.get_context().urlfetch(url + params, deadline=GEOCODING_DEADLINE)
+        result = json.loads(response.content)
+        status = result['status']
+        if status == 'ZERO_RESULTS':
+            raise ndb.Return('')
+        elif status != 'OK':
+            logging.debug(response.content)
+            raise GeocodingException(status)
+        raise ndb.Return(result.get('results', [{}])[0].get('formatted_address') or '')
+
+
+class FakeGeocoder(Geocoder):
+    """Returns fixed addresses without calling any api, e.g. for tests: set_geocoder(FakeGeocoder({...}))"""
+
+    def __init__(self, addresses=None):
+        # type: (Dict[Tuple[float, float], str]) -> None
+        self.addresses = addresses or {}
+        self.requests = []
+
+    @ndb.tasklet
+    def reverse_geocode_async(self, lat, lon):
+        self.requests.append((lat, lon))
+        raise ndb.Return(self.addresses.get((lat, lon), ''))
+
+
+class GeocodingException(Exception):
+    pass
+
+
+_geocoder = GoogleGeocoder()  # type: Geocoder
+_local_cache = LocalCache(LOCAL_CACHE_SIZE)
+
+
+def set_geocoder(geocoder):
+    # type: (Geocoder) -> None
+    global _geocoder, _local_cache
+    _geocoder = geocoder
+    _local_cache = LocalCache(LOCAL_CACHE_SIZE)
+
+
+def _round_location(lat, lon, precision):
+    # type: (float, float, int) -> Tuple[float, float]
+    return round(lat, precision), round(lon, precision)
+
+
+def reverse_geocode_async(lat, lon, app_id):
+    # type: (float, float, str) -> ndb.Future
+    """Returns a future with the address near this location, or None when it couldn't be found"""
+    return _reverse_geocode_async(lat, lon, app_id, get_config(NAMESPACE))
+
+
+@ndb.tasklet
+def _reverse_geocode_async(lat, lon, app_id, config):
+    # type: (float, float, str, ReportsPluginConfiguration) -> ndb.Future
+    lat, lon = _round_location(lat, lon, config.geocoding_precision)
+    location = '%s,%s' % (lat, lon)
+    address = _local_cache.get(location)
+    if address is not None:
+        raise ndb.Return(address or None)
+    context = ndb.get_context()
+    memcache_key = 'geocoded-address-%s' % location
+    address = yield context.memcache_get(memcache_key, namespace=NAMESPACE)
+    if address is None:
+        key = GeocodedAddress.create_key(location)
+        cached_address = yield key.get_async(use_cache=False, use_memcache=False)  # type: GeocodedAddress
+        if cached_address and cached_address.expires > datetime.utcnow():
+            address = cached_address.address or ''
+        else:
+            address = yield _geocode_async(lat, lon, app_id, config)
+            if address is None:
+                raise ndb.Return(None)
+            yield GeocodedAddress(key=key, address=address, expires=datetime.utcnow() + RESULT_LIFETIME).put_async()
+        yield context.memcache_set(memcache_key, address, time=MEMCACHE_LIFETIME, namespace=NAMESPACE)
+    _local_cache.set(location, address, LOCAL_CACHE_LIFETIME)
+    raise ndb.Return(address or None)
+
+
+@ndb.tasklet
+def _geocode_async(lat, lon, app_id, config):
+    is_allowed = yield _check_limits_async(app_id, config)
+    if not is_allowed:
+        raise ndb.Return(None)
+    try:
+        address = yield _geocoder.reverse_geocode_async(lat, lon)
+    except (urlfetch.Error, GeocodingException, ValueError) as e:
+        # ValueError: not a json response, e.g. an html error page
+        logging.warning('Reverse geocoding of %s,%s failed: %s', lat, lon, e)
+        raise ndb.Return(None)
+    raise ndb.Return(address)
+
+
+@ndb.tasklet
+def _check_limits_async(app_id, config):
+    now = int(time.time())
+    context = ndb.get_context()
+    # Counters per period, old periods are evicted from memcache eventually
+    day_count, minute_count = yield (
+        context.memcache_incr('geocoding-day-%s-%d' % (app_id, now // 86400), initial_value=0, namespace=NAMESPACE),
+        context.memcache_incr('geocoding-minute-%s-%d' % (app_id, now // 60), initial_value=0, namespace=NAMESPACE))
+    if day_count > config.geocoding_daily_quota:
+        logging.warning('Daily reverse geocoding quota of %s reached for app %s', config.geocoding_daily_quota, app_id)
+        raise ndb.Return(False)
+    if minute_count > config.geocoding_rate_limit:
+        logging.warning('Reverse geocoding rate limit of %s per minute reached for app %s', config.geocoding_rate_limit,
+                        app_id)
+        raise ndb.Return(False)
+    raise ndb.Return(True)
+
+
+def cleanup_expired_addresses():
+    run_job(_expired_addresses_query, [], _delete_addresses, [], mode=MODE_BATCH, batch_size=500)
+
+
+def _expired_addresses_query():
+    return GeocodedAddress.list_expired(datetime.utcnow())
+
+
+def _delete_addresses(keys):
+    ndb.delete_multi(keys)
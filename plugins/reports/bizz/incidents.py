@@ -15,13 +15,14 @@
 #
 # @@license_version:1.5@@
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
-from uuid import uuid4
+from uuid import uuid4, uuid5, UUID
 
 from dateutil.parser import parse as parse_date
-from google.appengine.ext import ndb
-from typing import List, Tuple
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb, deferred
+from typing import List, Tuple, Callable
 
 from plugins.reports.integrations.int_topdesk.models import TOPDeskFormConfiguration
 from plugins.reports.integrations.int_topdesk.topdesk import create_topdesk_incident_from_form
@@ -29,13 +30,13 @@ from framework.bizz.job import run_job, MODE_BATCH
 from framework.utils import try_or_defer
 from mcfw.exceptions import HttpBadRequestException
 from mcfw.rpc import parse_complex_value
-from plugins.reports.bizz.elasticsearch import re_index_incidents, re_index_incident
-from plugins.reports.dal import save_rogerthat_user, get_rogerthat_user, get_integration_settings
+from plugins.reports.bizz.indexer import save_incident, save_incidents
+from plugins.reports.dal import save_rogerthat_user, get_rogerthat_user, get_integration_settings, get_form_integration
 from plugins.reports.integrations.int_3p import create_incident as create_3p_incident
 from plugins.reports.integrations.int_green_valley.green_valley import create_incident as create_gv_incident
 from plugins.reports.integrations.int_topdesk.msgflow import create_incident as create_topdesk_incident
 from plugins.reports.models import Incident, IntegrationProvider, IncidentParamsFlow, IncidentParamsForm, \
-    FormIntegration, GreenValleyFormConfiguration, IncidentStatus
+    GreenValleyFormConfiguration, IncidentStatus, IncidentCreation, IncidentCreationStep
 from plugins.reports.to import FormSubmittedCallback
 from plugins.rogerthat_api.to.messaging.flow import FLOW_STEP_TO
 
@@ -54,13 +55,28 @@ def cleanup_timed_out_worker(incident_keys):
     for incident in incidents:
         incident.visible = False
         incident.cleanup_date = None
-    re_index_incidents(incidents)
-    ndb.put_multi(incidents)
+    save_incidents(incidents)
+
+
+_INCIDENT_ID_NAMESPACE = UUID('0c1f6ad2-8f4e-4a7b-9d39-54a3e6b1c0de')
+# Time an attempt to create an incident has before another attempt may take over
+CREATION_LEASE = timedelta(minutes=5)
+
+
+class IncidentCreationInProgressException(Exception):
+    pass
+
+
+def get_incident_id(*idempotency_key):
+    # type: (*unicode) -> str
+    """Every attempt to create the incident of the same message flow or form submission uses the same id"""
+    name = u':'.join(unicode(part) for part in idempotency_key)
+    return str(uuid5(_INCIDENT_ID_NAMESPACE, name.encode('utf-8')))
 
 
 def process_incident(integration_id, user_details, parent_message_key, steps, timestamp):
     rt_user = save_rogerthat_user(user_details[0])
-    incident_id = str(uuid4())
+    incident_id = get_incident_id(u'flow', parent_message_key) if parent_message_key else str(uuid4())
     try_or_defer(_create_incident, incident_id, integration_id, rt_user.user_id, parent_message_key, timestamp, steps)
 
 
@@ -86,15 +102,113 @@ def _create_incident(incident_id, integration_id, user_id, parent_message_key, t
     params.steps = parsed_steps
     incident.params = params
 
-    if settings.integration == IntegrationProvider.TOPDESK:
-        create_topdesk_incident(settings, rt_user, incident, parsed_steps)
-    elif settings.integration == IntegrationProvider.THREE_P:
-        create_3p_incident(settings, rt_user, incident, parsed_steps)
+    def create():
+        if settings.integration == IntegrationProvider.TOPDESK:
+            create_topdesk_incident(settings, rt_user, incident, parsed_steps)
+        elif settings.integration == IntegrationProvider.THREE_P:
+            create_3p_incident(settings, rt_user, incident, parsed_steps)
+        else:
+            raise Exception('Unknown integration: %s' % settings.integration)
+        return True
+
+    try:
+        _create_incident_once(incident, create)
+    except IncidentCreationInProgressException as e:
+        # Duplicate delivery of the same message flow. Check again once the lease expired, in case that attempt died.
+        logging.info('%s, checking again in %s', e, CREATION_LEASE)
+        deferred.defer(_create_incident, incident_id, integration_id, user_id, parent_message_key, timestamp, steps,
+                       _countdown=CREATION_LEASE.total_seconds())
+
+
+def _create_incident_once(incident, create_func):
+    # type: (Incident, Callable[[], bool]) -> Incident
+    """
+    Creates the incident at its integration with create_func and saves it. Steps that were completed by a previous
+    attempt with the same incident id are skipped. Returns None when create_func didn't create the incident.
+    """
+    creation = _start_incident_creation(incident.id)
+    if not creation:
+        logging.info('Incident %s was already created', incident.id)
+        return Incident.create_key(incident.id).get()
+    lease_token = creation.lease_token
+    if creation.step == IncidentCreationStep.INTEGRATION_DONE:
+        logging.info('Incident %s was already created at its integration, only saving it', incident.id)
+        incident = ndb.model_from_protobuf(entity_pb.EntityProto(creation.incident))
     else:
-        raise Exception('Unknown integration: %s' % settings.integration)
+        try:
+            created = create_func()
+        except Exception:
+            # Let the next attempt retry immediately
+            _release_incident_creation(creation.key, lease_token)
+            raise
+        if not created:
+            _cancel_incident_creation(creation.key, lease_token)
+            return None
+        _save_incident_creation_step(creation.key, lease_token, IncidentCreationStep.INTEGRATION_DONE, incident)
     incident.visible = incident.can_show_on_map
-    incident.put()
-    try_or_defer(re_index_incident, incident)
+    _finish_incident_creation(creation.key, lease_token, incident)
+    return incident
+
+
+def _get_leased_creation(creation_key, lease_token):
+    # type: (ndb.Key, str) -> IncidentCreation
+    # When the lease expired during a slow step, another attempt might have taken over. Only that attempt may continue.
+    creation = creation_key.get()  # type: IncidentCreation
+    if not creation or creation.lease_token != lease_token:
+        raise IncidentCreationInProgressException('Incident %s was taken over by another request' % creation_key.id())
+    return creation
+
+
+@ndb.transactional()
+def _start_incident_creation(incident_id):
+    # type: (str) -> IncidentCreation
+    creation_key = IncidentCreation.create_key(incident_id)
+    incident, creation = ndb.get_multi([creation_key.parent(), creation_key])  # type: Incident, IncidentCreation
+    if incident:
+        return None
+    now = datetime.utcnow()
+    if not creation:
+        creation = IncidentCreation(key=creation_key, step=IncidentCreationStep.STARTED)
+    elif creation.lease_expiration and creation.lease_expiration > now:
+        raise IncidentCreationInProgressException('Incident %s is being created by another request' % incident_id)
+    creation.lease_expiration = now + CREATION_LEASE
+    creation.lease_token = str(uuid4())
+    creation.put()
+    return creation
+
+
+@ndb.transactional()
+def _save_incident_creation_step(creation_key, lease_token, step, incident):
+    # type: (ndb.Key, str, str, Incident) -> None
+    creation = _get_leased_creation(creation_key, lease_token)
+    creation.step = step
+    creation.incident = ndb.model_to_protobuf(incident).Encode()
+    creation.put()
+
+
+@ndb.transactional()
+def _release_incident_creation(creation_key, lease_token):
+    # type: (ndb.Key, str) -> None
+    creation = creation_key.get()  # type: IncidentCreation
+    if creation and creation.lease_token == lease_token:
+        creation.lease_expiration = None
+        creation.put()
+
+
+@ndb.transactional()
+def _cancel_incident_creation(creation_key, lease_token):
+    # type: (ndb.Key, str) -> None
+    creation = creation_key.get()  # type: IncidentCreation
+    if creation and creation.lease_token == lease_token:
+        creation_key.delete()
+
+
+@ndb.transactional(xg=True)
+def _finish_incident_creation(creation_key, lease_token, incident):
+    # type: (ndb.Key, str, Incident) -> None
+    _get_leased_creation(creation_key, lease_token)
+    save_incident(incident)
+    creation_key.delete()
 
 
 def list_incidents(integration_id, page_size, status, cursor=None):
@@ -106,11 +220,11 @@ def create_incident_from_form(integration_id, data):
     # type: (int, FormSubmittedCallback) -> str
     rt_user = save_rogerthat_user(data.user_details)
     settings = get_integration_settings(integration_id)
-    form_configuration = FormIntegration.create_key(data.form.id).get()  # type: FormIntegration
+    form_configuration = get_form_integration(data.form.id)
     if not settings:
         raise HttpBadRequestException('Could not find integration settings for %s' % integration_id)
     date = parse_date(data.submission.submitted_date).replace(tzinfo=None)
-    incident = Incident(key=Incident.create_key(str(uuid4())))
+    incident = Incident(key=Incident.create_key(get_incident_id(u'form', integration_id, data.submission.id)))
     incident.set_status(IncidentStatus.NEW, date)
     incident.integration_id = integration_id
     incident.user_id = rt_user.user_id
@@ -121,17 +235,18 @@ def create_incident_from_form(integration_id, data):
     params.submission_id = data.submission.id
     incident.params = params
 
-    integration = get_integration_settings(integration_id)
     if isinstance(form_configuration.config, GreenValleyFormConfiguration):
-        created = create_gv_incident(integration.data, form_configuration.config, data.submission, data.form, incident)
+        create = lambda: create_gv_incident(settings.data, form_configuration.config, data.submission, data.form,
+                                            incident)
     elif isinstance(form_configuration.config, TOPDeskFormConfiguration):
-        created = create_topdesk_incident_from_form(integration, form_configuration.config, data.submission,
-                                                    data.form, incident, rt_user)
+        create = lambda: create_topdesk_incident_from_form(settings, form_configuration.config, data.submission,
+                                                           data.form, incident, rt_user)
     else:
         raise HttpBadRequestException()
-    if created:
-        incident.visible = incident.can_show_on_map
-        incident.put()
-        try_or_defer(re_index_incident, incident)
+    try:
+        created_incident = _create_incident_once(incident, create)
+    except IncidentCreationInProgressException as e:
+        # Duplicate delivery of the same submission, the other request creates the incident with the same id
+        logging.info(e)
         return incident.id
-    return None
+    return created_incident and created_incident.id
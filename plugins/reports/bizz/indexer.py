@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+import logging
+import time
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb, deferred
+
+from plugins.reports.bizz import get_incident_votes
+from plugins.reports.bizz.elasticsearch import execute_bulk_request, index_incident_operations, \
+    deleted_incident_operations, vote_update_operations
+from plugins.reports.bizz.search_cache import invalidate_search_cache
+from plugins.reports.consts import INDEXER_QUEUE, VOTES_INDEX_QUEUE
+from plugins.reports.models import Incident, IncidentIndexRequest
+from typing import List
+
+# Changes are collected for this many seconds before they are sent to elasticsearch
+FLUSH_INTERVAL = 10
+# Max amount of incidents per _bulk request
+FLUSH_BATCH_SIZE = 200
+VOTES_LEASE_SECONDS = 60
+
+
+def save_incident(incident):
+    # type: (Incident) -> None
+    save_incidents([incident])
+
+
+@ndb.transactional(xg=True)
+def save_incidents(incidents):
+    # type: (List[Incident]) -> None
+    """
+    Saves the incidents and marks them to be (re-)indexed, can also be used inside an existing transaction.
+    The search index is updated in batches by flush_index_requests, never in the transaction itself.
+    """
+    requests = [IncidentIndexRequest(key=IncidentIndexRequest.create_key(incident.id)) for incident in incidents]
+    ndb.put_multi(incidents + requests)
+    ndb.get_context().call_on_commit(schedule_index_flush)
+
+
+def mark_votes_changed(incident_id):
+    # type: (unicode) -> None
+    """
+    Updates the vote counts in the search index with the next flush. This doesn't write to the datastore, so voting
+    doesn't contend on the incident's entity group.
+    """
+    taskqueue.Queue(VOTES_INDEX_QUEUE).add(taskqueue.Task(payload=incident_id.encode('utf-8'), method='PULL'))
+    schedule_index_flush()
+
+
+def schedule_index_flush():
+    # One task per FLUSH_INTERVAL, all changes made in the mean time are sent together
+    bucket = int(time.time() / FLUSH_INTERVAL)
+    task_name = 'index-flush-%d' % bucket
+    if not memcache.add(task_name, 1, time=FLUSH_INTERVAL * 2, namespace=IncidentIndexRequest.NAMESPACE):
+        return
+    countdown = (bucket + 1) * FLUSH_INTERVAL - time.time()
+    try:
+        deferred.defer(flush_index_requests, _name=task_name, _countdown=countdown, _queue=INDEXER_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def flush_index_requests():
+    """
+    Sends all pending changes to the search index, one _bulk request per FLUSH_BATCH_SIZE incidents.
+    Multiple changes to the same incident only result in one document update since there's only one
+    IncidentIndexRequest per incident. Also executed by a cron job in case scheduling the task failed.
+    """
+    _flush_incidents()
+    _flush_votes()
+
+
+def _flush_incidents():
+    while True:
+        requests = IncidentIndexRequest.list_pending().fetch(FLUSH_BATCH_SIZE)  # type: List[IncidentIndexRequest]
+        if not requests:
+            return
+        incidents = ndb.get_multi([request.incident_key for request in requests])  # type: List[Incident]
+        votes = get_incident_votes([incident.id for incident in incidents if incident])
+        operations = []
+        deleted_ids = []
+        for request, incident in zip(requests, incidents):
+            if incident:
+                operations.extend(index_incident_operations(incident, votes[incident.id]))
+            else:
+                deleted_ids.append(request.incident_key.id().decode('utf-8'))
+        operations.extend(deleted_incident_operations(deleted_ids))
+        results = execute_bulk_request(operations, wait_for_refresh=True)
+        invalidate_search_cache(incidents)
+        # Rejected items stay pending and are retried on the next flush, permanent failures have been dead-lettered
+        rejected_ids = {result.doc_id for result in results if result.retryable}
+        processed = [request for request in requests if request.incident_key.id().decode('utf-8') not in rejected_ids]
+        ndb.Future.wait_all([_remove_index_request(request.key, request.updated) for request in processed])
+        logging.info('Indexed %d incidents', len(processed))
+        if rejected_ids:
+            logging.warning('%d incidents were not indexed, retrying later', len(rejected_ids))
+            return
+        if len(requests) < FLUSH_BATCH_SIZE:
+            return
+
+
+def _flush_votes():
+    # Partial updates of the vote counts, multiple votes on the same incident result in one update
+    queue = taskqueue.Queue(VOTES_INDEX_QUEUE)
+    while True:
+        tasks = queue.lease_tasks(VOTES_LEASE_SECONDS, FLUSH_BATCH_SIZE)
+        if not tasks:
+            return
+        incident_ids = list({task.payload.decode('utf-8') for task in tasks})
+        incidents = [incident for incident in ndb.get_multi([Incident.create_key(incident_id)
+                                                             for incident_id in incident_ids]) if incident]
+        votes = get_incident_votes([incident.id for incident in incidents])
+        operations = []
+        for incident in incidents:
+            operations.extend(vote_update_operations(incident, votes[incident.id]))
+        results = execute_bulk_request(operations, wait_for_refresh=True)
+        invalidate_search_cache(incidents)
+        # Rejected updates are retried once their lease expires
+        rejected_ids = {result.doc_id for result in results if result.retryable}
+        queue.delete_tasks([task for task in tasks if task.payload.decode('utf-8') not in rejected_ids])
+        logging.info('Updated the votes of %d incidents', len(incidents) - len(rejected_ids))
+        if rejected_ids:
+            logging.warning('The votes of %d incidents were not updated, retrying later', len(rejected_ids))
+            return
+        if len(tasks) < FLUSH_BATCH_SIZE:
+            return
+
+
+@ndb.transactional_tasklet
+def _remove_index_request(key, updated):
+    # Keep the request when the incident was changed again while it was being indexed
+    request = yield key.get_async()
+    if request and request.updated == updated:
+        yield key.delete_async()
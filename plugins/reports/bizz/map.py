@@ -16,18 +16,35 @@
 # @@license_version:1.5@@
 
 import logging
+import math
+from collections import namedtuple
 from datetime import date
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from typing import List
+from typing import List, Tuple
 
-from plugins.reports.bizz import update_incident_vote, get_vote_options, convert_to_item_details_to
-from plugins.reports.bizz.elasticsearch import search_current
-from plugins.reports.models import Incident, UserIncidentVote, IncidentStatus, ReportsFilter, IncidentVote, \
-    IncidentStatisticsYear, UserIncidentAnnouncement
+from plugins.reports.bizz import update_incident_vote, get_vote_options, convert_to_item_details_to, \
+    get_incident_votes, get_resolved_count
+from plugins.reports.bizz.announcements import mark_announcement_seen
+from plugins.reports.bizz.elasticsearch import should_cluster, get_sync_token, sync_items, MapSearch
+from plugins.reports.bizz.indexer import mark_votes_changed
+from plugins.reports.bizz.map_snapshots import get_map_snapshot_url
+from plugins.reports.bizz.search import search_map_items, search_map_clusters, search_map_multi
+from plugins.reports.bizz.search_cache import cached_search
+from plugins.reports.consts import NAMESPACE, MapItemsSort
+from plugins.reports.models import Incident, UserIncidentVote, IncidentStatus, ReportsFilter, IncidentVote
 from plugins.reports.to import GetMapItemsResponseTO, GetMapItemDetailsResponseTO, SaveMapItemVoteResponseTO, \
-    TextSectionTO, TextAnnouncementTO
-from plugins.reports.utils import get_app_id_from_user_id
+    TextSectionTO, TextAnnouncementTO, MapItemDetailsTO, VoteSectionTO, GetMapItemsSyncResponseTO, MapItemsCompactTO, \
+    MapItemTO, GetMapBatchResponseTO
+from plugins.reports.utils import get_app_id_from_user_id, codec
+from plugins.reports.utils.geo import BoundingBox, get_distance
+
+DETAILS_CACHE_LIFETIME = 24 * 3600  # seconds
+COMPACT_COORDS_PRECISION = 6  # decimals, about 10cm
+
+MapItemsQuery = namedtuple('MapItemsQuery', ['lat', 'lon', 'distance', 'status', 'limit', 'cluster', 'bbox', 'sort',
+                                             'min_votes'])
 
 
 def convert_filter_to_status(filter_value):
@@ -43,40 +60,157 @@ def convert_filter_to_status(filter_value):
 
 def get_report_map_announcement(user_id):
     today = date.today()
-    user_incident_announcement_key = UserIncidentAnnouncement.create_key(user_id, today.year, today.month)
-    if user_incident_announcement_key.get():
-        return None
-
-    UserIncidentAnnouncement(key=user_incident_announcement_key).put()
-
     app_id = get_app_id_from_user_id(user_id)
-    s = IncidentStatisticsYear.create_key(app_id, today.year).get()
-    if not s:
+    resolved_count = get_resolved_count(app_id, today.year)
+    if resolved_count < 2:
         return None
-    if s.resolved_count < 2:
+    if not mark_announcement_seen(user_id, today.year, today.month):
         return None
     # todo translate
     return TextAnnouncementTO(title=u'Opgeloste meldingen',
-                              description=u'Dit jaar zijn er al %s meldingen opgelost.' % s.resolved_count)
+                              description=u'Dit jaar zijn er al %s meldingen opgelost.' % resolved_count)
 
 
-def get_report_map_items(user_id, lat, lon, distance, status, limit, cursor):
-    # type: (str, float, float, int, str, int, str) -> GetMapItemsResponseTO
-    if lat and lon and distance and status and limit:
-        if limit > 1000:
-            limit = 1000
-    else:
-        logging.debug('not all parameters where provided')
+def get_report_map_snapshot_url(user_id):
+    # type: (str) -> unicode
+    return get_map_snapshot_url(get_app_id_from_user_id(user_id))
+
+
+def get_report_map_items(user_id, lat, lon, distance, status, limit, cursor, cluster=False, bbox=None,
+                         sort=MapItemsSort.DISTANCE, min_votes=None, compact=False):
+    # type: (str, float, float, int, str, int, str, bool, BoundingBox, str, int, bool) -> GetMapItemsResponseTO
+    params = _get_search_params(lat, lon, distance, status, limit, bbox)
+    if not params:
         return GetMapItemsResponseTO()
+    lat, lon, distance, limit = params
     status = convert_filter_to_status(status)
-    items, new_cursor = search_current(lat, lon, distance, status, cursor, limit)
+    app_id = get_app_id_from_user_id(user_id) if user_id else None
+    use_clusters = cluster and not cursor and should_cluster(distance)
+
+    def search(search_lat, search_lon, search_distance, search_bbox):
+        if use_clusters:
+            # Wide area: one aggregation instead of (up to) 1000 separate items
+            items, clusters = search_map_clusters(search_lat, search_lon, search_distance, status, app_id,
+                                                  search_bbox, min_votes)
+            return GetMapItemsResponseTO(items=items, clusters=clusters)
+        items, new_cursor = search_map_items(search_lat, search_lon, search_distance, status, cursor, limit, app_id,
+                                             search_bbox, sort, min_votes)
+        return GetMapItemsResponseTO(cursor=new_cursor, items=items)
+
+    key_args = (status, cursor, limit, app_id, use_clusters, sort, min_votes)
+    result = cached_search(lat, lon, distance, key_args, search, GetMapItemsResponseTO, bbox)
+    # The cached result is shared, don't modify it
+    result = GetMapItemsResponseTO(cursor=result.cursor,
+                                   items=_filter_items(result.items, lat, lon, distance, bbox, sort),
+                                   clusters=result.clusters)
+    return _create_items_response(user_id, result, distance, status, cursor, compact)
+
+
+def _filter_items(items, lat, lon, distance, bbox, sort):
+    # type: (List[MapItemTO], float, float, int, BoundingBox, str) -> List[MapItemTO]
+    # Cached searches cover a slightly larger area around a rounded location, see search_cache.cached_search
+    if bbox:
+        items = [item for item in items if bbox.contains(item.coords.lat, item.coords.lon)]
+    else:
+        items = [item for item in items if get_distance(lat, lon, item.coords.lat, item.coords.lon) <= distance]
+    if sort == MapItemsSort.DISTANCE:
+        items.sort(key=lambda item: (get_distance(lat, lon, item.coords.lat, item.coords.lon), item.id))
+    return items
+
+
+def _get_search_params(lat, lon, distance, status, limit, bbox):
+    # type: (float, float, int, str, int, BoundingBox) -> Tuple[float, float, int, int]
+    if bbox:
+        # Searches within the bounding box, sorted by distance from lat, lon (default: center of the box)
+        if not (lat and lon):
+            lat, lon = bbox.center
+        distance = int(math.ceil(bbox.radius))
+    if not (lat and lon and distance and status and limit):
+        logging.debug('not all parameters where provided')
+        return None
+    return lat, lon, distance, min(limit, 1000)
+
+
+def _create_items_response(user_id, result, distance, status, cursor, compact):
+    # type: (str, GetMapItemsResponseTO, int, str, str, bool) -> GetMapItemsResponseTO
     top_sections = []
     if status == IncidentStatus.RESOLVED and cursor is None:
         top_sections = get_top_sections_resolved(user_id)
-    return GetMapItemsResponseTO(cursor=new_cursor,
-                                 items=items,
+    return GetMapItemsResponseTO(cursor=result.cursor,
+                                 items=[] if compact else result.items,
                                  distance=distance,
-                                 top_sections=top_sections)
+                                 top_sections=top_sections,
+                                 clusters=result.clusters,
+                                 sync_token=get_sync_token() if cursor is None else None,
+                                 compact=encode_compact_items(result.items) if compact else None)
+
+
+def encode_compact_items(items):
+    # type: (List[MapItemTO]) -> MapItemsCompactTO
+    result = MapItemsCompactTO(precision=COMPACT_COORDS_PRECISION, ids=[], lats=[], lons=[], icons=[],
+                               icon_indexes=[], titles=[])
+    factor = 10 ** COMPACT_COORDS_PRECISION
+    icon_indexes = {}
+    previous_lat = previous_lon = 0
+    for item in items:
+        lat = long(round(item.coords.lat * factor))
+        lon = long(round(item.coords.lon * factor))
+        icon_key = (item.icon.id, item.icon.color)
+        if icon_key not in icon_indexes:
+            icon_indexes[icon_key] = len(result.icons)
+            result.icons.append(item.icon)
+        result.ids.append(item.id)
+        result.lats.append(lat - previous_lat)
+        result.lons.append(lon - previous_lon)
+        result.icon_indexes.append(icon_indexes[icon_key])
+        result.titles.append(item.title)
+        previous_lat, previous_lon = lat, lon
+    return result
+
+
+def get_report_map_batch(user_id, queries, announcement, detail_ids, language, compact=False):
+    # type: (str, List[MapItemsQuery], bool, List[unicode], unicode, bool) -> GetMapBatchResponseTO
+    """Everything needed to open the map, with one search request for all queries"""
+    app_id = get_app_id_from_user_id(user_id)
+    searches = {}
+    for i, query in enumerate(queries):
+        params = _get_search_params(query.lat, query.lon, query.distance, query.status, query.limit, query.bbox)
+        if params:
+            lat, lon, distance, limit = params
+            searches[i] = MapSearch(lat, lon, distance, convert_filter_to_status(query.status), limit, query.bbox,
+                                    query.sort, query.min_votes, query.cluster and should_cluster(distance))
+    indexes = sorted(searches)
+    search_results = dict(zip(indexes, search_map_multi([searches[i] for i in indexes], app_id)))
+    results = []
+    for i in xrange(len(queries)):
+        if i not in searches:
+            results.append(GetMapItemsResponseTO())
+            continue
+        search = searches[i]
+        items, cursor_or_clusters = search_results[i]
+        if search.cluster:
+            result = GetMapItemsResponseTO(items=items, clusters=cursor_or_clusters)
+        else:
+            result = GetMapItemsResponseTO(items=items, cursor=cursor_or_clusters)
+        results.append(_create_items_response(user_id, result, search.distance, search.status, None, compact))
+    details = get_reports_map_item_details(user_id, detail_ids, language).items if detail_ids else []
+    return GetMapBatchResponseTO(announcement=get_report_map_announcement(user_id) if announcement else None,
+                                 snapshot_url=get_map_snapshot_url(app_id),
+                                 results=results,
+                                 details=details)
+
+
+def get_report_map_items_sync(user_id, lat, lon, distance, status, limit, sync_token):
+    # type: (str, float, float, int, str, int, str) -> GetMapItemsSyncResponseTO
+    if not (lat and lon and distance and status and limit and sync_token):
+        logging.debug('not all parameters where provided')
+        return GetMapItemsSyncResponseTO(reset=True, sync_token=get_sync_token())
+    limit = min(limit, 1000)
+    status = convert_filter_to_status(status)
+    app_id = get_app_id_from_user_id(user_id) if user_id else None
+    items, removed_ids, new_token, more, reset = sync_items(lat, lon, distance, status, sync_token, limit, app_id)
+    return GetMapItemsSyncResponseTO(items=items, removed_ids=removed_ids, sync_token=new_token, more=more,
+                                     reset=reset)
 
 
 def get_reports_map_item_details(user_id, ids, language):
@@ -84,40 +218,68 @@ def get_reports_map_item_details(user_id, ids, language):
     if not ids or not user_id:
         return GetMapItemDetailsResponseTO()
     incidents = ndb.get_multi([Incident.create_key(uid) for uid in ids])  # type: List[Incident]
-    extra_keys = [IncidentVote.create_key(incident.id) for incident in incidents if incident.can_show_votes] + \
-                 [UserIncidentVote.create_key(user_id, incident.id) for incident in incidents if
-                  incident.can_show_votes]
-    extra_models = ndb.get_multi(extra_keys)
-    vote_mapping = {}
-    user_vote_mapping = {}
-    for model in extra_models:
-        if isinstance(model, IncidentVote):
-            vote_mapping[model.incident_id] = model
-        elif isinstance(model, UserIncidentVote):
-            user_vote_mapping[model.incident_id] = model
-    items = []
-    for incident in incidents:
-        vote = vote_mapping.get(incident.id)
-        if not vote and incident.can_show_votes:
-            vote = IncidentVote(key=IncidentVote.create_key(incident.id))
-        items.append(convert_to_item_details_to(incident, vote, user_vote_mapping.get(incident.id), language))
+    vote_ids = [incident.id for incident in incidents if incident.can_show_votes]
+    user_votes_future = ndb.get_multi_async([UserIncidentVote.create_key(user_id, incident_id)
+                                             for incident_id in vote_ids])
+    vote_mapping = get_incident_votes(vote_ids)
+    user_vote_mapping = {user_vote.incident_id: user_vote
+                         for user_vote in [f.get_result() for f in user_votes_future] if user_vote}
+    items = _get_cached_item_details(incidents, language)
+    for item in items:
+        _set_votes(item, vote_mapping.get(item.id), user_vote_mapping.get(item.id))
     return GetMapItemDetailsResponseTO(items=items)
 
 
+def _get_details_cache_key(incident, language):
+    # type: (Incident, unicode) -> str
+    return 'item-details-%s-%s-%s' % (incident.id, language, incident.version)
+
+
+def _get_cached_item_details(incidents, language):
+    # type: (List[Incident], unicode) -> List[MapItemDetailsTO]
+    """
+    The details without the vote counts and the user's vote are the same for every user, so those are cached per
+    incident version and language. Any change to the incident results in a new version.
+    """
+    keys = [_get_details_cache_key(incident, language) for incident in incidents]
+    cached = memcache.get_multi(keys, namespace=NAMESPACE)
+    items = []
+    to_cache = {}
+    for key, incident in zip(keys, incidents):
+        if key in cached:
+            items.append(codec.parse(MapItemDetailsTO, cached[key], False))
+            continue
+        vote = IncidentVote() if incident.can_show_votes else None
+        item = convert_to_item_details_to(incident, vote, None, language)
+        items.append(item)
+        to_cache[key] = codec.serialize(item, MapItemDetailsTO, False)
+    if to_cache:
+        memcache.set_multi(to_cache, time=DETAILS_CACHE_LIFETIME, namespace=NAMESPACE)
+    return items
+
+
+def _set_votes(item, vote, user_vote):
+    # type: (MapItemDetailsTO, IncidentVote, UserIncidentVote) -> None
+    for section in item.sections:
+        if isinstance(section, VoteSectionTO):
+            for option in section.options:
+                option.count = getattr(vote, '%s_count' % option.id, 0) if vote else 0
+                option.selected = user_vote is not None and user_vote.option_id == option.id
+
+
 def vote_report_item(item_id, user_id, vote_id, option_id, language):
     # type: (unicode, unicode, unicode, unicode, unicode) -> SaveMapItemVoteResponseTO
     vote, user_vote = update_incident_vote(item_id, user_id, vote_id, option_id)
+    mark_votes_changed(item_id)
     options = get_vote_options(vote, user_vote, language)
     return SaveMapItemVoteResponseTO(item_id=item_id, vote_id=vote_id, options=options)
 
 
 def get_top_sections_resolved(user_id):
     app_id = get_app_id_from_user_id(user_id)
-    s = IncidentStatisticsYear.create_key(app_id, date.today().year).get()
-    if not s:
-        return []
-    if s.resolved_count == 0:
+    resolved_count = get_resolved_count(app_id, date.today().year)
+    if resolved_count == 0:
         return []
     # todo translate
     return [TextSectionTO(title=u'Opgeloste meldingen',
-                          description=u'Dit jaar zijn er al %s meldingen opgelost.' % s.resolved_count)]
+                          description=u'Dit jaar zijn er al %s meldingen opgelost.' % resolved_count)]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Every app has a snapshot of all its visible incidents in a publicly readable json file on GCS, so most map opens can
+be served by a CDN instead of a search. The snapshot is updated every few minutes with the changes from the search
+index (see elasticsearch.sync_items). Every version is written to a new file, which can therefore be cached forever.
+The version is reserved in a transaction before the file is written, so overlapping updates never write the same file.
+
+Format: {"version": 1, "sync_token": "...", "items": [[id, lat, lon, icon id, title], ...]}
+The sync token can be used with /items/sync to fetch the changes made after the snapshot was created.
+"""
+import hashlib
+import json
+import logging
+import re
+import time
+
+import cloudstorage
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred, ndb
+
+from framework.plugin_loader import get_config
+from mcfw.cache import cached, invalidate_cache
+from mcfw.rpc import returns, arguments
+from plugins.reports.bizz.elasticsearch import sync_items, search_current, get_sync_token, is_routed_by_app, \
+    get_reports_index
+from plugins.reports.bizz.gcs import upload_to_gcs
+from plugins.reports.consts import NAMESPACE, MapItemsSort
+from plugins.reports.models import MapSnapshot, IntegrationSettings
+from plugins.reports.to import MapItemTO
+from typing import Dict, List
+
+PAGE_SIZE = 1000
+SNAPSHOT_INTERVAL = 5 * 60  # same as the cron schedule
+SNAPSHOT_OPTIONS = {
+    'x-goog-acl': 'public-read',
+    'cache-control': 'public, max-age=31536000',
+}
+
+
+def update_all_map_snapshots():
+    bucket = get_config(NAMESPACE).map_snapshot_bucket
+    if not bucket:
+        return
+    if not is_routed_by_app(get_reports_index()):
+        logging.warning('Not updating map snapshots: the search index must be rebuilt first to filter on app')
+        return
+    time_bucket = int(time.time() / SNAPSHOT_INTERVAL)
+    for app_id in {settings.app_id for settings in IntegrationSettings.query() if settings.app_id}:
+        # Named per app and interval so a slow or retried cron run doesn't start a second update of the same snapshot
+        task_name = 'map-snapshot-%s-%d' % (_get_task_name_part(app_id), time_bucket)
+        try:
+            deferred.defer(update_map_snapshot, app_id, bucket, _name=task_name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def _get_task_name_part(app_id):
+    # type: (unicode) -> str
+    # Task names may only contain [a-zA-Z0-9_-], the hash keeps app ids that only differ in other characters apart
+    app_hash = hashlib.md5(app_id.encode('utf-8')).hexdigest()[:8]
+    return '%s-%s' % (re.sub(r'[^a-zA-Z0-9_-]', '_', app_id)[:100], app_hash)
+
+
+def update_map_snapshot(app_id, bucket):
+    # type: (unicode, unicode) -> None
+    snapshot = MapSnapshot.create_key(app_id).get()  # type: MapSnapshot
+    previous_items = _read_snapshot_items(snapshot.file_name) if snapshot else None
+    items = None
+    sync_token = None
+    if previous_items is not None:
+        items, sync_token = _apply_changes(app_id, dict(previous_items), snapshot.sync_token)
+    if items is None:
+        sync_token = get_sync_token()
+        items = _get_all_items(app_id)
+    if items == previous_items:
+        if sync_token != snapshot.sync_token:
+            _save_sync_token(app_id, snapshot.file_name, sync_token)
+        return
+
+    version = _reserve_version(app_id)
+    file_name = u'/%s/map-snapshots/%s/%d.json' % (bucket, app_id, version)
+    content = json.dumps({'version': version,
+                          'sync_token': sync_token,
+                          'items': sorted(items.itervalues())}, separators=(',', ':'))
+    upload_to_gcs(content, u'application/json', file_name, SNAPSHOT_OPTIONS)
+    published, previous_file_name = _publish_snapshot(app_id, version, file_name, len(items), sync_token)
+    if not published:
+        logging.info('Not publishing version %d of the map snapshot of %s: a newer version is being created',
+                     version, app_id)
+        _delete_snapshot_file(file_name)
+        return
+    invalidate_cache(get_map_snapshot_url, app_id)
+    logging.info('Updated map snapshot of %s to version %d (%d items)', app_id, version, len(items))
+    if previous_file_name:
+        # Clients that just fetched the previous url might still need it for a while
+        deferred.defer(_delete_snapshot_file, previous_file_name, _countdown=3600)
+
+
+@ndb.transactional()
+def _reserve_version(app_id):
+    # type: (unicode) -> int
+    key = MapSnapshot.create_key(app_id)
+    snapshot = key.get() or MapSnapshot(key=key)  # type: MapSnapshot
+    snapshot.version += 1
+    snapshot.put()
+    return snapshot.version
+
+
+@ndb.transactional()
+def _publish_snapshot(app_id, version, file_name, count, sync_token):
+    # type: (unicode, int, unicode, int, unicode) -> tuple
+    snapshot = MapSnapshot.create_key(app_id).get()  # type: MapSnapshot
+    if snapshot.version != version:
+        return False, None
+    previous_file_name = snapshot.file_name
+    snapshot.file_name = file_name
+    snapshot.count = count
+    snapshot.sync_token = sync_token
+    snapshot.put()
+    return True, previous_file_name
+
+
+@ndb.transactional()
+def _save_sync_token(app_id, file_name, sync_token):
+    # type: (unicode, unicode, unicode) -> None
+    snapshot = MapSnapshot.create_key(app_id).get()  # type: MapSnapshot
+    # Another update might have published a newer file in the meantime
+    if snapshot.file_name == file_name:
+        snapshot.sync_token = sync_token
+        snapshot.put()
+
+
+def _to_row(item):
+    # type: (MapItemTO) -> list
+    return [item.id, item.coords.lat, item.coords.lon, item.icon.id, item.title]
+
+
+def _apply_changes(app_id, items, sync_token):
+    # type: (unicode, Dict[unicode, list], unicode) -> tuple
+    # Returns None as items when the snapshot is too old to be updated
+    while True:
+        changed, removed_ids, sync_token, more, reset = sync_items(None, None, None, None, sync_token, PAGE_SIZE,
+                                                                   app_id)
+        if reset:
+            return None, None
+        for item in changed:
+            items[item.id] = _to_row(item)
+        for incident_id in removed_ids:
+            items.pop(incident_id, None)
+        if not more:
+            return items, sync_token
+
+
+def _get_all_items(app_id):
+    # type: (unicode) -> Dict[unicode, list]
+    items = {}
+    cursor = None
+    while True:
+        page, cursor = search_current(None, None, None, None, cursor, PAGE_SIZE, app_id, sort=MapItemsSort.NONE)
+        for item in page:
+            items[item.id] = _to_row(item)
+        if not cursor:
+            return items
+
+
+def _read_snapshot_items(file_name):
+    # type: (unicode) -> Dict[unicode, list]
+    try:
+        with cloudstorage.open(file_name) as f:
+            return {row[0]: row for row in json.load(f)['items']}
+    except cloudstorage.errors.NotFoundError:
+        logging.warning('Map snapshot %s not found', file_name)
+        return None
+
+
+def _delete_snapshot_file(file_name):
+    try:
+        cloudstorage.delete(file_name)
+    except cloudstorage.errors.NotFoundError:
+        pass
+
+
+@cached(1, lifetime=300, request=True, memcache=True)
+@returns(unicode)
+@arguments(app_id=unicode)
+def get_map_snapshot_url(app_id):
+    snapshot = MapSnapshot.create_key(app_id).get()  # type: MapSnapshot
+    if not snapshot or not snapshot.file_name:
+        return None
+    return u'https://storage.googleapis.com%s' % snapshot.file_name
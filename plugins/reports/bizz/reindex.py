@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Rebuilds the search index without downtime. Searches always use the `reports` alias. A reindex job builds a new
+versioned index (reports-v<version>) in the background while incident changes are written to both the live index and
+the new one. Once the new index contains a document for every visible incident (that has a location), the alias is
+moved to it.
+"""
+import httplib
+import logging
+from datetime import datetime
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb, deferred
+
+from framework.bizz.job import run_job, MODE_BATCH
+from mcfw.cache import invalidate_cache
+from plugins.reports.bizz import get_incident_votes
+from plugins.reports.bizz.elasticsearch import create_index, get_versioned_index, execute_bulk_request, \
+    index_incident_operations, get_reindex_target, get_reports_index, REINDEX_TARGET_CACHE_LIFETIME, _request, \
+    ElasticsearchException, is_routed_by_app, get_id_sort_field
+from plugins.reports.consts import REINDEX_QUEUE
+from plugins.reports.models import Incident, ReindexJob, ReindexJobStatus
+from typing import List
+
+REINDEX_BATCH_SIZE = 200
+# Interval between two checks of the progress of a reindex job
+CHECK_INTERVAL = 60
+# The job is marked as failed when the amount of indexed documents didn't change for this many checks
+MAX_CHECKS_WITHOUT_PROGRESS = 15
+
+
+def start_reindex():
+    # type: () -> ReindexJob
+    """Creates a new versioned index and starts filling it. Can be executed via the interactive explorer."""
+    running_job = ReindexJob.get_running()
+    if running_job:
+        raise Exception('Reindex job %d is still running' % running_job.version)
+    latest_job = ReindexJob.get_latest()
+    version = latest_job.version + 1 if latest_job else 1
+    index = get_versioned_index(version)
+    # Refreshing is disabled while building the index, this makes bulk indexing a lot faster
+    create_index(index, {'index': {'refresh_interval': '-1'}})
+    job = ReindexJob(key=ReindexJob.create_key(version),
+                     status=ReindexJobStatus.RUNNING,
+                     index=index,
+                     expected_count=Incident.list_visible().count(limit=None))
+    job.put()
+    invalidate_cache(get_reindex_target)
+    # Wait until all instances write to the new index before copying the incidents
+    deferred.defer(_run_reindex_job, version, _countdown=REINDEX_TARGET_CACHE_LIFETIME, _queue=REINDEX_QUEUE)
+    return job
+
+
+def resume_reindex(version):
+    # type: (int) -> ReindexJob
+    """Indexes all incidents again in an existing versioned index, e.g. after the job failed."""
+    job = ReindexJob.create_key(version).get()  # type: ReindexJob
+    if not job:
+        raise Exception('Reindex job %d not found' % version)
+    if job.status == ReindexJobStatus.FINISHED:
+        raise Exception('Reindex job %d has already finished' % version)
+    job.status = ReindexJobStatus.RUNNING
+    job.checks_without_progress = 0
+    job.skipped_count = 0
+    job.expected_count = Incident.list_visible().count(limit=None)
+    job.put()
+    invalidate_cache(get_reindex_target)
+    deferred.defer(_run_reindex_job, version, _countdown=REINDEX_TARGET_CACHE_LIFETIME, _queue=REINDEX_QUEUE)
+    return job
+
+
+def _run_reindex_job(version):
+    job = ReindexJob.create_key(version).get()  # type: ReindexJob
+    run_job(_reindex_query, [], _reindex_worker, [version, job.index], mode=MODE_BATCH, batch_size=REINDEX_BATCH_SIZE,
+            worker_queue=REINDEX_QUEUE)
+    deferred.defer(_check_reindex, version, _countdown=CHECK_INTERVAL, _queue=REINDEX_QUEUE)
+
+
+def _reindex_query():
+    return Incident.list_visible()
+
+
+def _reindex_worker(incident_keys, version, index):
+    # type: (List[ndb.Key], int, str) -> None
+    incidents = [incident for incident in ndb.get_multi(incident_keys) if incident]  # type: List[Incident]
+    votes = get_incident_votes([incident.id for incident in incidents])
+    operations = []
+    for incident in incidents:
+        operations.extend(index_incident_operations(incident, votes[incident.id]))
+    if operations:
+        results = execute_bulk_request(operations, index)
+        if any(result.retryable for result in results):
+            # Retry the task, indexing the same version of an incident again is harmless
+            raise Exception('Not all incidents could be indexed in %s' % index)
+    # Incidents without a location are deleted from the index instead
+    skipped = sum(1 for incident in incidents if not incident.details or not incident.details.geo_location)
+    skipped += len(incident_keys) - len(incidents)
+    if skipped:
+        _add_skipped_count(version, skipped)
+
+
+@ndb.transactional()
+def _add_skipped_count(version, count):
+    job = ReindexJob.create_key(version).get()  # type: ReindexJob
+    job.skipped_count += count
+    job.put()
+
+
+def _count_documents(index):
+    # type: (str) -> int
+    _request('/%s/_refresh' % index, urlfetch.POST)
+    # Tombstones of incidents that were hidden while building the index don't count
+    qry = {'query': {'bool': {'must_not': [{'term': {'deleted': True}}]}}}
+    return _request('/%s/_count' % index, urlfetch.POST, qry)['count']
+
+
+def _check_reindex(version):
+    job = ReindexJob.create_key(version).get()  # type: ReindexJob
+    if job.status != ReindexJobStatus.RUNNING:
+        return
+    indexed_count = _count_documents(job.index)
+    logging.info('Reindex job %d: %d/%d documents indexed, %d incidents skipped', version, indexed_count,
+                 job.expected_count, job.skipped_count)
+    is_complete = indexed_count + job.skipped_count >= job.expected_count
+    if is_complete:
+        _switch_alias(job.index)
+    job = _save_reindex_progress(version, indexed_count, is_complete)
+    if job.status == ReindexJobStatus.RUNNING:
+        deferred.defer(_check_reindex, version, _countdown=CHECK_INTERVAL, _queue=REINDEX_QUEUE)
+    else:
+        invalidate_cache(get_reindex_target)
+
+
+@ndb.transactional()
+def _save_reindex_progress(version, indexed_count, is_complete):
+    # type: (int, int, bool) -> ReindexJob
+    # In a transaction, the workers update skipped_count in the mean time
+    job = ReindexJob.create_key(version).get()  # type: ReindexJob
+    if is_complete:
+        job.status = ReindexJobStatus.FINISHED
+        job.finished = datetime.now()
+    elif indexed_count == job.indexed_count:
+        job.checks_without_progress += 1
+        if job.checks_without_progress >= MAX_CHECKS_WITHOUT_PROGRESS:
+            logging.error('Reindex job %d failed: %d/%d documents indexed, use resume_reindex to try again',
+                          version, indexed_count, job.expected_count)
+            job.status = ReindexJobStatus.FAILED
+    else:
+        job.checks_without_progress = 0
+    job.indexed_count = indexed_count
+    job.put()
+    return job
+
+
+def _get_alias_indices(alias):
+    # type: (str) -> List[str]
+    try:
+        return _request('/_alias/%s' % alias).keys()
+    except ElasticsearchException as e:
+        if e.status_code == httplib.NOT_FOUND:
+            return []
+        raise
+
+
+def _switch_alias(index):
+    # type: (str) -> None
+    alias = get_reports_index()
+    _request('/%s/_settings' % index, urlfetch.PUT, {'index': {'refresh_interval': None}})
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    current_indices = _get_alias_indices(alias)
+    actions.extend({'remove': {'index': i, 'alias': alias}} for i in current_indices)
+    if not current_indices and _index_exists(alias):
+        # Before the first reindex, the live index is a regular index instead of an alias
+        actions.append({'remove_index': {'index': alias}})
+    # All actions are executed atomically
+    _request('/_aliases', urlfetch.POST, {'actions': actions})
+    invalidate_cache(is_routed_by_app, alias)
+    invalidate_cache(get_id_sort_field, alias)
+    # Old versions are kept so we can switch back to them, they can be removed with elasticsearch.delete_index
+    logging.info('Alias %s now points to %s instead of %s', alias, index, current_indices)
+
+
+def _index_exists(index):
+    # type: (str) -> bool
+    try:
+        _request('/%s' % index)
+        return True
+    except ElasticsearchException as e:
+        if e.status_code == httplib.NOT_FOUND:
+            return False
+        raise
@@ -18,6 +18,7 @@
 from mcfw.cache import cached
 from mcfw.rpc import returns, arguments
 
+from plugins.reports.utils.config_cache import get_cached
 from plugins.rogerthat_api.api import messaging, system
 from plugins.rogerthat_api.models.settings import RogerthatSettings
 from plugins.rogerthat_api.to import MemberTO
@@ -29,7 +30,7 @@ from plugins.rogerthat_api.to.messaging import AnswerTO, Message, AttachmentTO
            attachments=[AttachmentTO], parent_message_key=unicode, json_rpc_id=unicode)
 def send_rogerthat_message(sik, member, message, answers=None, flags=None, attachments=None,
                            parent_message_key=None, json_rpc_id=None):
-    rt_settings = RogerthatSettings.create_key(sik).get()
+    rt_settings = get_cached(RogerthatSettings.create_key(sik))  # type: RogerthatSettings
 
     flags = flags if flags is not None else Message.FLAG_AUTO_LOCK
     if not answers:
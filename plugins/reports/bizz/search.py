@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+import abc
+import json
+import logging
+import math
+import threading
+import time
+import zlib
+from collections import namedtuple, defaultdict
+
+import cloudstorage
+from google.appengine.api import urlfetch, app_identity
+from google.appengine.ext import ndb
+
+from plugins.reports.bizz import convert_to_item_to, get_incident_votes
+from plugins.reports.bizz.elasticsearch import search_current, search_clusters, ElasticsearchException, \
+    get_cluster_precision, _encode_cursor, _decode_cursor, _get_app_id, multi_search, MapSearch
+from plugins.reports.bizz.gcs import upload_to_gcs
+from plugins.reports.consts import MapItemsSort
+from plugins.reports.models import Incident
+from plugins.reports.to import MapItemTO, MapClusterTO, GeoPointTO, MapClusterStatusTO
+from plugins.reports.utils import geohash
+from plugins.reports.utils.geo import get_distance, BoundingBox
+from typing import List, Tuple, Union, Dict
+
+METERS_PER_DEGREE = 111320.0
+GRID_SNAPSHOT_FILE = 'reports/search-grid.json.zlib'
+
+
+class SearchBackend(object):
+    """Searches the visible incidents. Results are sorted by distance (see MapItemsSort), then by id."""
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def search(self, lat, lon, distance, status, cursor, limit, app_id, bbox=None, sort=MapItemsSort.DISTANCE,
+               min_votes=None):
+        # type: (float, float, int, str, str, int, str, BoundingBox, str, int) -> Tuple[List[MapItemTO], str]
+        pass
+
+    @abc.abstractmethod
+    def search_clusters(self, lat, lon, distance, status, app_id, bbox=None, min_votes=None):
+        # type: (float, float, int, str, str, BoundingBox, int) -> Tuple[List[MapItemTO], List[MapClusterTO]]
+        pass
+
+    def multi_search(self, searches, app_id):
+        # type: (List[MapSearch], str) -> List[Tuple[List[MapItemTO], Union[None, str, List[MapClusterTO]]]]
+        """First page of every search, see elasticsearch.multi_search"""
+        results = []
+        for search in searches:
+            if search.cluster:
+                results.append(self.search_clusters(search.lat, search.lon, search.distance, search.status, app_id,
+                                                    search.bbox, search.min_votes))
+            else:
+                results.append(self.search(search.lat, search.lon, search.distance, search.status, None, search.limit,
+                                           app_id, search.bbox, search.sort, search.min_votes))
+        return results
+
+
+class ElasticsearchBackend(SearchBackend):
+
+    def search(self, lat, lon, distance, status, cursor, limit, app_id, bbox=None, sort=MapItemsSort.DISTANCE,
+               min_votes=None):
+        return search_current(lat, lon, distance, status, cursor, limit, app_id, bbox, sort, min_votes)
+
+    def search_clusters(self, lat, lon, distance, status, app_id, bbox=None, min_votes=None):
+        return search_clusters(lat, lon, distance, status, app_id, bbox, min_votes)
+
+    def multi_search(self, searches, app_id):
+        return multi_search(searches, app_id)
+
+
+GridEntry = namedtuple('GridEntry', ['id', 'lat', 'lon', 'status', 'app_id'])
+
+
+class GridIndex(object):
+    """Visible incidents grouped per cell of CELL_SIZE by CELL_SIZE degrees"""
+    CELL_SIZE = 0.1  # degrees, about 11km
+    MAX_CELLS = 2500  # scan all incidents instead when a search covers more cells than this
+
+    def __init__(self, entries):
+        # type: (List[GridEntry]) -> None
+        self.entries = entries
+        self.cells = defaultdict(list)  # type: Dict[Tuple[int, int], List[GridEntry]]
+        for entry in entries:
+            self.cells[self._get_cell(entry.lat, entry.lon)].append(entry)
+
+    @classmethod
+    def from_datastore(cls):
+        # type: () -> GridIndex
+        entries = []
+        for incident in Incident.list_visible().iter(batch_size=500):  # type: Incident
+            if not incident.details or not incident.details.geo_location:
+                continue
+            entries.append(GridEntry(incident.id, incident.details.geo_location.lat,
+                                     incident.details.geo_location.lon, incident.status,
+                                     _get_app_id(incident.integration_id)))
+        return cls(entries)
+
+    @classmethod
+    def from_snapshot(cls):
+        # type: () -> GridIndex
+        """Index saved by update_grid_snapshot, None if there is none yet"""
+        try:
+            with cloudstorage.open(_get_grid_snapshot_path()) as f:
+                rows = json.loads(zlib.decompress(f.read()))
+        except cloudstorage.errors.NotFoundError:
+            return None
+        return cls([GridEntry(*row) for row in rows])
+
+    def _get_cell(self, lat, lon):
+        return int(math.floor(lat / self.CELL_SIZE)), int(math.floor(lon / self.CELL_SIZE))
+
+    def _get_candidates(self, lat, lon, distance):
+        lat_delta = distance / METERS_PER_DEGREE
+        lon_delta = distance / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        min_lat, min_lon = self._get_cell(lat - lat_delta, lon - lon_delta)
+        max_lat, max_lon = self._get_cell(lat + lat_delta, lon + lon_delta)
+        if (max_lat - min_lat + 1) * (max_lon - min_lon + 1) > self.MAX_CELLS:
+            return self.entries
+        candidates = []
+        for cell_lat in xrange(min_lat, max_lat + 1):
+            for cell_lon in xrange(min_lon, max_lon + 1):
+                candidates.extend(self.cells.get((cell_lat, cell_lon), []))
+        return candidates
+
+    def search(self, lat, lon, distance, status, app_id, bbox=None):
+        # type: (float, float, int, str, str, BoundingBox) -> List[Tuple[float, GridEntry]]
+        """Returns (distance in meters, entry) tuples, sorted the same way as the elasticsearch results"""
+        if bbox:
+            center_lat, center_lon = bbox.center
+            candidates = self._get_candidates(center_lat, center_lon, bbox.radius)
+        else:
+            candidates = self._get_candidates(lat, lon, distance)
+        results = []
+        for entry in candidates:
+            if status and entry.status != status:
+                continue
+            if app_id and entry.app_id != app_id:
+                continue
+            entry_distance = get_distance(lat, lon, entry.lat, entry.lon)
+            if bbox.contains(entry.lat, entry.lon) if bbox else entry_distance <= distance:
+                results.append((entry_distance, entry))
+        results.sort(key=lambda result: (result[0], result[1].id))
+        return results
+
+
+class GridBackend(SearchBackend):
+    """
+    Searches an in-memory grid of all visible incidents. Used when elasticsearch is unavailable and in tests. Cursors
+    are compatible with the elasticsearch backend, so paging can continue on the other backend.
+
+    Scanning all incidents takes too long to do while searching, so the grid is built by a cron job (see
+    update_grid_snapshot) and instances load that snapshot every INDEX_LIFETIME seconds.
+    """
+    INDEX_LIFETIME = 5 * 60  # seconds
+    RETRY_INTERVAL = 60  # seconds, after loading the snapshot failed
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None  # type: GridIndex
+        self._index_expiration = 0
+
+    def get_index(self):
+        # type: () -> GridIndex
+        """Never waits for a request that is loading the index, the previous (or an empty) index is used meanwhile"""
+        if time.time() < self._index_expiration:
+            return self._index
+        if not self._lock.acquire(False):
+            return self._index or GridIndex([])
+        try:
+            if time.time() >= self._index_expiration:
+                self._load_index()
+        finally:
+            self._lock.release()
+        return self._index or GridIndex([])
+
+    def _load_index(self):
+        start_time = time.time()
+        try:
+            index = GridIndex.from_snapshot()
+        except Exception:
+            logging.exception('Failed to load the grid index')
+            index = None
+        if not index:
+            logging.warning('No grid index available, using the previous one until it is')
+            self._index_expiration = time.time() + self.RETRY_INTERVAL
+            return
+        self._index = index
+        self._index_expiration = time.time() + self.INDEX_LIFETIME
+        logging.info('Loaded grid index with %d incidents in %.3fs', len(index.entries), time.time() - start_time)
+
+    def invalidate(self):
+        self._index_expiration = 0
+
+    def search(self, lat, lon, distance, status, cursor, limit, app_id, bbox=None, sort=MapItemsSort.DISTANCE,
+               min_votes=None):
+        results = self._search(lat, lon, distance, status, app_id, bbox, min_votes)
+        if sort == MapItemsSort.VOTES:
+            # Same sort values as elasticsearch: [votes, distance, id] with the votes descending
+            votes = get_incident_votes([entry.id for _, entry in results])
+            sort_values = {entry.id: [votes[entry.id].negative_count, entry_distance, entry.id]
+                           for entry_distance, entry in results}
+            get_sort_key = lambda values: (-values[0], values[1], values[2])
+        elif sort == MapItemsSort.NONE:
+            sort_values = {entry.id: [entry.id] for _, entry in results}
+            get_sort_key = tuple
+        else:
+            sort_values = {entry.id: [entry_distance, entry.id] for entry_distance, entry in results}
+            get_sort_key = tuple
+        results.sort(key=lambda result: get_sort_key(sort_values[result[1].id]))
+        if cursor and cursor.isdigit():
+            results = results[long(cursor):]
+        elif cursor:
+            search_after, _ = _decode_cursor(cursor)
+            if not search_after:
+                return [], None
+            after = get_sort_key(search_after)
+            results = [result for result in results if get_sort_key(sort_values[result[1].id]) > after]
+        page = results[:limit]
+        new_cursor = None
+        if len(results) > limit:
+            new_cursor = _encode_cursor(sort_values[page[-1][1].id])
+        return self._get_items([entry for _, entry in page], status), new_cursor
+
+    def search_clusters(self, lat, lon, distance, status, app_id, bbox=None, min_votes=None):
+        precision = get_cluster_precision(distance)
+        cells = defaultdict(list)
+        for _, entry in self._search(lat, lon, distance, status, app_id, bbox, min_votes):
+            cells[geohash.encode(entry.lat, entry.lon, precision)].append(entry)
+        single_entries = []
+        clusters = []
+        for cell, entries in cells.iteritems():
+            if len(entries) == 1:
+                single_entries.extend(entries)
+                continue
+            statuses = defaultdict(int)
+            for entry in entries:
+                statuses[entry.status] += 1
+            clusters.append(MapClusterTO(id=cell,
+                                         coords=GeoPointTO(lat=sum(e.lat for e in entries) / len(entries),
+                                                           lon=sum(e.lon for e in entries) / len(entries)),
+                                         count=len(entries),
+                                         statuses=[MapClusterStatusTO(status=s, count=count)
+                                                   for s, count in statuses.iteritems()]))
+        return self._get_items(single_entries, status), clusters
+
+    def _search(self, lat, lon, distance, status, app_id, bbox, min_votes):
+        # type: (float, float, int, str, str, BoundingBox, int) -> List[Tuple[float, GridEntry]]
+        results = self.get_index().search(lat, lon, distance, status, app_id, bbox)
+        if min_votes:
+            votes = get_incident_votes([entry.id for _, entry in results])
+            results = [result for result in results if votes[result[1].id].negative_count >= min_votes]
+        return results
+
+    def _get_items(self, entries, status):
+        # type: (List[GridEntry], str) -> List[MapItemTO]
+        # The index can be a few minutes old, skip incidents that changed in the mean time
+        incidents = ndb.get_multi([Incident.create_key(entry.id) for entry in entries])  # type: List[Incident]
+        return [convert_to_item_to(incident) for incident in incidents
+                if incident and incident.visible and (not status or incident.status == status)]
+
+
+def _get_grid_snapshot_path():
+    return '/%s/%s' % (app_identity.get_default_gcs_bucket_name(), GRID_SNAPSHOT_FILE)
+
+
+def update_grid_snapshot():
+    """Saves the grid of all visible incidents for the GridBackend of every instance. Executed by a cron job."""
+    start_time = time.time()
+    index = GridIndex.from_datastore()
+    content = zlib.compress(json.dumps([list(entry) for entry in index.entries], separators=(',', ':')))
+    upload_to_gcs(content, 'application/octet-stream', _get_grid_snapshot_path())
+    logging.info('Saved grid index with %d incidents (%d bytes) in %.3fs', len(index.entries), len(content),
+                 time.time() - start_time)
+
+
+_search_backend = ElasticsearchBackend()  # type: SearchBackend
+_fallback_backend = GridBackend()  # type: SearchBackend
+
+
+def get_search_backend():
+    # type: () -> SearchBackend
+    return _search_backend
+
+
+def set_search_backend(backend, fallback_backend=None):
+    # type: (SearchBackend, SearchBackend) -> None
+    """Can be used to search without elasticsearch, e.g. in tests: set_search_backend(GridBackend())"""
+    global _search_backend, _fallback_backend
+    _search_backend = backend
+    _fallback_backend = fallback_backend
+
+
+def _with_fallback(func_name, *args):
+    try:
+        return getattr(_search_backend, func_name)(*args)
+    except (ElasticsearchException, urlfetch.Error):
+        if not _fallback_backend:
+            raise
+        logging.exception('Search backend failed, using fallback')
+        return getattr(_fallback_backend, func_name)(*args)
+
+
+def search_map_items(lat, lon, distance, status, cursor, limit, app_id, bbox=None, sort=MapItemsSort.DISTANCE,
+                     min_votes=None):
+    # type: (float, float, int, str, str, int, str, BoundingBox, str, int) -> Tuple[List[MapItemTO], Union[None, str]]
+    return _with_fallback('search', lat, lon, distance, status, cursor, limit, app_id, bbox, sort, min_votes)
+
+
+def search_map_clusters(lat, lon, distance, status, app_id, bbox=None, min_votes=None):
+    # type: (float, float, int, str, str, BoundingBox, int) -> Tuple[List[MapItemTO], List[MapClusterTO]]
+    return _with_fallback('search_clusters', lat, lon, distance, status, app_id, bbox, min_votes)
+
+
+def search_map_multi(searches, app_id):
+    # type: (List[MapSearch], str) -> List[Tuple[List[MapItemTO], Union[None, str, List[MapClusterTO]]]]
+    return _with_fallback('multi_search', searches, app_id)
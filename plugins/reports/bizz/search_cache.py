@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Cache for map searches. Users panning around the same area send almost identical searches, so the center of a search
+is rounded to the center of a small geohash cell and the distance is rounded up. The distance is also enlarged by half
+the diagonal of that cell, so the searched circle always contains the requested one. Bounding boxes are rounded outwards
+to the edges of those cells and searched around the rounded center of the box. Callers therefore have to drop the
+results outside the requested area and sort them by distance from the real location again, see map.get_report_map_items.
+Results are cached per instance and in memcache for RESULT_LIFETIME seconds.
+
+Every cache key contains a generation number of the (larger) geohash cell around the center. The searched area always
+lies within that cell and its neighbours, so when an incident is indexed, the generation of its cell and the 8 cells
+around it is incremented, which invalidates every cached search that could contain the incident.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from plugins.reports.consts import NAMESPACE
+from plugins.reports.models import Incident
+from plugins.reports.utils import geohash, codec
+from plugins.reports.utils.geo import BoundingBox, get_distance
+from plugins.reports.utils.local_cache import LocalCache
+from typing import List, Callable, Tuple, Any
+
+RESULT_LIFETIME = 30  # seconds
+LOCAL_CACHE_SIZE = 1000
+# Precisions at which generations are kept. Searches with a larger distance are not cached.
+GENERATION_PRECISIONS = range(2, 8)
+# Searches are rounded to cells of at most 1/QUANTIZATION_FACTOR of the distance
+QUANTIZATION_FACTOR = 10
+MAX_QUANTIZATION_PRECISION = 8
+# Time other instances wait for the instance that is executing the same search
+LOCK_LIFETIME = 5  # seconds
+LOCK_POLL_INTERVAL = 0.05  # seconds
+LOCK_MAX_WAIT = 1  # seconds
+
+
+class _SingleFlight(object):
+    """Makes sure concurrent calls for the same key on this instance only execute the function once"""
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+        if not is_leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+_local_cache = LocalCache(LOCAL_CACHE_SIZE)
+_single_flight = _SingleFlight()
+
+
+def _get_generation_precision(lat, distance):
+    # type: (float, int) -> int
+    # Most precise level at which the searched area still fits in one cell. Cell heights are about half of their width
+    # for some precisions and cells are narrower further from the equator.
+    lon_factor = max(math.cos(math.radians(lat)), 0.01)
+    for precision in reversed(GENERATION_PRECISIONS):
+        if geohash.CELL_WIDTH[precision] * lon_factor / 2 >= distance:
+            return precision
+    return None
+
+
+def _get_quantization_precision(distance):
+    # type: (int) -> int
+    for precision in sorted(geohash.CELL_WIDTH):
+        if geohash.CELL_WIDTH[precision] <= distance / QUANTIZATION_FACTOR:
+            return precision
+    return MAX_QUANTIZATION_PRECISION
+
+
+def _get_distance_bucket(distance):
+    # type: (int) -> int
+    # Round up to 2 significant digits
+    step = 10 ** max(0, len(str(int(distance))) - 2)
+    return int(math.ceil(float(distance) / step) * step)
+
+
+def _get_generation_key(cell):
+    return 'map-search-gen-%s' % cell
+
+
+def _snap_bbox(bbox, precision):
+    # type: (BoundingBox, int) -> BoundingBox
+    """Enlarges the box to the edges of the geohash cells of this precision around its corners"""
+    _, top, left, _ = geohash.decode_bounds(geohash.encode(bbox.top, bbox.left, precision))
+    bottom, _, _, right = geohash.decode_bounds(geohash.encode(bbox.bottom, bbox.right, precision))
+    return BoundingBox(top, left, bottom, right)
+
+
+def _get_bbox_distance(lat, lon, bbox):
+    # type: (float, float, BoundingBox) -> int
+    # Distance to the farthest point of the box. Besides the corners, boxes are widest at the latitude closest to the
+    # equator.
+    widest_lat = min(max(0.0, bbox.bottom), bbox.top)
+    points = [(bbox.top, bbox.left), (bbox.top, bbox.right), (bbox.bottom, bbox.left), (bbox.bottom, bbox.right),
+              (widest_lat, bbox.left), (widest_lat, bbox.right)]
+    return int(math.ceil(max(get_distance(lat, lon, point_lat, point_lon) for point_lat, point_lon in points)))
+
+
+def cached_search(lat, lon, distance, key_args, search_func, result_type, bbox=None):
+    # type: (float, float, int, Tuple, Callable[[float, float, int, BoundingBox], Any], type, BoundingBox) -> Any
+    """
+    Args:
+        lat (float)
+        lon (float)
+        distance (int): radius of the search in meters
+        key_args (tuple): all other arguments of the search, e.g. status, cursor and limit
+        search_func (function): executes the search with the rounded lat, lon, distance and bounding box
+        result_type (type): TO returned by search_func
+        bbox (BoundingBox): searches within this box instead, around its center. lat, lon and distance are ignored.
+    """
+    original_args = lat, lon, distance, bbox
+    if bbox:
+        lat, lon = bbox.center
+        distance = bbox.radius
+    distance = _get_distance_bucket(distance)
+    quantization_precision = _get_quantization_precision(distance)
+    cell = geohash.encode(lat, lon, quantization_precision)
+    lat, lon = geohash.decode(cell)
+    if bbox:
+        bbox = _snap_bbox(bbox, quantization_precision)
+        search_distance = _get_bbox_distance(lat, lon, bbox)
+    else:
+        # Cells are at most CELL_WIDTH wide and high
+        search_distance = distance + int(math.ceil(geohash.CELL_WIDTH[quantization_precision] * math.sqrt(2) / 2))
+    generation_precision = _get_generation_precision(lat, search_distance)
+    if not generation_precision:
+        return search_func(*original_args)
+    generation_cell = geohash.encode(lat, lon, generation_precision)
+    generation = memcache.get(_get_generation_key(generation_cell), namespace=NAMESPACE) or 0
+    key_str = repr((cell, distance, bbox, generation) + tuple(key_args))
+    cache_key = 'map-search-%s' % hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    result = _local_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    def search():
+        serialized = memcache.get(cache_key, namespace=NAMESPACE)
+        if serialized is None:
+            serialized = _search_once(cache_key, lambda: codec.serialize(
+                search_func(lat, lon, search_distance, bbox), result_type, False))
+        value = codec.parse(result_type, serialized, False)
+        _local_cache.set(cache_key, value, RESULT_LIFETIME)
+        return value
+
+    return _single_flight.do(cache_key, search)
+
+
+def _search_once(cache_key, search_func):
+    # Only one instance executes the search, the others wait a bit for the result to appear in memcache
+    lock_key = '%s-lock' % cache_key
+    is_locked = memcache.add(lock_key, 1, time=LOCK_LIFETIME, namespace=NAMESPACE)
+    if not is_locked:
+        end_time = time.time() + LOCK_MAX_WAIT
+        while time.time() < end_time:
+            time.sleep(LOCK_POLL_INTERVAL)
+            serialized = memcache.get(cache_key, namespace=NAMESPACE)
+            if serialized is not None:
+                return serialized
+        logging.debug('Timeout while waiting for %s, executing the search anyway', cache_key)
+    try:
+        serialized = search_func()
+        memcache.set(cache_key, serialized, time=RESULT_LIFETIME, namespace=NAMESPACE)
+        return serialized
+    finally:
+        if is_locked:
+            memcache.delete(lock_key, namespace=NAMESPACE)
+
+
+def invalidate_search_cache(incidents):
+    # type: (List[Incident]) -> None
+    """
+    Invalidates all cached searches which might contain these incidents. Searches around the previous location of an
+    incident that was moved expire after RESULT_LIFETIME.
+    """
+    keys = set()
+    for incident in incidents:
+        if not incident or not incident.details or not incident.details.geo_location:
+            continue
+        location = incident.details.geo_location
+        for precision in GENERATION_PRECISIONS:
+            for cell in geohash.neighbours(geohash.encode(location.lat, location.lon, precision)):
+                keys.add(_get_generation_key(cell))
+    if keys:
+        memcache.offset_multi({key: 1 for key in keys}, namespace=NAMESPACE, initial_value=0)
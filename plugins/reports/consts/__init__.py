@@ -21,8 +21,18 @@ from plugins.rogerthat_api.plugin_utils import Enum
 
 NAMESPACE = 'reports'
 INCIDENTS_QUEUE = 'incidents-queue'
+INDEXER_QUEUE = 'indexer-queue'
+REINDEX_QUEUE = 'reindex-queue'
+ANNOUNCEMENTS_QUEUE = 'announcements-queue'
+VOTES_INDEX_QUEUE = 'votes-index-queue'
 
 
 class IncidentTagType(Enum):
     CATEGORY = 'category'
     SUB_CATEGORY = 'subcategory'
+
+
+class MapItemsSort(Enum):
+    DISTANCE = 'distance'
+    NONE = 'none'  # cheaper, results are in an arbitrary but stable order
+    VOTES = 'votes'  # incidents that were also reported by the most users first, then by distance
@@ -18,10 +18,11 @@ from google.appengine.ext import ndb
 
 from framework.utils.cloud_tasks import schedule_tasks, create_task
 from mcfw.exceptions import HttpNotFoundException
-from plugins.reports.bizz.elasticsearch import re_index_incident
+from plugins.reports.bizz.indexer import save_incident
 from plugins.reports.models import IntegrationSettingsData, IntegrationSettings, Consumer, RogerthatUser, Incident, \
-    GreenValleySettings
+    GreenValleySettings, FormIntegration
 from plugins.reports.to import IncidentTO
+from plugins.reports.utils.config_cache import get_cached, invalidate_cached
 from plugins.rogerthat_api.models.settings import RogerthatSettings
 from plugins.rogerthat_api.to import UserDetailsTO
 from typing import List, Tuple
@@ -61,6 +62,7 @@ def save_integration_settings(integration_id, rogerthat_api_key, name, consumer_
             tasks.append(create_task(remove_gv_integration, integration_id, settings.data.topic, data.proxy_id))
     settings.data = data
     ndb.put_multi([settings, rogerthat_settings, consumer])
+    invalidate_cached(IntegrationSettings, RogerthatSettings, Consumer)
     schedule_tasks(tasks)
     return settings, rogerthat_settings
 
@@ -72,7 +74,7 @@ def list_integrations():
 
 def get_integration_settings(integration_id):
     # type: (int) -> IntegrationSettings
-    settings = IntegrationSettings.create_key(integration_id).get()
+    settings = get_cached(IntegrationSettings.create_key(integration_id))
     if not settings:
         raise HttpNotFoundException('settings_not_found', {'integration_id': integration_id})
     return settings
@@ -89,7 +91,19 @@ def get_integration_settings_tuple(integration_id):
 
 def get_consumer(consumer_key):
     # type: (str) -> Consumer
-    return Consumer.create_key(consumer_key).get()
+    if not consumer_key:
+        return None
+    return get_cached(Consumer.create_key(consumer_key))
+
+
+def get_rogerthat_settings(sik):
+    # type: (str) -> RogerthatSettings
+    return get_cached(RogerthatSettings.create_key(sik))
+
+
+def get_form_integration(form_id):
+    # type: (int) -> FormIntegration
+    return get_cached(FormIntegration.create_key(form_id))
 
 
 def save_rogerthat_user(user_details):
@@ -128,6 +142,5 @@ def update_incident(incident, data):
     # type: (Incident, IncidentTO) -> Incident
     incident.set_status(data.status)
     incident.visible = data.visible if incident.can_show_on_map else False
-    incident.put()
-    re_index_incident(incident)
+    save_incident(incident)
     return incident
@@ -19,8 +19,14 @@ from datetime import datetime
 import webapp2
 
 from plugins.reports.bizz import re_count_incidents
+from plugins.reports.bizz.announcements import save_seen_announcements
+from plugins.reports.bizz.elasticsearch import cleanup_tombstones
+from plugins.reports.bizz.geocoding import cleanup_expired_addresses
 from plugins.reports.bizz.incident_statistics import build_monthly_incident_statistics, refresh_all_tags
 from plugins.reports.bizz.incidents import cleanup_timed_out
+from plugins.reports.bizz.indexer import flush_index_requests
+from plugins.reports.bizz.map_snapshots import update_all_map_snapshots
+from plugins.reports.bizz.search import update_grid_snapshot
 
 
 class ReportsCleanupTimedOutHandler(webapp2.RequestHandler):
@@ -35,6 +41,42 @@ class ReportsCountIncidentsHandler(webapp2.RequestHandler):
         re_count_incidents()
 
 
+class ReportsFlushIndexRequestsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        flush_index_requests()
+
+
+class ReportsCleanupTombstonesHandler(webapp2.RequestHandler):
+
+    def get(self):
+        cleanup_tombstones()
+
+
+class ReportsCleanupGeocodedAddressesHandler(webapp2.RequestHandler):
+
+    def get(self):
+        cleanup_expired_addresses()
+
+
+class ReportsSaveSeenAnnouncementsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        save_seen_announcements()
+
+
+class ReportsUpdateMapSnapshotsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        update_all_map_snapshots()
+
+
+class ReportsUpdateSearchGridHandler(webapp2.RequestHandler):
+
+    def get(self):
+        update_grid_snapshot()
+
+
 class BuildIncidentStatisticsHandler(webapp2.RequestHandler):
     def get(self):
         build_monthly_incident_statistics(datetime.now())
@@ -24,8 +24,8 @@ from mcfw.consts import DEBUG
 from typing import Tuple
 
 from framework.utils import guid, try_or_defer
-from plugins.reports.bizz.elasticsearch import re_index_incident
 from plugins.reports.bizz.gcs import is_file_available, upload_to_gcs
+from plugins.reports.bizz.indexer import save_incident
 from plugins.reports.bizz.rogerthat import send_rogerthat_message
 from plugins.reports.consts import INCIDENTS_QUEUE
 from plugins.reports.dal import get_incident, get_rogerthat_user
@@ -175,8 +175,7 @@ def incident_follow_up(from_, regex, subject, body):
     member = MemberTO(member=rt_user.email, app_id=rt_user.app_id, alert_flags=2)
     if incident.status == IncidentStatus.NEW:
         incident.set_status(IncidentStatus.IN_PROGRESS)
-        incident.put()
-        try_or_defer(re_index_incident, incident)
+        save_incident(incident)
     if isinstance(incident.params, IncidentParamsFlow):
         parent_message_key = incident.params.parent_message_key
         settings = IntegrationSettings.create_key(incident.integration_id)  # type: IntegrationSettings
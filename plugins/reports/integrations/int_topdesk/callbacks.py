@@ -25,7 +25,7 @@ from google.appengine.ext import ndb
 import dateutil
 from framework.utils import try_or_defer, guid
 from mcfw.consts import MISSING
-from plugins.reports.bizz.elasticsearch import re_index_incident
+from plugins.reports.bizz.indexer import save_incident
 from plugins.reports.bizz.rogerthat import send_rogerthat_message
 from plugins.reports.consts import IncidentTagType
 from plugins.reports.dal import get_integration_settings, get_rogerthat_user, get_incident_by_external_id
@@ -67,8 +67,7 @@ def incident_feedback(integration_id, incident_id, message):
         if message and params.last_message != message:
             params.last_message = message
             message_lines.append(message)
-    incident.put()
-    try_or_defer(re_index_incident, incident)
+    save_incident(incident)
 
     if incident.source == 'app':
         if len(message_lines) == 1:
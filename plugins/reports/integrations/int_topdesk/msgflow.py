@@ -14,20 +14,17 @@
 # limitations under the License.
 #
 # @@license_version:1.5@@
-import json
 import logging
-import urllib
 from collections import defaultdict
 
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb, deferred
 
-from framework.plugin_loader import get_config
 from markdown import markdown
-from plugins.reports.consts import NAMESPACE
+from plugins.reports.bizz.geocoding import reverse_geocode_async
 from plugins.reports.integrations.int_topdesk.consts import TopdeskPropertyName, TopdeskFieldMappingType
-from plugins.reports.integrations.int_topdesk.topdesk import create_topdesk_person, update_topdesk_person, \
-    get_new_incident_data, upload_attachment, topdesk_api_call, get_reverse_value
+from plugins.reports.integrations.int_topdesk.topdesk import create_topdesk_person_async, \
+    update_topdesk_person_async, get_new_incident_data, upload_attachment, topdesk_api_call, get_reverse_value_async
 from plugins.reports.models import IncidentDetails, IntegrationParamsTopdesk, IdName, Incident, \
     TopdeskSettings, IntegrationSettings
 from plugins.reports.utils import get_step
@@ -44,24 +41,30 @@ def create_incident(config, rt_user, incident, steps):
     openid_step = find_step_by_type(steps, Widget.TYPE_OPENID)
     openid_result = openid_step and openid_step.form_result.result  # type: OpenIdWidgetResultTO
 
-    if not settings.unregistered_users:
-        if not rt_user.external_id:
-            rt_user.external_id = create_topdesk_person(settings, rt_user, openid_result)
-            rt_user.put()
-        elif openid_result:
-            update_topdesk_person(settings, rt_user, openid_result)
+    # The person and the reverse mapped values are looked up concurrently, the addresses while the person is saved.
+    # The incident is created once all of them are known.
+    person_future = _save_topdesk_person_async(settings, rt_user, openid_result)
+    mapping_values_future = get_field_mapping_values_async(settings, steps)
 
     attachments = []
 
     incident_details = IncidentDetails()
 
+    custom_values, included_step_ids, user_consent = mapping_values_future.get_result()
+    request_step_ids = {mapping.step_id for mapping in settings.field_mapping
+                        if mapping.property == TopdeskPropertyName.REQUEST and mapping.step_id not in included_step_ids}
+    # Only the steps that end up in the request need an address, geocoding is limited per app
+    address_futures = {}
+    for step in steps:
+        if step.step_id in request_step_ids and isinstance(step, FormFlowStepTO) and step.answer_id == FormTO.POSITIVE:
+            val = step.get_value()
+            if isinstance(val, LocationWidgetResultTO):
+                address_futures[step.step_id] = reverse_geocode_async(val.latitude, val.longitude, rt_user.app_id)
+    person_future.get_result()
     data = get_new_incident_data(settings, rt_user)
-    custom_values, included_step_ids, user_consent = get_field_mapping_values(settings, steps)
     logging.info('Updating request data with %s', custom_values)
     data.update(custom_values)
     result_text = []  # list of lines of markdown
-    request_step_ids = {mapping.step_id for mapping in settings.field_mapping
-                        if mapping.property == TopdeskPropertyName.REQUEST and mapping.step_id not in included_step_ids}
     # Populate the 'request' field and upload attachments
     for step in steps:
         if isinstance(step, FormFlowStepTO) and step.answer_id == FormTO.POSITIVE:
@@ -81,7 +84,7 @@ def create_incident(config, rt_user, incident, steps):
                 if not val:
                     continue
                 if isinstance(val, LocationWidgetResultTO):
-                    address = reverse_geocode_location(val)
+                    address = address_futures[step.step_id].get_result()
                     if address:
                         step_value = '%s\n%s' % (step.display_value, address)
                 else:
@@ -137,12 +140,26 @@ def create_incident(config, rt_user, incident, steps):
     incident.user_consent = user_consent
 
 
-def get_field_mapping_values(settings, steps):
-    # type: (TopdeskSettings, List[FlowStepTO]) -> Tuple[Dict[str, str], List[str], bool]
-    # Maps form step values to fields for a topdesk incident
+@ndb.tasklet
+def _save_topdesk_person_async(settings, rt_user, openid_result):
+    # type: (TopdeskSettings, RogerthatUser, OpenIdWidgetResultTO) -> ndb.Future
+    if settings.unregistered_users:
+        return
+    if not rt_user.external_id:
+        rt_user.external_id = yield create_topdesk_person_async(settings, rt_user, openid_result)
+        yield rt_user.put_async()
+    elif openid_result:
+        yield update_topdesk_person_async(settings, rt_user, openid_result)
+
+
+@ndb.tasklet
+def get_field_mapping_values_async(settings, steps):
+    # type: (TopdeskSettings, List[FlowStepTO]) -> ndb.Future
+    # Maps form step values to fields for a topdesk incident. Returns (custom values, included step ids, has consent)
     has_consent = False
     custom_values = defaultdict(dict)
     included_step_ids = set()
+    reverse_mappings = []
     for mapping in settings.field_mapping:
         if mapping.type == TopdeskFieldMappingType.FIXED_VALUE:
             custom_values[mapping.property][mapping.value_properties[0]] = mapping.default_value
@@ -183,33 +200,24 @@ def get_field_mapping_values(settings, steps):
                 included_step_ids.add(step.step_id)
             elif mapping.type == TopdeskFieldMappingType.REVERSE_MAPPING:
                 assert isinstance(result, unicode)
-                value_id = get_reverse_value(settings, mapping.property, result, custom_values)
-                if value_id:
-                    custom_values[mapping.property]['id'] = value_id
-                    included_step_ids.add(step.step_id)
+                reverse_mappings.append((mapping, result))
         elif isinstance(step, MessageFlowStepTO):
             if mapping.type == TopdeskFieldMappingType.PUBLIC_CONSENT:
                 has_consent = step.answer_id == mapping.property
             else:
                 custom_values[mapping.property]['id'] = step.answer_id.lstrip('button_')
             included_step_ids.add(step.step_id)
-    return custom_values, included_step_ids, has_consent
-
-
-def reverse_geocode_location(result):
-    # type: (LocationWidgetResultTO) -> str
-    url = 'https://maps.googleapis.com/maps/api/geocode/json?'
-    maps_key = get_config(NAMESPACE).google_maps_key
-    params = urllib.urlencode({'latlng': '%s,%s' % (result.latitude, result.longitude), 'key': maps_key})
-    response = urlfetch.fetch(url + params)
-    result = json.loads(response.content)
-    status = result['status']
-    if status == 'ZERO_RESULTS':
-        return None
-    elif status != 'OK':
-        logging.debug(response.content)
-        raise Exception('Error while looking up address')
-    return result.get('results', [{}])[0].get('formatted_address')
+    # The possible locations depend on the branch, so those are only looked up once the branch is known
+    other_mappings = [m for m in reverse_mappings if m[0].property != TopdeskPropertyName.LOCATION]
+    location_mappings = [m for m in reverse_mappings if m[0].property == TopdeskPropertyName.LOCATION]
+    for mappings in (other_mappings, location_mappings):
+        value_ids = yield [get_reverse_value_async(settings, mapping.property, value, custom_values)
+                           for mapping, value in mappings]
+        for (mapping, _), value_id in zip(mappings, value_ids):
+            if value_id:
+                custom_values[mapping.property]['id'] = value_id
+                included_step_ids.add(mapping.step_id)
+    raise ndb.Return((custom_values, included_step_ids, has_consent))
 
 
 def find_step_by_type(steps, type):
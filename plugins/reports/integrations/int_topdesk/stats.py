@@ -14,8 +14,12 @@
 # limitations under the License.
 #
 # @@license_version:1.5@@
+import logging
+
+from google.appengine.ext import ndb
+
 from plugins.reports.integrations.int_topdesk.consts import TopdeskPropertyName
-from plugins.reports.integrations.int_topdesk.topdesk import get_topdesk_values
+from plugins.reports.integrations.int_topdesk.topdesk import get_topdesk_metadata_async
 from plugins.reports.models import IntegrationSettings
 from plugins.reports.models.incident_statistics import IncidentTagMapping, NameValue
 
@@ -23,9 +27,22 @@ from plugins.reports.models.incident_statistics import IncidentTagMapping, NameV
 def refresh_topdesk_tags(integration_key):
     integration = integration_key.get()  # type: IntegrationSettings
     settings = integration.data
-    categories = get_topdesk_values(settings, TopdeskPropertyName.CATEGORY, {})
-    subcategories = get_topdesk_values(settings, TopdeskPropertyName.SUB_CATEGORY, {})
-    mapping = IncidentTagMapping(key=IncidentTagMapping.create_key(integration.id))
-    mapping.categories = [NameValue(id=c['id'], name=c['name']) for c in categories]
-    mapping.subcategories = [NameValue(id=c['id'], name=c['name']) for c in subcategories]
+    # Also refreshes the cached values used when creating incidents
+    futures = {prop: get_topdesk_metadata_async(settings, prop, {}, refresh=True)
+               for prop in (TopdeskPropertyName.CATEGORY, TopdeskPropertyName.SUB_CATEGORY,
+                            TopdeskPropertyName.BRANCH, TopdeskPropertyName.CALL_TYPE, TopdeskPropertyName.ENTRY_TYPE,
+                            TopdeskPropertyName.OPERATOR_GROUP)}
+    ndb.Future.wait_all(futures.values())
+    categories = [NameValue(id=c['id'], name=c['name'])
+                  for c in futures[TopdeskPropertyName.CATEGORY].get_result().values]
+    subcategories = [NameValue(id=c['id'], name=c['name'])
+                     for c in futures[TopdeskPropertyName.SUB_CATEGORY].get_result().values]
+    mapping_key = IncidentTagMapping.create_key(integration.id)
+    mapping = mapping_key.get()  # type: IncidentTagMapping
+    if mapping and mapping.categories == categories and mapping.subcategories == subcategories:
+        logging.debug('Tags of integration %s did not change', integration.id)
+        return
+    mapping = IncidentTagMapping(key=mapping_key)
+    mapping.categories = categories
+    mapping.subcategories = subcategories
     mapping.put()
@@ -16,6 +16,7 @@
 # @@license_version:1.5@@
 
 import base64
+import hashlib
 import json
 import logging
 from cStringIO import StringIO
@@ -32,6 +33,7 @@ from mcfw.cache import cached
 from mcfw.exceptions import HttpBadRequestException
 from mcfw.rpc import arguments, returns
 from plugins.reports.bizz.rogerthat import send_rogerthat_message
+from plugins.reports.consts import NAMESPACE
 from plugins.reports.dal import get_integration_settings
 from plugins.reports.integrations.int_topdesk.consts import ENDPOINTS, TopdeskPropertyName
 from plugins.reports.integrations.int_topdesk.models import TOPDeskFormConfiguration, TOPDeskCategoryMapping, \
@@ -41,11 +43,17 @@ from plugins.reports.models import TopdeskSettings, RogerthatUser, Incident, Inc
     IntegrationParamsTopdesk, IntegrationSettings, IntegrationProvider, IncidentParamsForm
 from plugins.reports.to import FormSubmissionTO, DynamicFormTO, FieldComponentTO, SingleSelectComponentValueTO, \
     BaseComponentValue, LocationComponentValueTO, FileComponentValueTO
+from plugins.reports.utils.local_cache import LocalCache
 from plugins.rogerthat_api.to import MemberTO
 from plugins.rogerthat_api.to.messaging.forms import OpenIdWidgetResultTO
 from typing import Dict, List
 from urllib3 import encode_multipart_formdata
 
+# Reference data (categories, branches, ...) rarely changes. Also refreshed daily by refresh_topdesk_tags.
+METADATA_LIFETIME = 6 * 3600  # seconds
+LOCAL_METADATA_LIFETIME = 600  # seconds
+_metadata_cache = LocalCache(200)
+
 
 class TopdeskApiException(Exception):
 
@@ -103,22 +111,34 @@ def _update_person_with_openid_data(person, openid_result):
 
 def create_topdesk_person(settings, rogerthat_user, openid_result):
     # type: (TopdeskSettings, RogerthatUser, OpenIdWidgetResultTO) -> str
+    return create_topdesk_person_async(settings, rogerthat_user, openid_result).get_result()
+
+
+@ndb.tasklet
+def create_topdesk_person_async(settings, rogerthat_user, openid_result):
+    # type: (TopdeskSettings, RogerthatUser, OpenIdWidgetResultTO) -> ndb.Future
     person = _get_person_info_from_rogerthat_user(settings, rogerthat_user)
     if openid_result:
         person = _update_person_with_openid_data(person, openid_result)
-    created_person = topdesk_api_call(settings, '/api/persons', urlfetch.POST, person)
+    created_person = yield topdesk_api_call_async(settings, '/api/persons', urlfetch.POST, person)
     logging.debug('Created topdesk person: %s', created_person)
-    return created_person['id']
+    raise ndb.Return(created_person['id'])
 
 
 def update_topdesk_person(settings, rogerthat_user, openid_result):
     # type: (TopdeskSettings, RogerthatUser, OpenIdWidgetResultTO) -> dict
+    return update_topdesk_person_async(settings, rogerthat_user, openid_result).get_result()
+
+
+@ndb.tasklet
+def update_topdesk_person_async(settings, rogerthat_user, openid_result):
+    # type: (TopdeskSettings, RogerthatUser, OpenIdWidgetResultTO) -> ndb.Future
     person = _get_person_info_from_rogerthat_user(settings, rogerthat_user)
     person = _update_person_with_openid_data(person, openid_result)
     url = '/api/persons/id/%s' % rogerthat_user.external_id
-    updated_person = topdesk_api_call(settings, url, urlfetch.PUT, person)
+    updated_person = yield topdesk_api_call_async(settings, url, urlfetch.PUT, person)
     logging.debug('Updated topdesk person: %s', updated_person)
-    return updated_person
+    raise ndb.Return(updated_person)
 
 
 def _get_headers(username, password):
@@ -132,13 +152,20 @@ def _get_headers(username, password):
 
 def topdesk_api_call(settings, path, method=urlfetch.GET, payload=None):
     # type: (TopdeskSettings, str, int, dict) -> dict
+    return topdesk_api_call_async(settings, path, method, payload).get_result()
+
+
+@ndb.tasklet
+def topdesk_api_call_async(settings, path, method=urlfetch.GET, payload=None):
+    # type: (TopdeskSettings, str, int, dict) -> ndb.Future
+    """Same as topdesk_api_call, but doesn't wait for the response. Other calls can be done in the mean time."""
     full_url = '%s%s' % (settings.api_url, path)
     headers = _get_headers(settings.username, settings.password)
-    response = urlfetch.fetch(full_url,
-                              headers=headers,
-                              payload=json.dumps(payload) if payload else None,
-                              method=method,
-                              deadline=30)  # type: urlfetch._URLFetchResult
+    response = yield ndb.get_context().urlfetch(full_url,
+                                                headers=headers,
+                                                payload=json.dumps(payload) if payload else None,
+                                                method=method,
+                                                deadline=30)  # type: urlfetch._URLFetchResult
 
     should_raise = False
     if method == urlfetch.GET and response.status_code not in (200, 204, 206,):
@@ -154,14 +181,14 @@ def topdesk_api_call(settings, path, method=urlfetch.GET, payload=None):
             logging.info('Payload: %s', payload)
         raise TopdeskApiException(response)
 
-    return json.loads(response.content) if response.content else None
+    raise ndb.Return(json.loads(response.content) if response.content else None)
 
 
-@cached(0)
+@cached(1, lifetime=METADATA_LIFETIME, request=True, memcache=True)
 @returns([dict])
 @arguments(integration_id=long, path=unicode)
 def topdesk_integration_call(integration_id, path):
-    settings = IntegrationSettings.create_key(integration_id).get()  # type: IntegrationSettings
+    settings = get_integration_settings(integration_id)
     if settings.integration != IntegrationProvider.TOPDESK:
         raise HttpBadRequestException('This integration is not a topdesk integration')
     return topdesk_api_call(settings.data, '/api' + path, urlfetch.GET)
@@ -169,23 +196,22 @@ def topdesk_integration_call(integration_id, path):
 
 def get_topdesk_data(url, username, password):
     # type: (str,str,str) -> dict
-    paths = [ENDPOINTS[prop] for prop in
-             (TopdeskPropertyName.ENTRY_TYPE, TopdeskPropertyName.CALL_TYPE, TopdeskPropertyName.CATEGORY,
-              TopdeskPropertyName.SUB_CATEGORY,
-              TopdeskPropertyName.BRANCH, TopdeskPropertyName.OPERATOR_GROUP, TopdeskPropertyName.OPERATOR)]
-    rpcs = []
-    for path in paths:
-        full_url = '%s/api%s' % (url, path)
-        headers = _get_headers(username, password)
-        rpc = urlfetch.create_rpc(20)
-        urlfetch.make_fetch_call(rpc, full_url, headers=headers)
-        rpcs.append(rpc)
-    try:
-        entry_types, call_types, categories, sub_categories, branches, operator_groups, operators = [
-            json.loads(rpc.get_result().content) if rpc.get_result().status_code == 200 else [] for rpc in rpcs]
-    except:
-        logging.debug('Failed to exec rpc to topdesk', exc_info=True)
-        raise HttpBadRequestException('%s: %s' % (rpcs[0].get_result().status_code, rpcs[0].get_result().content))
+    settings = TopdeskSettings(api_url=url, username=username, password=password)
+    # Used by the admin page, which must always show the current categories, branches, ... (and updates the cache)
+    futures = [get_topdesk_metadata_async(settings, prop, {}, refresh=True) for prop in
+               (TopdeskPropertyName.ENTRY_TYPE, TopdeskPropertyName.CALL_TYPE, TopdeskPropertyName.CATEGORY,
+                TopdeskPropertyName.SUB_CATEGORY,
+                TopdeskPropertyName.BRANCH, TopdeskPropertyName.OPERATOR_GROUP, TopdeskPropertyName.OPERATOR)]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.get_result().values)
+        except TopdeskApiException:
+            results.append([])
+        except Exception as e:
+            logging.debug('Failed to exec rpc to topdesk', exc_info=True)
+            raise HttpBadRequestException('%s' % e)
+    entry_types, call_types, categories, sub_categories, branches, operator_groups, operators = results
     return {
         'entryTypes': entry_types,
         'callTypes': call_types,
@@ -472,20 +498,72 @@ def get_new_incident_data(topdesk_settings, rt_user):
 
 
 def get_topdesk_values(settings, property_name, custom_values):
+    return get_topdesk_values_async(settings, property_name, custom_values).get_result()
+
+
+@ndb.tasklet
+def get_topdesk_values_async(settings, property_name, custom_values):
+    path = _get_values_path(settings, property_name, custom_values)
+    if not path:
+        raise ndb.Return([])
+    values = yield topdesk_api_call_async(settings, path, urlfetch.GET)
+    raise ndb.Return(values)
+
+
+def _get_values_path(settings, property_name, custom_values):
+    # type: (TopdeskSettings, str, dict) -> str
     resource = ENDPOINTS[property_name]
     query = '?'
     if property_name == TopdeskPropertyName.LOCATION:
         branch_id = custom_values.get(TopdeskPropertyName.BRANCH, {}).get('id') or settings.branch_id
         if not branch_id:
-            return []
+            return None
         query += '&branch=%s' % branch_id
-    return topdesk_api_call(settings, '/api%s%s' % (resource, query), urlfetch.GET)
-
-
-def get_reverse_value(settings, property_name, value, custom_values):
-    things = get_topdesk_values(settings, property_name, custom_values)
-    if things:
-        value = value.strip()
-        for thing in things:
-            if thing['name'] == value:
-                return thing['id']
+    return '/api%s%s' % (resource, query)
+
+
+class TopdeskMetadata(object):
+    """Values of a TOPdesk endpoint, e.g. all categories, with their ids by name"""
+
+    def __init__(self, values):
+        # type: (List[dict]) -> None
+        self.values = values
+        self.ids_by_name = {}  # type: Dict[unicode, unicode]
+        for value in values:
+            if value.get('name'):
+                self.ids_by_name.setdefault(value['name'], value['id'])
+
+
+@ndb.tasklet
+def get_topdesk_metadata_async(settings, property_name, custom_values, refresh=False):
+    # type: (TopdeskSettings, str, dict, bool) -> ndb.Future
+    """
+    Cached version of get_topdesk_values, per instance and in memcache for METADATA_LIFETIME. Returns a future with a
+    TopdeskMetadata object. With refresh=True, the values are always downloaded again.
+    """
+    path = _get_values_path(settings, property_name, custom_values)
+    if not path:
+        raise ndb.Return(TopdeskMetadata([]))
+    # Includes the credentials, other users might not have access to the same values
+    key_str = repr((settings.api_url, settings.username, settings.password, path))
+    cache_key = 'topdesk-metadata-%s' % hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+    context = ndb.get_context()
+    values = None
+    if not refresh:
+        metadata = _metadata_cache.get(cache_key)
+        if metadata:
+            raise ndb.Return(metadata)
+        values = yield context.memcache_get(cache_key, namespace=NAMESPACE)
+    if values is None:
+        values = yield topdesk_api_call_async(settings, path, urlfetch.GET)
+        values = values or []
+        yield context.memcache_set(cache_key, values, time=METADATA_LIFETIME, namespace=NAMESPACE)
+    metadata = TopdeskMetadata(values)
+    _metadata_cache.set(cache_key, metadata, LOCAL_METADATA_LIFETIME)
+    raise ndb.Return(metadata)
+
+
+@ndb.tasklet
+def get_reverse_value_async(settings, property_name, value, custom_values):
+    metadata = yield get_topdesk_metadata_async(settings, property_name, custom_values)
+    raise ndb.Return(metadata.ids_by_name.get(value.strip()))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 Green Valley NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+from google.appengine.ext import ndb
+
+from framework.bizz.job import run_job, MODE_BATCH
+from plugins.reports.bizz import invalidate_cached_votes
+from plugins.reports.bizz.indexer import mark_votes_changed
+from plugins.reports.models import IncidentVote, IncidentVoteShard
+
+
+def migrate(dry_run=True):
+    if dry_run:
+        return IncidentVote.query().count(limit=None)
+    run_job(_get_votes, [], _migrate_votes, [], mode=MODE_BATCH, batch_size=50)
+
+
+def _get_votes():
+    return IncidentVote.query()
+
+
+def _migrate_votes(vote_keys):
+    incident_ids = [vote_key.id().decode('utf8') for vote_key in vote_keys if _migrate_vote(vote_key)]
+    invalidate_cached_votes(incident_ids)
+    for incident_id in incident_ids:
+        mark_votes_changed(incident_id)
+
+
+@ndb.transactional(xg=True)
+def _migrate_vote(vote_key):
+    # The vote is removed in the same transaction, so running the migration again doesn't count it twice
+    vote = vote_key.get()  # type: IncidentVote
+    if not vote:
+        return False
+    shard_key = IncidentVoteShard.create_key(vote.incident_id, 0)
+    shard = shard_key.get() or IncidentVoteShard(key=shard_key)
+    shard.negative_count += vote.negative_count
+    shard.positive_count += vote.positive_count
+    shard.put()
+    vote_key.delete()
+    return True
@@ -17,6 +17,7 @@
 
 from __future__ import unicode_literals
 
+import calendar
 from datetime import datetime
 
 from google.appengine.ext import ndb
@@ -323,11 +324,20 @@ class Incident(NdbModel):
     status = ndb.StringProperty(choices=IncidentStatus.all())
     details = ndb.LocalStructuredProperty(IncidentDetails)  # type: IncidentDetails
     tags = ndb.StructuredProperty(IncidentTag, repeated=True)  # type: List[IncidentTag]
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
     @property
     def id(self):
         return self.key.id().decode('utf-8')
 
+    @property
+    def version(self):
+        # type: () -> long
+        # Microseconds since epoch of the last change
+        if not self.updated:
+            return None
+        return long(calendar.timegm(self.updated.timetuple())) * 1000000 + self.updated.microsecond
+
     @property
     def can_show_on_map(self):
         return all((self.user_consent, self.details.title, self.details.description, self.details.geo_location))
@@ -398,6 +408,10 @@ class Incident(NdbModel):
     def list_by_integration_id(cls, integration_id):
         return cls.query().filter(cls.integration_id == integration_id)
 
+    @classmethod
+    def list_visible(cls):
+        return cls.query().filter(cls.visible == True)
+
     @classmethod
     def get_oldest(cls):
         return cls.query().order(cls.report_date).get()
@@ -416,6 +430,144 @@ class Incident(NdbModel):
             .filter(cls.resolve_date == None)
 
 
+class IncidentIndexRequest(NdbModel):
+    """
+    Outbox for the search index: marks an incident as changed since it was last indexed. This is always saved in the
+    same transaction as the incident itself (it's in the same entity group), see bizz.indexer
+    """
+    NAMESPACE = NAMESPACE
+
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @property
+    def incident_key(self):
+        return self.key.parent()
+
+    @classmethod
+    def create_key(cls, incident_id):
+        return ndb.Key(cls, incident_id, parent=Incident.create_key(incident_id))
+
+    @classmethod
+    def list_pending(cls):
+        return cls.query().order(cls.updated)
+
+
+class IncidentCreationStep(Enum):
+    STARTED = 'started'
+    INTEGRATION_DONE = 'integration_done'  # created at the integration (topdesk, 3p, ...), only saving is left
+
+
+class IncidentCreation(NdbModel):
+    """
+    Progress of the creation of an incident, so a retried callback or task continues where the previous attempt
+    stopped instead of creating the incident again. Deleted in the same transaction that saves the incident.
+    """
+    NAMESPACE = NAMESPACE
+
+    step = ndb.StringProperty(choices=IncidentCreationStep.all(), indexed=False)
+    lease_expiration = ndb.DateTimeProperty(indexed=False)  # another attempt is busy until then
+    lease_token = ndb.StringProperty(indexed=False)  # attempt that holds the lease
+    incident = ndb.BlobProperty()  # serialized incident, as it was after the last completed step
+
+    @property
+    def incident_key(self):
+        return self.key.parent()
+
+    @classmethod
+    def create_key(cls, incident_id):
+        return ndb.Key(cls, incident_id, parent=Incident.create_key(incident_id))
+
+
+class ReindexJobStatus(Enum):
+    RUNNING = 'running'
+    FAILED = 'failed'
+    FINISHED = 'finished'
+
+
+class ReindexJob(NdbModel):
+    NAMESPACE = NAMESPACE
+
+    status = ndb.StringProperty(choices=ReindexJobStatus.all())
+    index = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    expected_count = ndb.IntegerProperty(indexed=False)  # amount of visible incidents in the datastore
+    indexed_count = ndb.IntegerProperty(indexed=False, default=0)  # amount of documents in the new index
+    # visible incidents that were processed but have no document, e.g. because they have no location
+    skipped_count = ndb.IntegerProperty(indexed=False, default=0)
+    checks_without_progress = ndb.IntegerProperty(indexed=False, default=0)
+
+    @property
+    def version(self):
+        return self.key.id()
+
+    @classmethod
+    def create_key(cls, version):
+        return ndb.Key(cls, version, namespace=NAMESPACE)
+
+    @classmethod
+    def get_running(cls):
+        return cls.query().filter(cls.status == ReindexJobStatus.RUNNING).get()
+
+    @classmethod
+    def get_latest(cls):
+        return cls.query().order(-cls.key).get()
+
+
+class MapSnapshot(NdbModel):
+    NAMESPACE = NAMESPACE
+
+    version = ndb.IntegerProperty(indexed=False, default=0)
+    file_name = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(indexed=False)
+    sync_token = ndb.StringProperty(indexed=False)  # changes after this token aren't in the snapshot yet
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @property
+    def app_id(self):
+        return self.key.id().decode('utf-8')
+
+    @classmethod
+    def create_key(cls, app_id):
+        return ndb.Key(cls, app_id, namespace=NAMESPACE)
+
+
+class GeocodedAddress(NdbModel):
+    """Result of a reverse geocoding lookup, see bizz.geocoding. The id is the rounded location, e.g. 51.0543,3.7174"""
+    NAMESPACE = NAMESPACE
+
+    address = ndb.TextProperty()  # empty when nothing was found at this location
+    expires = ndb.DateTimeProperty()
+
+    @classmethod
+    def create_key(cls, location):
+        return ndb.Key(cls, location, namespace=NAMESPACE)
+
+    @classmethod
+    def list_expired(cls, date):
+        return cls.query(cls.expires < date)
+
+
+class IndexingFailure(NdbModel):
+    """Bulk action which was refused by elasticsearch, e.g. because the document didn't match the mapping"""
+    NAMESPACE = NAMESPACE
+
+    index = ndb.StringProperty()
+    doc_id = ndb.StringProperty()
+    status = ndb.IntegerProperty(indexed=False)
+    error = ndb.JsonProperty()
+    operation = ndb.TextProperty()  # ndjson lines which were sent
+    date = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def create_key(cls, index, doc_id):
+        return ndb.Key(cls, '%s/%s' % (index, doc_id), namespace=NAMESPACE)
+
+    @classmethod
+    def list_by_index(cls, index):
+        return cls.query().filter(cls.index == index)
+
+
 class FormIntegration(NdbModel):
     NAMESPACE = NAMESPACE
     integration_id = ndb.IntegerProperty()  # IntegrationSettings id
@@ -432,6 +584,7 @@ class SaveFormIntegrationTO(TO):
 
 
 class IncidentVote(NdbModel):
+    """Total vote counts of an incident. No longer saved since votes are counted in IncidentVoteShard."""
     NAMESPACE = NAMESPACE
 
     NEGATIVE = u'negative'
@@ -449,6 +602,26 @@ class IncidentVote(NdbModel):
         return ndb.Key(cls, incident_id, namespace=cls.NAMESPACE)
 
 
+class IncidentVoteShard(NdbModel):
+    """
+    The vote counts of an incident are spread over SHARD_COUNT entities, so concurrent votes don't contend on one
+    entity group. The total is the sum of all shards, see bizz.get_incident_votes.
+    """
+    NAMESPACE = NAMESPACE
+    SHARD_COUNT = 20
+
+    negative_count = ndb.IntegerProperty(indexed=False, default=0)
+    positive_count = ndb.IntegerProperty(indexed=False, default=0)
+
+    @classmethod
+    def create_key(cls, incident_id, shard):
+        return ndb.Key(cls, '%s-%d' % (incident_id, shard), namespace=cls.NAMESPACE)
+
+    @classmethod
+    def list_keys(cls, incident_id):
+        return [cls.create_key(incident_id, shard) for shard in xrange(cls.SHARD_COUNT)]
+
+
 class UserIncidentVote(NdbModel):
     NAMESPACE = NAMESPACE
 
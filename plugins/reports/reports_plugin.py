@@ -32,7 +32,9 @@ from plugins.reports import rogerthat_callbacks
 from plugins.reports.api import map_api, reports, green_valley
 from plugins.reports.bizz.rtemail import EmailHandler
 from plugins.reports.handlers.cron import ReportsCleanupTimedOutHandler, \
-    ReportsCountIncidentsHandler, BuildIncidentStatisticsHandler
+    ReportsCountIncidentsHandler, BuildIncidentStatisticsHandler, ReportsFlushIndexRequestsHandler, \
+    ReportsSaveSeenAnnouncementsHandler, ReportsCleanupTombstonesHandler, ReportsUpdateMapSnapshotsHandler, \
+    ReportsCleanupGeocodedAddressesHandler, ReportsUpdateSearchGridHandler
 from plugins.reports.integrations import integrations_api
 from plugins.reports.integrations.int_green_valley.notifications import NotificationAttachmentHandler
 from plugins.reports.integrations.int_topdesk.handlers import TopdeskCallbackHandler
@@ -77,6 +79,12 @@ class ReportsPlugin(Plugin):
             yield Handler(url='/admin/cron/reports/cleanup/timed_out', handler=ReportsCleanupTimedOutHandler)
             yield Handler(url='/admin/cron/reports/incidents/count', handler=ReportsCountIncidentsHandler)
             yield Handler(url='/admin/cron/reports/incidents-stats', handler=BuildIncidentStatisticsHandler)
+            yield Handler(url='/admin/cron/reports/incidents/index', handler=ReportsFlushIndexRequestsHandler)
+            yield Handler(url='/admin/cron/reports/announcements/save', handler=ReportsSaveSeenAnnouncementsHandler)
+            yield Handler(url='/admin/cron/reports/incidents/tombstones', handler=ReportsCleanupTombstonesHandler)
+            yield Handler(url='/admin/cron/reports/geocoding/cleanup', handler=ReportsCleanupGeocodedAddressesHandler)
+            yield Handler(url='/admin/cron/reports/map/snapshots', handler=ReportsUpdateMapSnapshotsHandler)
+            yield Handler(url='/admin/cron/reports/search/grid', handler=ReportsUpdateSearchGridHandler)
 
     def get_modules(self):
         yield Module('integrations', [], 1)
@@ -16,6 +16,7 @@
 # @@license_version:1.5@@
 from __future__ import unicode_literals
 
+from mcfw.properties import long_list_property, long_property
 from plugins.rogerthat_api.to import PaginatedResultTO, UserDetailsTO
 from typing import List
 from .forms import *
@@ -31,6 +32,12 @@ class ReportsPluginConfiguration(TO):
     google_maps_key = unicode_property('google_maps_key')
     oca_server_secret = unicode_property('oca_server_secret')
     gv_proxies = typed_property('gv_proxies', GVProxy, True)  # type: List[GVProxy]
+    # Publicly readable bucket to which the map snapshots of every app are written, see bizz.map_snapshots
+    map_snapshot_bucket = unicode_property('map_snapshot_bucket', default=None)
+    # Reverse geocoding, see bizz.geocoding. Coordinates are rounded to this amount of decimals (4 is about 11m).
+    geocoding_precision = long_property('geocoding_precision', default=4)
+    geocoding_daily_quota = long_property('geocoding_daily_quota', default=2000)  # per app
+    geocoding_rate_limit = long_property('geocoding_rate_limit', default=60)  # per app, per minute
 
 
 class GeoPointTO(TO):
@@ -176,17 +183,83 @@ class MapItemTO(TO):
     description = unicode_property('5')
 
 
+class MapClusterStatusTO(TO):
+    status = unicode_property('status')
+    count = long_property('count')
+
+
+class MapClusterTO(TO):
+    id = unicode_property('id')  # geohash of the cell
+    coords = typed_property('coords', GeoPointTO, False)  # centroid of the incidents in the cell
+    count = long_property('count')
+    statuses = typed_property('statuses', MapClusterStatusTO, True)
+
+
 class MapItemDetailsTO(TO):
     id = unicode_property('id')
     geometry = typed_property('geometry', MapGeometryTO(), True)
     sections = typed_property('sections', MapSectionTO(), True)
 
 
+class MapItemsCompactTO(TO):
+    """
+    Columnar encoding of map items, requested with the header `X-Map-Items-Format: compact`.
+    Item i has id ids[i], icon icons[icon_indexes[i]] and title titles[i]. Coordinates are in degrees * 10^precision,
+    every coordinate except the first one is relative to the previous item. Descriptions are omitted, they can be
+    fetched via /items/detail.
+    """
+    precision = long_property('precision')
+    ids = unicode_list_property('ids', default=[])
+    lats = long_list_property('lats', default=[])
+    lons = long_list_property('lons', default=[])
+    icons = typed_property('icons', MapIconTO, True, default=[])
+    icon_indexes = long_list_property('icon_indexes', default=[])
+    titles = unicode_list_property('titles', default=[])
+
+
 class GetMapItemsResponseTO(TO):
-    cursor = unicode_property('1', default=None)
+    cursor = unicode_property('1', default=None)  # opaque, should be sent as-is to fetch the next page
     items = typed_property('2', MapItemTO, True, default=[])
     distance = long_property('3', default=0)
     top_sections = typed_property('top_sections', MapSectionTO(), True, default=[])
+    clusters = typed_property('clusters', MapClusterTO, True, default=[])
+    sync_token = unicode_property('sync_token', default=None)  # can be used with /items/sync to fetch changes
+    compact = typed_property('compact', MapItemsCompactTO, False, default=None)  # replaces items when requested
+
+
+class MapItemsQueryTO(TO):
+    # Same parameters as /items, without cursor
+    lat = float_property('lat', default=None)
+    lon = float_property('lon', default=None)
+    distance = long_property('distance', default=None)
+    status = unicode_property('status', default=None)
+    limit = long_property('limit', default=None)
+    cluster = bool_property('cluster', default=False)
+    bbox = unicode_property('bbox', default=None)
+    sort = unicode_property('sort', default=None)
+    min_votes = long_property('min_votes', default=None)
+
+
+class GetMapBatchRequestTO(TO):
+    user_id = unicode_property('user_id')
+    announcement = bool_property('announcement', default=False)
+    queries = typed_property('queries', MapItemsQueryTO, True, default=[])
+    detail_ids = unicode_list_property('detail_ids', default=[])
+
+
+class GetMapBatchResponseTO(TO):
+    announcement = typed_property('announcement', MapAnnouncementTO(), False, default=None)
+    snapshot_url = unicode_property('snapshot_url', default=None)
+    results = typed_property('results', GetMapItemsResponseTO, True, default=[])  # in the same order as the queries
+    details = typed_property('details', MapItemDetailsTO, True, default=[])
+
+
+class GetMapItemsSyncResponseTO(TO):
+    items = typed_property('items', MapItemTO, True, default=[])  # added or changed
+    removed_ids = unicode_list_property('removed_ids', default=[])
+    sync_token = unicode_property('sync_token')
+    more = bool_property('more', default=False)  # sync again immediately with the new token to get the next changes
+    reset = bool_property('reset', default=False)  # token was too old, all items should be fetched again via /items
 
 
 class GetMapItemDetailsResponseTO(TO):
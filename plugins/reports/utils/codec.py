@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Faster replacement for mcfw's serialize_complex_value and parse_complex_value for TOs that are (de)serialized a lot,
+e.g. the map items. The generic functions look up the properties of every object they process, a codec looks them up
+once per TO class.
+
+Anything the codecs don't handle themselves (object factories, values of an unexpected type, missing values, subclass
+instances) is passed to the generic functions, so the results are always the same.
+"""
+import logging
+import threading
+
+from mcfw.consts import MISSING
+from mcfw.properties import object_factory
+from mcfw.rpc import serialize_complex_value, parse_complex_value
+
+_SIMPLE_TYPES = {
+    unicode: (unicode,),
+    bool: (bool,),
+    float: (float,),
+    long: (int, long),
+    int: (int, long),
+}
+
+
+class _Field(object):
+    __slots__ = ('attr', 'key', 'type', 'list', 'codec', 'allowed_types')
+
+    def __init__(self, attr, prop):
+        self.attr = attr
+        self.key = prop.name
+        self.type = prop.type
+        self.list = prop.list
+        self.codec = None  # type: TOCodec
+        self.allowed_types = None
+        if prop.type in _SIMPLE_TYPES:
+            self.allowed_types = _SIMPLE_TYPES[prop.type]
+        elif isinstance(prop.type, type):
+            self.codec = get_codec(prop.type)
+        elif not isinstance(prop.type, object_factory):
+            raise ValueError('Unsupported type %s for property %s' % (prop.type, attr))
+
+
+class TOCodec(object):
+
+    def __init__(self, to_type):
+        self.to_type = to_type
+        self.fields = None  # type: list[_Field]
+
+    def compile(self):
+        properties = {}
+        for klass in reversed(self.to_type.__mro__):
+            for attr, prop in klass.__dict__.iteritems():
+                # mcfw properties, not other descriptors such as __dict__ and __weakref__
+                if _is_property(prop):
+                    properties[attr] = prop
+        if not properties:
+            raise ValueError('%s has no properties' % self.to_type)
+        self.fields = [_Field(attr, prop) for attr, prop in sorted(properties.iteritems())]
+
+    def encode(self, obj):
+        if obj is None:
+            return None
+        if obj.__class__ is not self.to_type:
+            return serialize_complex_value(obj, self.to_type, False)
+        result = {}
+        for field in self.fields:
+            value = getattr(obj, field.attr)
+            if value is MISSING:
+                return serialize_complex_value(obj, self.to_type, False)
+            if value is not None:
+                if field.codec:
+                    value = [field.codec.encode(v) for v in value] if field.list else field.codec.encode(value)
+                elif field.allowed_types:
+                    value = list(value) if field.list else value
+                else:
+                    value = serialize_complex_value(value, field.type, field.list)
+            result[field.key] = value
+        return result
+
+    def decode(self, data):
+        if data is None:
+            return None
+        obj = self.to_type()
+        for field in self.fields:
+            if field.key not in data:
+                continue
+            value = data[field.key]
+            if value is not None:
+                if field.codec:
+                    value = [field.codec.decode(v) for v in value] if field.list else field.codec.decode(value)
+                elif field.allowed_types:
+                    if not _has_type(value, field.allowed_types, field.list):
+                        return parse_complex_value(self.to_type, data, False)
+                    value = list(value) if field.list else value
+                else:
+                    value = parse_complex_value(field.type, value, field.list)
+            setattr(obj, field.attr, value)
+        return obj
+
+
+def _is_property(value):
+    return hasattr(value, '__get__') and hasattr(value, '__set__') \
+           and all(hasattr(value, attr) for attr in ('name', 'type', 'list'))
+
+
+def _has_type(value, allowed_types, is_list):
+    # bool is a subclass of int, so compare the exact types
+    if is_list:
+        return isinstance(value, list) and all(v.__class__ in allowed_types for v in value)
+    return value.__class__ in allowed_types
+
+
+_codecs = {}  # None for TOs that can't be compiled
+_compiling = {}
+_lock = threading.RLock()
+
+
+def get_codec(to_type):
+    # type: (type) -> TOCodec
+    try:
+        return _codecs[to_type]
+    except KeyError:
+        pass
+    with _lock:
+        if to_type in _codecs:
+            return _codecs[to_type]
+        if to_type in _compiling:
+            # TO which (indirectly) contains itself
+            return _compiling[to_type]
+        codec = _compiling[to_type] = TOCodec(to_type)
+        try:
+            codec.compile()
+        except Exception:
+            logging.exception('Could not compile codec for %s, using the generic functions instead', to_type)
+            codec = None
+        finally:
+            del _compiling[to_type]
+        _codecs[to_type] = codec
+        return codec
+
+
+def serialize(value, to_type, is_list):
+    """Same as mcfw.rpc.serialize_complex_value(value, to_type, is_list)"""
+    codec = get_codec(to_type) if isinstance(to_type, type) else None
+    if not codec:
+        return serialize_complex_value(value, to_type, is_list)
+    if is_list:
+        return None if value is None else [codec.encode(v) for v in value]
+    return codec.encode(value)
+
+
+def parse(to_type, value, is_list):
+    """Same as mcfw.rpc.parse_complex_value(to_type, value, is_list)"""
+    codec = get_codec(to_type) if isinstance(to_type, type) else None
+    if not codec:
+        return parse_complex_value(to_type, value, is_list)
+    if is_list:
+        return None if value is None else [codec.decode(v) for v in value]
+    return codec.decode(value)
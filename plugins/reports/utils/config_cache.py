@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Read-through cache for configuration entities that are needed on (almost) every request, e.g. the consumer of every
+REST call. Entities are cached per instance and in memcache.
+
+Every kind has a version number in memcache which is part of the cache keys and is incremented by invalidate().
+Instances check the version at most every VERSION_CHECK_INTERVAL seconds, so other instances can keep using the
+previous configuration for that long.
+Kinds that are only edited in the datastore viewer, so nothing invalidates them, should be read with a short lifetime.
+
+Cached entities are shared between requests and must not be modified, get them from the datastore to update them.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from plugins.reports.consts import NAMESPACE
+from plugins.reports.utils.local_cache import LocalCache
+from typing import Dict
+
+VERSION_CHECK_INTERVAL = 10  # seconds
+LOCAL_CACHE_SIZE = 500  # entities per kind
+MEMCACHE_LIFETIME = 24 * 3600  # seconds
+_NOT_FOUND = ''  # cached value for entities that don't exist
+_MISSING = object()
+
+
+class ConfigCache(object):
+
+    def __init__(self, kind, lifetime=MEMCACHE_LIFETIME):
+        self.kind = kind
+        self.lifetime = lifetime
+        self._lock = threading.Lock()
+        self._entities = LocalCache(LOCAL_CACHE_SIZE)
+        self._version = None
+        self._version_expiration = 0
+        self.hits = defaultdict(int)  # per tier: local, memcache, datastore
+
+    @property
+    def _version_key(self):
+        return 'config-version-%s' % self.kind
+
+    def _get_version(self):
+        now = time.time()
+        if now < self._version_expiration:
+            return self._version
+        version = memcache.get(self._version_key, namespace=NAMESPACE)
+        if version is None:
+            # Not 0: after an eviction, entities of the previous versions might still be in memcache
+            version = long(now * 1000)
+            if not memcache.add(self._version_key, version, namespace=NAMESPACE):
+                version = memcache.get(self._version_key, namespace=NAMESPACE) or version
+        with self._lock:
+            if version != self._version:
+                self._entities.clear()
+                self._version = version
+            self._version_expiration = now + VERSION_CHECK_INTERVAL
+        return version
+
+    def get(self, key):
+        # type: (ndb.Key) -> ndb.Model
+        version = self._get_version()
+        entity = self._entities.get(key, _MISSING)
+        if entity is not _MISSING:
+            self.hits['local'] += 1
+            return entity
+        cache_key = 'config-%s-%s' % (version, key.urlsafe())
+        serialized = memcache.get(cache_key, namespace=NAMESPACE)
+        if serialized is not None:
+            self.hits['memcache'] += 1
+            entity = ndb.model_from_protobuf(entity_pb.EntityProto(serialized)) if serialized else None
+        else:
+            self.hits['datastore'] += 1
+            entity = key.get()
+            serialized = ndb.model_to_protobuf(entity).Encode() if entity else _NOT_FOUND
+            memcache.set(cache_key, serialized, time=self.lifetime, namespace=NAMESPACE)
+        with self._lock:
+            if version == self._version:
+                self._entities.set(key, entity, self.lifetime)
+        return entity
+
+    def invalidate(self):
+        memcache.incr(self._version_key, namespace=NAMESPACE, initial_value=long(time.time() * 1000))
+        with self._lock:
+            self._entities.clear()
+            self._version_expiration = 0
+
+    def get_stats(self):
+        # type: () -> dict
+        stats = dict(self.hits)
+        total = sum(self.hits.itervalues())
+        stats['hit_rate'] = float(total - self.hits['datastore']) / total if total else None
+        return stats
+
+
+_caches = {}  # type: Dict[str, ConfigCache]
+_caches_lock = threading.Lock()
+
+
+def _get_cache(kind, lifetime=MEMCACHE_LIFETIME):
+    # type: (str, int) -> ConfigCache
+    cache = _caches.get(kind)
+    if not cache:
+        with _caches_lock:
+            cache = _caches.setdefault(kind, ConfigCache(kind, lifetime))
+    return cache
+
+
+def get_cached(key, lifetime=MEMCACHE_LIFETIME):
+    # type: (ndb.Key, int) -> ndb.Model
+    """Same as key.get(), but cached for at most `lifetime` seconds (per kind). Don't modify the result."""
+    return _get_cache(key.kind(), lifetime).get(key)
+
+
+def invalidate_cached(*model_classes):
+    """Should be called after saving entities of these models"""
+    for model_class in model_classes:
+        _get_cache(model_class._get_kind()).invalidate()
+
+
+def get_cache_stats():
+    # type: () -> Dict[str, dict]
+    """Amount of hits per tier and the hit rate (not from the datastore) per kind, for this instance"""
+    return {kind: cache.get_stats() for kind, cache in _caches.items()}
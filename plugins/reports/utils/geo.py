@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+import math
+from collections import namedtuple
+
+from typing import Tuple
+
+EARTH_RADIUS = 6371008.8  # meters, same value as elasticsearch
+
+
+def get_distance(lat1, lon1, lat2, lon2):
+    # type: (float, float, float, float) -> float
+    """Haversine distance in meters"""
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class BoundingBox(namedtuple('BoundingBox', ['top', 'left', 'bottom', 'right'])):
+
+    @classmethod
+    def from_string(cls, value):
+        # type: (unicode) -> BoundingBox
+        """Parses 'top,left,bottom,right', raises ValueError when invalid"""
+        parts = [float(part) for part in value.split(',')]
+        if len(parts) != 4:
+            raise ValueError('Expected 4 coordinates: %s' % value)
+        box = cls(*parts)
+        if not -90 <= box.bottom <= box.top <= 90 or not -180 <= box.left <= 180 or not -180 <= box.right <= 180:
+            raise ValueError('Invalid bounding box: %s' % value)
+        return box
+
+    @property
+    def center(self):
+        # type: () -> Tuple[float, float]
+        right = self.right if self.right >= self.left else self.right + 360  # crosses the antimeridian
+        lon = (self.left + right) / 2
+        return (self.top + self.bottom) / 2, lon - 360 if lon > 180 else lon
+
+    @property
+    def radius(self):
+        # type: () -> float
+        """Distance in meters from the center to the corners"""
+        lat, lon = self.center
+        return get_distance(lat, lon, self.top, self.left)
+
+    def contains(self, lat, lon):
+        # type: (float, float) -> bool
+        if not self.bottom <= lat <= self.top:
+            return False
+        if self.left <= self.right:
+            return self.left <= lon <= self.right
+        return lon >= self.left or lon <= self.right
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+from typing import Tuple, List
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Approximate width in meters of a cell at the equator, per precision
+CELL_WIDTH = {
+    1: 5009400,
+    2: 1252300,
+    3: 156500,
+    4: 39100,
+    5: 4900,
+    6: 1200,
+    7: 153,
+    8: 38,
+}
+
+
+def encode(lat, lon, precision):
+    # type: (float, float, int) -> unicode
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    result = []
+    bit = 0
+    char = 0
+    even = True
+    while len(result) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            char = (char << 1) | 1
+            rng[0] = mid
+        else:
+            char <<= 1
+            rng[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            result.append(BASE32[char])
+            bit = 0
+            char = 0
+    return u''.join(result)
+
+
+def decode_bounds(geohash):
+    # type: (unicode) -> Tuple[float, float, float, float]
+    """Returns min_lat, max_lat, min_lon, max_lon of the cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in xrange(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def decode(geohash):
+    # type: (unicode) -> Tuple[float, float]
+    """Returns the center of the cell"""
+    min_lat, max_lat, min_lon, max_lon = decode_bounds(geohash)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+def neighbours(geohash):
+    # type: (unicode) -> List[unicode]
+    """Returns the cell itself and the 8 cells around it"""
+    min_lat, max_lat, min_lon, max_lon = decode_bounds(geohash)
+    height = max_lat - min_lat
+    width = max_lon - min_lon
+    lat, lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    cells = []
+    for lat_offset in (-1, 0, 1):
+        neighbour_lat = lat + lat_offset * height
+        if not -90 < neighbour_lat < 90:
+            continue
+        for lon_offset in (-1, 0, 1):
+            neighbour_lon = (lon + lon_offset * width + 180) % 360 - 180
+            cell = encode(neighbour_lat, neighbour_lon, len(geohash))
+            if cell not in cells:
+                cells.append(cell)
+    return cells
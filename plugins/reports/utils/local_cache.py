@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    Thread safe LRU cache with expiration, per instance. Values are shared between requests and must not be modified.
+    """
+
+    def __init__(self, max_size):
+        # type: (int) -> None
+        self._max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns default when the key isn't cached or expired, so None can be cached as well"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if not item or item[0] < time.time():
+                return default
+            self._data[key] = item
+            return item[1]
+
+    def set(self, key, value, lifetime):
+        # type: (object, object, float) -> None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + lifetime, value)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -1,10 +1,31 @@
+import json
+import os
+import threading
 import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 
 from mcfw.properties import object_factory
-from mcfw.rpc import parse_complex_value
+from mcfw.rpc import parse_complex_value, serialize_complex_value
+from plugins.reports.bizz.elasticsearch import ElasticsearchClient, MapSearch
 from plugins.reports.bizz.gcs import upload_to_gcs
+from plugins.reports.bizz.geocoding import FakeGeocoder, set_geocoder, _reverse_geocode_async
+from plugins.reports.bizz.incidents import _create_incident_once, get_incident_id, IncidentCreationInProgressException
 from plugins.reports.bizz.int_3p import create_incident_xml
-from plugins.reports.models import RogerthatUser
+from plugins.reports.bizz.map import encode_compact_items, _filter_items
+from plugins.reports.bizz.search import GridBackend, update_grid_snapshot
+from plugins.reports.bizz.search_cache import cached_search
+from plugins.reports.integrations.int_topdesk.topdesk import TopdeskMetadata
+from plugins.reports.consts import MapItemsSort
+from plugins.reports.models import RogerthatUser, ElasticsearchSettings, IntegrationSettings, Incident, \
+    IncidentStatus, IncidentDetails, Consumer, GeocodedAddress, IncidentCreation, IncidentCreationStep
+from plugins.reports.to import MapItemTO, GeoPointTO, MapIconTO, GetMapItemsResponseTO, MapClusterTO, \
+    MapClusterStatusTO, ReportsPluginConfiguration, MapItemDetailsTO, TextSectionTO
+from plugins.reports.utils import codec
+from plugins.reports.utils.config_cache import get_cached, invalidate_cached, get_cache_stats
+from plugins.reports.utils.geo import BoundingBox
 from plugins.rogerthat_api.to.messaging.flow import FLOW_STEP_MAPPING
 
 
@@ -24,6 +45,7 @@ class Test(unittest.TestCase):
         self.testbed.init_files_stub()
         self.testbed.init_memcache_stub()
         self.testbed.init_urlfetch_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', 'plugins'))
 
     def setup_rt_user(self):
         email = u'john.doe@example.com'
@@ -146,6 +168,232 @@ class Test(unittest.TestCase):
 
         upload_to_gcs(xml_content, u'text/xml', u'/%s/reports/%s.xml' % (gcs_bucket_name, incident_id))
 
+    def test_elasticsearch_client_retries(self):
+        self.setup()
+        responses = [(503, {}), (429, {}), (200, {'acknowledged': True})]
+        requests = []
+
+        class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                requests.append((self.path, self.headers.get('Authorization')))
+                status_code, body = responses.pop(0)
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(body))
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('localhost', 0), FakeElasticsearchHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            ElasticsearchSettings(key=ElasticsearchSettings.create_key(),
+                                  base_url=u'http://localhost:%d' % server.server_port,
+                                  auth_username=u'user',
+                                  auth_password=u'password').put()
+            client = ElasticsearchClient()
+            result = client.request('/reports', urlfetch.PUT, {'mappings': {}}, max_retries=2)
+            self.assertEqual({'acknowledged': True}, result)
+            self.assertEqual(3, len(requests))
+            self.assertTrue(all(auth == 'Basic dXNlcjpwYXNzd29yZA==' for _, auth in requests))
+        finally:
+            server.shutdown()
+
+    def test_grid_search_backend(self):
+        self.setup()
+        IntegrationSettings(key=IntegrationSettings.create_key(1), app_id=u'rogerthat').put()
+        locations = [(u'a', 51.0, 3.0), (u'b', 51.001, 3.0), (u'c', 51.002, 3.0), (u'far', 52.0, 3.0)]
+        for incident_id, lat, lon in locations:
+            Incident(key=Incident.create_key(incident_id),
+                     visible=True,
+                     integration_id=1,
+                     status=IncidentStatus.NEW,
+                     details=IncidentDetails(title=u'title', description=u'description',
+                                             geo_location=ndb.GeoPt(lat, lon))).put()
+        backend = GridBackend()
+        self.assertEqual([], backend.get_index().entries)
+        update_grid_snapshot()
+        backend.invalidate()
+        items, cursor = backend.search(51.0, 3.0, 1000, IncidentStatus.NEW, None, 2, u'rogerthat')
+        self.assertEqual([u'a', u'b'], [item.id for item in items])
+        self.assertIsNotNone(cursor)
+        items, cursor = backend.search(51.0, 3.0, 1000, IncidentStatus.NEW, cursor, 2, u'rogerthat')
+        self.assertEqual([u'c'], [item.id for item in items])
+        self.assertIsNone(cursor)
+        items, _ = backend.search(51.0, 3.0, 1000, IncidentStatus.NEW, None, 10, u'other-app')
+        self.assertEqual([], items)
+        searches = [MapSearch(51.0, 3.0, 1000, IncidentStatus.NEW, 2, None, MapItemsSort.DISTANCE, None, False),
+                    MapSearch(52.0, 3.0, 1000, None, 10, None, MapItemsSort.DISTANCE, None, False)]
+        results = backend.multi_search(searches, u'rogerthat')
+        self.assertEqual([[u'a', u'b'], [u'far']], [[item.id for item in items] for items, _ in results])
+
+    def test_encode_compact_items(self):
+        new_icon = MapIconTO(id=u'new', color=u'#f10812')
+        items = [MapItemTO(id=u'a', coords=GeoPointTO(lat=51.0, lon=3.7), icon=new_icon, title=u'A', description=u'x'),
+                 MapItemTO(id=u'b', coords=GeoPointTO(lat=51.000123, lon=3.699999),
+                           icon=MapIconTO(id=u'resolved', color=u'#a4c14d'), title=u'B', description=u'y'),
+                 MapItemTO(id=u'c', coords=GeoPointTO(lat=50.9, lon=3.7), icon=new_icon, title=u'C', description=u'z')]
+        compact = encode_compact_items(items)
+        self.assertEqual([u'a', u'b', u'c'], compact.ids)
+        self.assertEqual([51000000, 123, -100123], compact.lats)
+        self.assertEqual([3700000, -1, 1], compact.lons)
+        self.assertEqual([u'new', u'resolved'], [icon.id for icon in compact.icons])
+        self.assertEqual([0, 1, 0], compact.icon_indexes)
+        self.assertEqual([u'A', u'B', u'C'], compact.titles)
+
+    def test_cached_bbox_search(self):
+        self.setup()
+        searches = []
+
+        def search(lat, lon, distance, bbox):
+            searches.append(bbox)
+            return GetMapItemsResponseTO(items=[])
+
+        bbox = BoundingBox(51.06, 3.70, 51.04, 3.74)
+        cached_search(10.0, 10.0, 5, (), search, GetMapItemsResponseTO, bbox)
+        # Slightly panned: rounded to the same box, the location of the user doesn't matter
+        cached_search(51.0, 3.0, 5, (), search, GetMapItemsResponseTO, BoundingBox(51.0601, 3.7001, 51.0401, 3.7401))
+        self.assertEqual(1, len(searches))
+        snapped = searches[0]
+        self.assertTrue(snapped.top >= bbox.top and snapped.left <= bbox.left)
+        self.assertTrue(snapped.bottom <= bbox.bottom and snapped.right >= bbox.right)
+
+        icon = MapIconTO(id=u'new', color=u'#f10812')
+        items = [MapItemTO(id=u'outside', coords=GeoPointTO(lat=51.07, lon=3.72), icon=icon),
+                 MapItemTO(id=u'far', coords=GeoPointTO(lat=51.05, lon=3.71), icon=icon),
+                 MapItemTO(id=u'near', coords=GeoPointTO(lat=51.05, lon=3.73), icon=icon)]
+        filtered = _filter_items(items, 51.05, 3.735, 2000, bbox, MapItemsSort.DISTANCE)
+        self.assertEqual([u'near', u'far'], [item.id for item in filtered])
+
+    def test_codec_equivalence(self):
+        for to_type in (MapItemTO, GetMapItemsResponseTO, MapItemDetailsTO):
+            self.assertIsNotNone(codec.get_codec(to_type))
+        item = MapItemTO(id=u'a', coords=GeoPointTO(lat=51.0, lon=3.7), icon=MapIconTO(id=u'new', color=u'#f10812'),
+                         title=u'A', description=None)
+        response = GetMapItemsResponseTO(cursor=u'cursor', items=[item, item], distance=1000,
+                                         top_sections=[TextSectionTO(title=u'title', description=u'description')],
+                                         clusters=[MapClusterTO(id=u'u155', coords=GeoPointTO(lat=51.1, lon=3.8),
+                                                                count=2,
+                                                                statuses=[MapClusterStatusTO(status=u'new', count=2)])],
+                                         sync_token=None, compact=encode_compact_items([item]))
+        details = MapItemDetailsTO(id=u'a', geometry=[], sections=[TextSectionTO(title=u't', description=u'd')])
+        for value, to_type in ((response, GetMapItemsResponseTO), (details, MapItemDetailsTO)):
+            serialized = serialize_complex_value(value, to_type, False)
+            self.assertEqual(serialized, codec.serialize(value, to_type, False))
+            self.assertEqual(serialized, serialize_complex_value(codec.parse(to_type, serialized, False), to_type,
+                                                                 False))
+        self.assertEqual(serialize_complex_value([item], MapItemTO, True), codec.serialize([item], MapItemTO, True))
+        # Unexpected types (an int instead of a float) are handled by mcfw
+        data = {u'1': 51, u'2': 3.7}
+        self.assertEqual(serialize_complex_value(parse_complex_value(GeoPointTO, data, False), GeoPointTO, False),
+                         serialize_complex_value(codec.parse(GeoPointTO, data, False), GeoPointTO, False))
+
+    def test_config_cache(self):
+        self.setup()
+        key = Consumer.create_key(u'consumer-key')
+        self.assertIsNone(get_cached(key))
+        Consumer(key=key, ref=u'first', integration_id=1).put()
+        invalidate_cached(Consumer)
+        self.assertEqual(u'first', get_cached(key).ref)
+        Consumer(key=key, ref=u'second', integration_id=1).put()
+        self.assertEqual(u'first', get_cached(key).ref)
+        invalidate_cached(Consumer)
+        self.assertEqual(u'second', get_cached(key).ref)
+        stats = get_cache_stats()[Consumer._get_kind()]
+        self.assertEqual(1, stats['local'])
+        self.assertEqual(3, stats['datastore'])
+
+    def test_reverse_geocoding_cache(self):
+        self.setup()
+        geocoder = FakeGeocoder({(51.0543, 3.7174): u'Korenmarkt, 9000 Gent'})
+        set_geocoder(geocoder)
+        config = ReportsPluginConfiguration(geocoding_precision=4, geocoding_daily_quota=3, geocoding_rate_limit=10)
+        address = _reverse_geocode_async(51.05432, 3.71738, 'app', config).get_result()
+        self.assertEqual(u'Korenmarkt, 9000 Gent', address)
+        address = _reverse_geocode_async(51.05429, 3.71741, 'app', config).get_result()
+        self.assertEqual(u'Korenmarkt, 9000 Gent', address)
+        self.assertEqual(1, len(geocoder.requests))
+        self.assertIsNotNone(GeocodedAddress.create_key(u'51.0543,3.7174').get())
+
+        # Nothing found is cached as well
+        self.assertIsNone(_reverse_geocode_async(50.0, 4.0, 'app', config).get_result())
+        set_geocoder(geocoder)  # clears the local cache, the result is still in memcache
+        self.assertIsNone(_reverse_geocode_async(50.0, 4.0, 'app', config).get_result())
+        self.assertEqual(2, len(geocoder.requests))
+
+        # Daily quota
+        self.assertIsNone(_reverse_geocode_async(50.1, 4.0, 'app', config).get_result())
+        self.assertIsNone(_reverse_geocode_async(50.2, 4.0, 'app', config).get_result())
+        self.assertEqual(3, len(geocoder.requests))
+        self.assertIsNone(_reverse_geocode_async(50.2, 4.0, 'other-app', config).get_result())
+        self.assertEqual(4, len(geocoder.requests))
+
+        # Failures don't prevent creating the incident, it just has no address
+        class InvalidResponseGeocoder(FakeGeocoder):
+            @ndb.tasklet
+            def reverse_geocode_async(self, lat, lon):
+                raise ValueError('No JSON object could be decoded')
+
+        set_geocoder(InvalidResponseGeocoder())
+        self.assertIsNone(_reverse_geocode_async(50.3, 4.0, 'other-app', config).get_result())
+
+    def test_topdesk_metadata(self):
+        metadata = TopdeskMetadata([{'id': 'id-1', 'name': 'Wegen'},
+                                    {'id': 'id-2', 'name': 'Groen'},
+                                    {'id': 'id-3', 'name': 'Wegen'},
+                                    {'id': 'id-4', 'dynamicName': 'Operator'}])
+        self.assertEqual({'Wegen': 'id-1', 'Groen': 'id-2'}, metadata.ids_by_name)
+        self.assertEqual(4, len(metadata.values))
+
+    def test_create_incident_once(self):
+        self.setup()
+        incident_id = get_incident_id(u'flow', u'parent-message-key')
+        self.assertEqual(incident_id, get_incident_id(u'flow', u'parent-message-key'))
+        calls = []
+
+        def create(fail=False):
+            calls.append(incident_id)
+            if fail:
+                raise Exception('Integration unavailable')
+            incident.external_id = u'M 2010 001'
+            incident.details = IncidentDetails(title=u'Pothole')
+            return True
+
+        incident = Incident(key=Incident.create_key(incident_id))
+        self.assertRaises(Exception, _create_incident_once, incident, lambda: create(fail=True))
+        self.assertIsNotNone(IncidentCreation.create_key(incident_id).get())
+
+        incident = Incident(key=Incident.create_key(incident_id))
+        self.assertEqual(u'M 2010 001', _create_incident_once(incident, create).external_id)
+        self.assertIsNone(IncidentCreation.create_key(incident_id).get())
+
+        # Retries don't create the incident again
+        incident = Incident(key=Incident.create_key(incident_id))
+        self.assertEqual(u'M 2010 001', _create_incident_once(incident, create).external_id)
+        self.assertEqual(2, len(calls))
+
+    def test_create_incident_lease_taken_over(self):
+        self.setup()
+        incident_id = get_incident_id(u'flow', u'slow-message-key')
+        creation_key = IncidentCreation.create_key(incident_id)
+
+        def create():
+            # The lease expired and another attempt took over while the integration was slow
+            creation = creation_key.get()
+            creation.lease_token = u'other-attempt'
+            creation.put()
+            return True
+
+        incident = Incident(key=Incident.create_key(incident_id))
+        self.assertRaises(IncidentCreationInProgressException, _create_incident_once, incident, create)
+        creation = creation_key.get()
+        self.assertEqual(u'other-attempt', creation.lease_token)
+        self.assertEqual(IncidentCreationStep.STARTED, creation.step)
+        self.assertIsNone(Incident.create_key(incident_id).get())
+
 
 if __name__ == '__main__':
     unittest.main()
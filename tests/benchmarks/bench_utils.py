@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Helpers for the benchmark scripts in this folder. They aren't part of the unit tests, run them one by one from the
+server repo with the same PYTHONPATH as run_unit_tests.sh, e.g.
+
+    python2 ../plugin-reports/tests/benchmarks/benchmark_codecs.py
+"""
+import os
+import random
+import time
+
+from typing import Callable, List
+
+WORDS = [u'straat', u'put', u'lamp', u'kapot', u'afval', u'gevaarlijk', u'fietspad', u'boom', u'riool', u'verstopt',
+         u'graffiti', u'voetpad', u'verlichting', u'bord', u'zwerfvuil']
+
+
+def setup_testbed():
+    # Same stubs as tests.Test.setup
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_app_identity_stub()
+    bed.init_blobstore_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_files_stub()
+    bed.init_memcache_stub()
+    bed.init_urlfetch_stub()
+    bed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+    return bed
+
+
+def measure(func, repeat=5, number=1):
+    # type: (Callable[[], object], int, int) -> float
+    """Seconds per call of the fastest of `repeat` runs"""
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        timings.append((time.time() - start) / number)
+    return min(timings)
+
+
+def random_text(word_count):
+    # type: (int) -> unicode
+    return u' '.join(random.choice(WORDS) for _ in xrange(word_count))
+
+
+def print_table(headers, rows):
+    # type: (List[str], List[list]) -> None
+    rows = [[_format(value) for value in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+    print '  '.join(header.ljust(width) for header, width in zip(headers, widths))
+    for row in rows:
+        print '  '.join(value.ljust(width) for value, width in zip(row, widths))
+    print
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return unicode(value)
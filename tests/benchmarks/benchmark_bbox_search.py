@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Searching the viewport of a map with a bounding box against searching the circle around it, on a dense dataset.
+
+A circle that contains a portrait phone screen covers almost twice its area, so radius searches return and transfer
+incidents the user can't see. The searches are executed with the in-memory GridIndex of the fallback search backend,
+which filters and sorts the same way as elasticsearch.
+"""
+import argparse
+import json
+import random
+
+from bench_utils import measure, random_text, print_table
+from plugins.reports.bizz import convert_hit_to_item_to
+from plugins.reports.bizz.search import GridIndex, GridEntry
+from plugins.reports.models import IncidentStatus
+from plugins.reports.to import GetMapItemsResponseTO
+from plugins.reports.utils import codec
+from plugins.reports.utils.geo import BoundingBox
+from typing import Tuple
+
+CENTER = (51.0543, 3.7174)
+AREA_SIZE = 0.2  # degrees, about 22 by 14 km
+APP_ID = u'rogerthat'
+
+
+def _create_index(incident_count):
+    # type: (int) -> Tuple[GridIndex, dict]
+    entries = []
+    sources = {}
+    statuses = [IncidentStatus.NEW, IncidentStatus.IN_PROGRESS, IncidentStatus.RESOLVED]
+    for i in xrange(incident_count):
+        entry = GridEntry(u'incident-%d' % i,
+                          CENTER[0] + random.uniform(-AREA_SIZE / 2, AREA_SIZE / 2),
+                          CENTER[1] + random.uniform(-AREA_SIZE / 2, AREA_SIZE / 2),
+                          random.choice(statuses), APP_ID)
+        entries.append(entry)
+        sources[entry.id] = {'location': {'lat': entry.lat, 'lon': entry.lon}, 'status': entry.status,
+                             'title': random_text(4), 'description': random_text(30)}
+    return GridIndex(entries), sources
+
+
+def _get_response_size(results, sources, limit):
+    items = [convert_hit_to_item_to(entry.id, sources[entry.id]) for _, entry in results[:limit]]
+    response = GetMapItemsResponseTO(items=items)
+    return len(json.dumps(codec.serialize(response, GetMapItemsResponseTO, False), separators=(',', ':')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--incidents', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--viewports', type=float, nargs='+', default=[500, 1000, 2000, 4000],
+                        help='widths of the viewport in meters, the height is 16/9 of the width')
+    args = parser.parse_args()
+
+    random.seed(42)
+    index, sources = _create_index(args.incidents)
+    rows = []
+    for width in args.viewports:
+        lat_delta = width * 16 / 9 / 2 / 111320.0
+        lon_delta = width / 2 / 70000.0  # meters per degree of longitude at this latitude
+        bbox = BoundingBox(CENTER[0] + lat_delta, CENTER[1] - lon_delta, CENTER[0] - lat_delta, CENTER[1] + lon_delta)
+        lat, lon = bbox.center
+        radius = int(bbox.radius) + 1
+        modes = [('radius', lambda: index.search(lat, lon, radius, None, APP_ID)),
+                 ('bbox', lambda: index.search(lat, lon, None, None, APP_ID, bbox))]
+        for mode, search in modes:
+            results = search()
+            rows.append([width, mode, len(results), measure(search) * 1000,
+                         _get_response_size(results, sources, args.limit)])
+    print_table(['viewport (m)', 'mode', 'matches', 'search (ms)', 'first page (bytes)'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+The precompiled codecs of utils.codec against mcfw's serialize_complex_value and parse_complex_value, for the payloads
+of the hot endpoints: an /items response and a form submission callback.
+"""
+import argparse
+import random
+
+from bench_utils import measure, random_text, print_table
+from mcfw.rpc import serialize_complex_value, parse_complex_value
+from plugins.reports.bizz import convert_hit_to_item_to
+from plugins.reports.models import IncidentStatus
+from plugins.reports.to import GetMapItemsResponseTO, FormSubmittedCallback
+from plugins.reports.to.forms.enums import FormComponentType
+from plugins.reports.utils import codec
+
+
+def _create_items_response(count):
+    statuses = [IncidentStatus.NEW, IncidentStatus.IN_PROGRESS, IncidentStatus.RESOLVED]
+    return GetMapItemsResponseTO(items=[convert_hit_to_item_to(u'incident-%d' % i, {
+        'location': {'lat': 51.0543 + random.uniform(-0.05, 0.05), 'lon': 3.7174 + random.uniform(-0.05, 0.05)},
+        'status': random.choice(statuses),
+        'title': random_text(4),
+        'description': random_text(30),
+    }) for i in xrange(count)])
+
+
+def _create_form_callback(section_count, component_count):
+    sections = []
+    values = []
+    for i in xrange(section_count):
+        section_id = u'section-%d' % i
+        sections.append({
+            'id': section_id, 'title': random_text(3), 'description': random_text(10), 'next_action': None,
+            'branding': None, 'next_button_caption': None,
+            'components': [{'type': FormComponentType.PARAGRAPH, 'title': random_text(3),
+                            'description': random_text(20)} for _ in xrange(component_count)],
+        })
+        components = []
+        for j in xrange(component_count):
+            component_id = u'component-%d-%d' % (i, j)
+            if j % 3 == 0:
+                components.append({'type': FormComponentType.LOCATION, 'id': component_id, 'latitude': 51.0543,
+                                   'longitude': 3.7174, 'address': None})
+            elif j % 3 == 1:
+                components.append({'type': FormComponentType.SINGLE_SELECT, 'id': component_id, 'value': u'choice'})
+            else:
+                components.append({'type': FormComponentType.TEXT_INPUT, 'id': component_id,
+                                   'value': random_text(15)})
+        values.append({'id': section_id, 'components': components})
+    return {
+        'form': {'id': 1, 'title': u'Melding', 'sections': sections, 'submission_section': None,
+                 'max_submissions': -1, 'version': 1},
+        'submission': {'id': 1, 'sections': values, 'submitted_date': u'2019-06-01T10:00:00Z', 'version': 1,
+                       'external_reference': None},
+        'user_details': None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--sections', type=int, default=10)
+    parser.add_argument('--components', type=int, default=10, help='components per section')
+    args = parser.parse_args()
+
+    random.seed(42)
+    response = _create_items_response(args.items)
+    serialized_response = serialize_complex_value(response, GetMapItemsResponseTO, False)
+    callback = _create_form_callback(args.sections, args.components)
+    cases = [
+        ('serialize /items response', lambda: serialize_complex_value(response, GetMapItemsResponseTO, False),
+         lambda: codec.serialize(response, GetMapItemsResponseTO, False)),
+        ('parse /items response', lambda: parse_complex_value(GetMapItemsResponseTO, serialized_response, False),
+         lambda: codec.parse(GetMapItemsResponseTO, serialized_response, False)),
+        ('parse form callback', lambda: parse_complex_value(FormSubmittedCallback, callback, False),
+         lambda: codec.parse(FormSubmittedCallback, callback, False)),
+    ]
+    rows = []
+    for name, generic, compiled in cases:
+        generic_time = measure(generic)
+        compiled_time = measure(compiled)
+        rows.append([name, generic_time * 1000, compiled_time * 1000, generic_time / compiled_time])
+    print_table(['payload', 'mcfw (ms)', 'codec (ms)', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
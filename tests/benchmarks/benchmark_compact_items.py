@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Size and CPU time of an /items response in the compact format (see MapItemsCompactTO) against the regular format.
+The CPU time includes converting the items and serializing the response to json, like map_api.api_get_items does.
+"""
+import argparse
+import json
+import random
+import zlib
+
+from bench_utils import measure, random_text, print_table
+from plugins.reports.bizz import convert_hit_to_item_to
+from plugins.reports.bizz.map import encode_compact_items
+from plugins.reports.models import IncidentStatus
+from plugins.reports.to import GetMapItemsResponseTO
+from plugins.reports.utils import codec
+
+
+def _create_items(count):
+    statuses = [IncidentStatus.NEW, IncidentStatus.IN_PROGRESS, IncidentStatus.RESOLVED]
+    return [convert_hit_to_item_to(u'%032x' % random.getrandbits(128), {
+        'location': {'lat': 51.0543 + random.uniform(-0.05, 0.05), 'lon': 3.7174 + random.uniform(-0.05, 0.05)},
+        'status': random.choice(statuses),
+        'title': random_text(4),
+        'description': random_text(30),
+    }) for _ in xrange(count)]
+
+
+def _to_json(response):
+    return json.dumps(codec.serialize(response, GetMapItemsResponseTO, False), separators=(',', ':'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, nargs='+', default=[100, 1000])
+    args = parser.parse_args()
+
+    random.seed(42)
+    rows = []
+    for count in args.items:
+        items = _create_items(count)
+        formats = [('full', lambda: _to_json(GetMapItemsResponseTO(items=items))),
+                   ('compact', lambda: _to_json(GetMapItemsResponseTO(items=[], compact=encode_compact_items(items))))]
+        for name, encode in formats:
+            content = encode()
+            rows.append([count, name, len(content), len(zlib.compress(content, 6)), measure(encode) * 1000])
+    print_table(['items', 'format', 'bytes', 'gzipped bytes', 'cpu (ms)'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+"""
+Concurrent votes on one incident: the sharded counters of update_incident_vote against a transaction on a single
+IncidentVote entity, the way votes were counted before.
+
+The datastore stub detects conflicting transactions like the datastore does, but answers immediately. Every datastore
+call is therefore delayed by --latency ms, otherwise transactions hardly ever overlap. Absolute numbers mean nothing,
+compare the throughput and the failed votes of both counters as the amount of threads grows.
+"""
+import argparse
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.datastore_errors import TransactionFailedError
+from google.appengine.ext import ndb
+
+from bench_utils import setup_testbed, print_table
+from plugins.reports.bizz import update_incident_vote, get_incident_votes
+from plugins.reports.models import IncidentVote, UserIncidentVote
+
+
+@ndb.transactional(xg=True)
+def _vote_single_counter(incident_id, user_id, option_id):
+    vote_key = IncidentVote.create_key(incident_id)
+    user_vote_key = UserIncidentVote.create_key(user_id, incident_id)
+    vote, user_vote = ndb.get_multi((vote_key, user_vote_key))
+    if user_vote:
+        return
+    vote = vote or IncidentVote(key=vote_key)
+    vote.negative_count += 1
+    ndb.put_multi([vote, UserIncidentVote(key=user_vote_key, incident_id=incident_id, option_id=option_id)])
+
+
+def _vote_sharded(incident_id, user_id, option_id):
+    update_incident_vote(incident_id, user_id, None, option_id)
+
+
+def _add_latency(latency):
+    def hook(service, call, request, response):
+        if call in ('Get', 'Put', 'Commit', 'BeginTransaction'):
+            time.sleep(latency)
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark-latency', hook, 'datastore_v3')
+
+
+def _run(vote_func, incident_id, thread_count, votes_per_thread):
+    failures = []
+
+    def vote(thread_index):
+        for i in xrange(votes_per_thread):
+            try:
+                vote_func(incident_id, u'user-%d-%d' % (thread_index, i), IncidentVote.NEGATIVE)
+            except TransactionFailedError:
+                failures.append(thread_index)
+
+    threads = [threading.Thread(target=vote, args=(i,)) for i in xrange(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    return (thread_count * votes_per_thread - len(failures)) / duration, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--votes', type=int, default=20, help='votes per thread')
+    parser.add_argument('--latency', type=float, default=10, help='ms per datastore call')
+    args = parser.parse_args()
+
+    setup_testbed()
+    _add_latency(args.latency / 1000)
+    rows = []
+    for thread_count in args.threads:
+        single_rate, single_failed = _run(_vote_single_counter, u'single-%d' % thread_count, thread_count, args.votes)
+        sharded_incident_id = u'sharded-%d' % thread_count
+        sharded_rate, sharded_failed = _run(_vote_sharded, sharded_incident_id, thread_count, args.votes)
+        counted = get_incident_votes([sharded_incident_id])[sharded_incident_id].negative_count
+        assert counted == thread_count * args.votes - sharded_failed, 'sharded counters lost votes'
+        rows.append([thread_count, single_rate, single_failed, sharded_rate, sharded_failed])
+    print_table(['threads', 'single votes/s', 'single failed', 'sharded votes/s', 'sharded failed'], rows)
+
+
+if __name__ == '__main__':
+    main()